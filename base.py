@@ -1,6 +1,5 @@
 from core import *
 from twisted.internet import defer
-from collections import defaultdict
 
 class Adventurer(Action):
     cost = 6
@@ -22,15 +21,16 @@ class Adventurer(Action):
         #TODO: discarding can trigger a reaction
         self.owner.discard.extend(discardedCards)
         self.owner.hand.extend(treasureCards)
-        self.owner.addToLog("revealing %s." % (', '.join([repr(x) for x in revealedCards])))
+        self.owner.reveal(revealedCards)
+        self.owner.addToLog("revealing %s.", CardList(revealedCards))
         if discardedCards:
-            self.owner.addToLog("discarding %s." % (', '.join([repr(x) for x in discardedCards])))
-        self.owner.addToLog("putting %s into the hand." % (', '.join([repr(x) for x in treasureCards])))
+            self.owner.addToLog("discarding %s.", CardList(discardedCards))
+        self.owner.addToLog("putting %s into the hand.", CardList(treasureCards))
 
 class Bureaucrat(Attack):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         silver = self.owner.game.getCardFromSupply("Silver")
         if silver:
@@ -42,31 +42,29 @@ class Bureaucrat(Attack):
             player.userService.sendMessage("(Bureaucrat attack) Choose a Victory card to put back on your deck:")
             d = player.userService.chooseCardFromHand(Victory)
             deferreds.append(d)
-        results = yield defer.gatherResults(deferreds)
+        results = yield gatherResults(deferreds)
         for i, player in enumerate(playersAffected):
             card = results[i]
             if card:
-                player.drawdeck.insert(0, card)
+                player.reveal([card])
+                player.drawdeck.putOnTop(card)
                 player.hand.remove(card)
-                self.owner.addToLog("%s reveals a %s and puts it back on their deck." % (player, repr(card)))
+                self.owner.addToLog("%s reveals a %s and puts it back on their deck.", player, card)
             else:
-                cardCount = defaultdict(int)
-                for card in player.hand:
-                    cardCount[repr(card)] += 1
-                handStr = ', '.join(["%s: %d" % (name, count) for name, count in cardCount.iteritems()])
-                self.owner.addToLog("%s reveals their hand: %s" % (player, handStr))
+                player.reveal(list(player.hand))
+                self.owner.addToLog("%s reveals their hand: %s", player, CardList(list(player.hand), counts=True))
 
 
 class Cellar(Action):
     cost = 2
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.actions += 1
         self.owner.addToLog("getting +1 action")
         numDiscard = -1
         while numDiscard < 0 or numDiscard > len(self.owner.hand):
-            numDiscard = yield self.owner.userService.getChoice("How many cards would you like to discard? (min 0, max %s)" % len(self.owner.hand))
+            numDiscard = yield self.owner.userService.getChoice("How many cards would you like to discard?", 0, len(self.owner.hand))
             numDiscard = int(numDiscard)
         cards = yield self.owner.userService.chooseCardsFromHand(Card, numDiscard)
         for card in cards:
@@ -76,19 +74,18 @@ class Cellar(Action):
 
         drawnCards = self.owner.draw(numDiscard)
 
-        self.owner.addToLog("discarding %d cards and drawing %d cards" % (numDiscard, len(drawnCards)))
+        self.owner.addToLog("discarding %d cards and drawing %d cards", numDiscard, len(drawnCards))
 
 class Chancellor(Action):
     cost = 3
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.coins += 2
         self.owner.addToLog("getting +$2.")
         choice = yield self.owner.userService.getYesNoChoice("Put deck in discard pile?")
         if choice:
-            self.owner.discard += self.owner.drawdeck
-            self.owner.drawdeck = []
+            self.owner.discard.extend(self.owner.drawdeck.takeAll())
             self.owner.addToLog("discarding the deck.")
         else:
             self.owner.addToLog("not discarding the deck.")
@@ -96,55 +93,41 @@ class Chancellor(Action):
 class Chapel(Action):
     cost = 2
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         numTrash = -1
         while numTrash < 0 or numTrash > 4:
-            numTrash = yield self.owner.userService.getChoice("How many cards would you like to trash? (min 0, max 4)")
+            numTrash = yield self.owner.userService.getChoice("How many cards would you like to trash?", 0, 4)
             numTrash = int(numTrash)
         cards = yield self.owner.userService.chooseCardsFromHand(Card, numTrash)
         for card in cards:
             self.owner.trashFromHand(card)
-        self.owner.addToLog("trashing %d cards." % numTrash)
+        self.owner.addToLog("trashing %d cards.", numTrash)
 
 class CouncilRoom(Action):
     cost = 5
-
-    def __repr__(self):
-        return "Council Room"
-
-    def doAction(self):
-        drawnCards = self.owner.draw(4)
-        self.owner.buys += 1
-        self.owner.addToLog("getting +1 buy and drawing %d cards" % len(drawnCards))
-        for player in self.owner.game.players:
-            if player != self.owner:
-                drawnCards = player.draw(1)
-                if drawnCards:
-                    self.owner.addToLog("%s draws 1 card" % player.name)
-                else:
-                    self.owner.addtoLog("%s draws no cards" % player.name)
+    displayName = "Council Room"
+    plusCards = 4
+    plusBuys = 1
+    othersDraw = 1
 
 class Feast(Action):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.userService.sendMessage("Choose a card to gain:")
         cardToGainName = yield self.owner.userService.chooseCardFromSupply(Card, 5)
         cardToGain = self.owner.game.getCardFromSupply(cardToGainName)
         self.owner.gainToDiscard(cardToGain)
         self.markedForTrash = True
-        self.owner.addToLog("trashing the Feast and gaining a %s." % repr(cardToGain))
+        self.owner.addToLog("trashing the Feast and gaining a %s.", cardToGain)
 
 class Festival(Action):
     cost = 5
-
-    def doAction(self):
-        self.owner.actions += 2
-        self.owner.buys += 1
-        self.owner.coins += 2
-        self.owner.addToLog("getting +2 actions, +1 buy, and +$2.")
+    plusActions = 2
+    plusBuys = 1
+    plusCoins = 2
 
 class Gardens(Victory):
     cost = 4
@@ -155,16 +138,13 @@ class Gardens(Victory):
 
 class Laboratory(Action):
     cost = 5
-
-    def doAction(self):
-        self.owner.actions += 1
-        drawnCards = self.owner.draw(2)
-        self.owner.addToLog("getting +1 action and drawing %d cards." % len(drawnCards))
+    plusCards = 2
+    plusActions = 1
 
 class Library(Action):
     cost = 5
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         sidePile = []
         while len(self.owner.hand) < 7 and (self.owner.drawdeck or self.owner.discard):
@@ -181,24 +161,21 @@ class Library(Action):
                 self.owner.hand.append(revealedCard)
 
         if sidePile:
-            #self.owner.addToLog("discarding a %s." % (', '.join([repr(x) for x in sidePile])))
-            self.owner.addToLog("discarding %d cards" % len(sidePile))
+            #self.owner.addToLog("discarding a %s.", CardList(sidePile))
+            self.owner.addToLog("discarding %d cards", len(sidePile))
             self.owner.discard.extend(sidePile)
 
 class Market(Action):
     cost = 5
-
-    def doAction(self):
-        drawnCards = self.owner.draw(1)
-        self.owner.actions += 1
-        self.owner.buys += 1
-        self.owner.coins += 1
-        self.owner.addToLog("drawing %d card and getting +1 action, +1 buy, +$1." % len(drawnCards))
+    plusCards = 1
+    plusActions = 1
+    plusBuys = 1
+    plusCoins = 1
 
 class Militia(Attack):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.coins += 2
         self.owner.addToLog("getting +$2.")
@@ -213,10 +190,10 @@ class Militia(Attack):
                 d = player.userService.chooseCardsFromHand(Card, numDiscard)
                 deferreds.append(d)
                 players.append(player)
-        result = yield defer.gatherResults(deferreds)
+        result = yield gatherResults(deferreds)
         for i, player in enumerate(players):
             cardList = result[i]
-            self.owner.addToLog("%s discards %d cards." % (player.name, len(cardList)))
+            self.owner.addToLog("%s discards %d cards.", player.name, len(cardList))
 
             #TODO: discarding can trigger a reaction
             player.discard.extend(cardList)
@@ -226,7 +203,7 @@ class Militia(Attack):
 class Mine(Action):
     cost = 5
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         #TODO: utilize the userservice object here for interaction
         self.owner.userService.sendMessage("Choose a treasure to upgrade:")
@@ -235,27 +212,28 @@ class Mine(Action):
             #self.owner.userService.sendMessage("Upgrading " + repr(cardToUpgrade))
             availableCoins = cardToUpgrade.getCost() + 3
             self.owner.trashFromHand(cardToUpgrade)
-            self.owner.addToLog("trashing a %s." % repr(cardToUpgrade))
+            self.owner.addToLog("trashing a %s.", cardToUpgrade)
             self.owner.userService.sendMessage("Choose a treasure to upgrade to:")
             cardToGainName = yield self.owner.userService.chooseCardFromSupply(Treasure, availableCoins)
             cardToGain = self.owner.game.getCardFromSupply(cardToGainName)
             self.owner.gainInHand(cardToGain)
-            self.owner.addToLog("gaining a %s in hand." % repr(cardToGain))
+            self.owner.addToLog("gaining a %s in hand.", cardToGain)
 
 class Moat(Action, AttackReaction):
     cost = 2
 
     def doAction(self):
         drawnCards = self.owner.draw(2)
-        self.owner.addToLog("drawing %d cards." % len(drawnCards))
+        self.owner.addToLog("drawing %d cards.", len(drawnCards))
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doReaction(self, player):
         """Return true if reaction makes this player immune to attack.
         player argument is the player initiating the attack"""
         choice = yield self.owner.userService.getYesNoChoice("Reveal moat?")
         if choice:
-            player.addToLog("%s reveals a Moat and is immune to the attack." % self.owner.name)
+            self.owner.reveal([self])
+            player.addToLog("%s reveals a Moat and is immune to the attack.", self.owner.name)
         defer.returnValue(choice)
 
 class Moneylender(Action):
@@ -271,139 +249,155 @@ class Moneylender(Action):
 class Remodel(Action):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.userService.sendMessage("Choose a card to trash:")
         cardToRemodel = yield self.owner.userService.chooseCardFromHand(Card)
         if cardToRemodel:
             costOfCard = cardToRemodel.cost
             self.owner.trashFromHand(cardToRemodel)
-            self.owner.addToLog("trashing a %s." % repr(cardToRemodel))
+            self.owner.addToLog("trashing a %s.", cardToRemodel)
             self.owner.userService.sendMessage("Choose a card to gain:")
             cardToGainName = yield self.owner.userService.chooseCardFromSupply(Card, costOfCard+2)
             cardToGain = self.owner.game.getCardFromSupply(cardToGainName)
             self.owner.gainToDiscard(cardToGain)
-            self.owner.addToLog("gaining a %s." % repr(cardToGain))
+            self.owner.addToLog("gaining a %s.", cardToGain)
 
 class Smithy(Action):
     cost = 4
-
-    def doAction(self):
-        drawnCards = self.owner.draw(3)
-        self.owner.addToLog("drawing %d cards." % len(drawnCards))
+    plusCards = 3
 
 class Spy(Attack):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         drawnCards = self.owner.draw(1)
         self.owner.actions += 1
-        self.owner.addToLog("drawing %d card and getting +1 action." % len(drawnCards))
+        self.owner.addToLog("drawing %d card and getting +1 action.", len(drawnCards))
 
         drawnCards = self.owner.draw(1, False)
         if drawnCards:
             card = drawnCards[0]
+            self.owner.reveal(drawnCards)
             choice = yield self.owner.userService.getYesNoChoice("Discard your %s?" % repr(card))
             if choice:
                 self.owner.discard.append(card)
-                self.owner.addToLog("revealing a %s and discarding it." % repr(card))
+                self.owner.addToLog("revealing a %s and discarding it.", card)
             else:
-                self.owner.drawdeck.insert(0, card)
-                self.owner.addToLog("revealing a %s and keeping it." % repr(card))
+                self.owner.drawdeck.putOnTop(card)
+                self.owner.addToLog("revealing a %s and keeping it.", card)
 
 
+        # the choices for all the players are asked at once and carried out
+        # in turn order once they are all in
         playersAffected = yield self.owner.game.doAttack(self.owner)
+        revealed = []
+        choices = []
         for player in playersAffected:
             drawnCards = player.draw(1, False)
             if drawnCards:
                 card = drawnCards[0]
-                choice = yield self.owner.userService.getYesNoChoice("Discard %s's %s?" % (player.name, repr(card)))
-                if choice:
-                    #TODO: discarding can trigger a reaction
-                    player.discard.append(card)
-                    self.owner.addToLog("making %s discard a %s." % (player.name, repr(card)))
-                else:
-                    player.drawdeck.insert(0, card)
-                    self.owner.addToLog("letting %s keep a %s." % (player.name, repr(card)))
+                player.reveal(drawnCards)
+                revealed.append((player, card))
+                choices.append(attempt(self.owner.userService.getYesNoChoice,
+                        "Discard %s's %s?" % (player.name, repr(card))))
+        outcomes = yield gatherOutcomes(choices)
+        for (player, card), (success, choice) in zip(revealed, outcomes):
+            if success and choice:
+                #TODO: discarding can trigger a reaction
+                player.discard.append(card)
+                self.owner.addToLog("making %s discard a %s.", player.name, card)
+            else:
+                player.drawdeck.putOnTop(card)
+                self.owner.addToLog("letting %s keep a %s.", player.name, card)
+        raiseFailures(outcomes)
 
 class Thief(Attack):
     cost = 4
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         playersAffected = yield self.owner.game.doAttack(self.owner)
+        revealed = []
         for player in playersAffected:
             drawnCards = player.draw(2, False)
             if drawnCards:
-                self.owner.addToLog("%s reveals %s" % (player.name, ', '.join([repr(x) for x in drawnCards])))
-                trashChoices = []
-                discard = []
-                for card in drawnCards:
-                    if isinstance(card, Treasure):
-                        trashChoices.append(card)
-                    else:
-                        discard.append(card)
-                if trashChoices:
-                    self.owner.userService.sendMessage("Choose a treasure to trash from %s's revealed cards:" % player.name)
-                    choice = yield self.owner.userService.getCardInstance(trashChoices)
-                    self.owner.addToLog("%s trashes %s's %s" % (self.owner.name, player.name, repr(choice)))
-
-                    gainCard = yield self.owner.userService.getYesNoChoice("Gain the %s?" % repr(choice))
-                    if gainCard:
-                        player.deck.remove(choice)
-                        self.owner.gainToDiscard(choice)
-                        self.owner.addToLog("%s gains the trashed %s" % (self.owner.name, repr(choice)))
-                    else:
-                        #TODO: don't call private method here
-                        player._trash(choice)
-
-                if discard:
-                    for card in discard:
-                        player.discard.append(card)
-                    self.owner.addToLog("%s discards %s" % (player.name, ', '.join([repr(x) for x in discard])))
+                player.reveal(drawnCards)
+                self.owner.addToLog("%s reveals %s", player.name, CardList(drawnCards))
+                revealed.append((player, drawnCards))
+
+        # the treasures to trash are chosen for all the players at once, then
+        # whether to gain them, and both are carried out in turn order. As
+        # the prompts are out together, each says whose cards it is about
+        service = self.owner.userService
+        choices = []
+        for player, drawnCards in revealed:
+            trashChoices = [x for x in drawnCards if isinstance(x, Treasure)]
+            if trashChoices:
+                choices.append(attempt(service.getCardInstance, trashChoices,
+                        "Choose a treasure to trash from %s's revealed %s:" % (player.name, CardList(drawnCards))))
+            else:
+                choices.append(None)
+        choices = yield gatherOutcomes(choices)
+        trashed = [card if success else None for success, card in choices]
+        gains = yield gatherOutcomes([attempt(service.getYesNoChoice, "Gain %s's trashed %s?" % (player.name, repr(card)))
+                if card is not None else False for (player, drawnCards), card in zip(revealed, trashed)])
+
+        for (player, drawnCards), card, (success, gainCard) in zip(revealed, trashed, gains):
+            discard = list(drawnCards)
+            if card is not None:
+                discard.remove(card)
+                self.owner.addToLog("%s trashes %s's %s", self.owner.name, player.name, card)
+                if success and gainCard:
+                    player.removeFromDeck(card)
+                    self.owner.gainToDiscard(card)
+                    self.owner.addToLog("%s gains the trashed %s", self.owner.name, card)
+                else:
+                    #TODO: don't call private method here
+                    player._trash(card)
+
+            if discard:
+                for card in discard:
+                    player.discard.append(card)
+                self.owner.addToLog("%s discards %s", player.name, CardList(discard))
+        raiseFailures(choices + gains)
 
 class ThroneRoom(Action):
     cost = 4
+    displayName = "Throne Room"
 
-    def __repr__(self):
-        return "Throne Room"
-
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         if (len([x for x in self.owner.hand if isinstance(x, Action)]) > 0):
             self.owner.userService.sendMessage("Choose an action card to play twice:")
             card = yield self.owner.userService.chooseCardFromHand(Action)
             if card:
-                self.owner.addToLog("and plays a %s." % repr(card))
+                #TODO: do this through methods on the Player object
+                # (Feast doesn't work yet)
+                self.owner.hand.remove(card)
+                self.owner.played.append(card)
+                self.owner.addToLog("and plays a %s.", card)
                 self.owner.pushLogLevel()
                 yield card.doAction()
                 self.owner.popLogLevel()
-                self.owner.addToLog("and plays the %s again." % repr(card))
+                self.owner.addToLog("and plays the %s again.", card)
                 self.owner.pushLogLevel()
                 yield card.doAction()
                 self.owner.popLogLevel()
 
-                #TODO: do this through methods on the Player object
-                # (Feast doesn't work yet)
-                self.owner.hand.remove(card)
-                self.owner.played.append(card)
-
 class Village(Action):
     cost = 3
-
-    def doAction(self):
-        self.owner.actions += 2
-        drawnCards = self.owner.draw(1)
-        self.owner.addToLog("getting +2 actions and drawing %d card." % len(drawnCards))
+    plusCards = 1
+    plusActions = 2
 
 class Witch(Attack):
     cost = 5
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         drawnCards = self.owner.draw(2)
-        self.owner.addToLog("drawing %s cards." % len(drawnCards))
+        self.owner.addToLog("drawing %s cards.", len(drawnCards))
 
         playersAffected = yield self.owner.game.doAttack(self.owner)
         for player in playersAffected:
@@ -411,23 +405,20 @@ class Witch(Attack):
             if curse:
                 gained = yield player.gainToDiscard(curse)
                 if gained:
-                    self.owner.addToLog("%s gains a Curse." % player.name)
+                    self.owner.addToLog("%s gains a Curse.", player.name)
 
 class Woodcutter(Action):
     cost = 3
-
-    def doAction(self):
-        self.owner.buys += 1
-        self.owner.coins += 2
-        self.owner.addToLog("getting +1 buy and +$2.")
+    plusBuys = 1
+    plusCoins = 2
 
 class Workshop(Action):
     cost = 3
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAction(self):
         self.owner.userService.sendMessage("Choose card to gain:")
         cardToGainName = yield self.owner.userService.chooseCardFromSupply(Card, 4)
         cardToGain = self.owner.game.getCardFromSupply(cardToGainName)
         self.owner.gainToDiscard(cardToGain)
-        self.owner.addToLog("gaining a %s." % repr(cardToGain))
+        self.owner.addToLog("gaining a %s.", cardToGain)
@@ -0,0 +1,271 @@
+import sys
+import json
+import time
+import platform
+from optparse import OptionParser
+
+from core import *
+from base import *
+import simulation
+from simulation import BigMoneyBot, SmithyBot, RandomBot, resultOf
+
+# kingdoms the full game benchmarks are played on
+FIRST_GAME = ["Cellar", "Market", "Militia", "Mine", "Moat", "Remodel",
+              "Smithy", "Village", "Woodcutter", "Workshop"]
+ATTACKS = ["Bureaucrat", "Chapel", "Library", "Militia", "Moat", "Spy",
+           "Thief", "ThroneRoom", "Witch", "CouncilRoom"]
+
+# each repeat runs for at least this long
+MIN_TIME = 0.2
+DEFAULT_REPEATS = 5
+# a benchmark is flagged when it got slower than this fraction
+DEFAULT_THRESHOLD = 0.10
+
+timer = time.time
+BENCHMARKS = []
+
+def benchmark(name):
+    """Registers a benchmark. A benchmark is called with a number of loops
+    and returns the seconds spent doing them, leaving out its setup"""
+    def register(function):
+        BENCHMARKS.append((name, function))
+        return function
+    return register
+
+def makeGame(cards=FIRST_GAME, bots=(SmithyBot, SmithyBot), seed=0):
+    """Returns a set up game between bots, which answer all prompts"""
+    players = [Player("%s%d" % (bot.__name__, i+1)) for i, bot in enumerate(bots)]
+    game = GameManager(players, seed)
+    for bot, player in zip(bots, players):
+        player.userService = bot(game, player)
+    game.setup(cards)
+    return game
+
+def _withBots(game, bots):
+    for bot, player in zip(bots, game.players):
+        player.userService = bot(game, player)
+    return game
+
+@benchmark("draw")
+def benchDraw(loops):
+    game = makeGame()
+    player = game.currentPlayer
+    player.drawdeck.cards.extend([Copper() for i in xrange(loops * 5)])
+    start = timer()
+    for i in xrange(loops):
+        player.draw(5)
+    return timer() - start
+
+@benchmark("draw_reshuffle")
+def benchDrawReshuffle(loops):
+    game = makeGame()
+    player = game.currentPlayer
+    player.drawdeck = DrawPile()
+    discards = [[Copper() for j in xrange(12)] for i in xrange(loops)]
+    start = timer()
+    for discard in discards:
+        player.discard = discard
+        player.draw(5)
+    return timer() - start
+
+@benchmark("cleanup")
+def benchCleanup(loops):
+    game = makeGame()
+    player = game.currentPlayer
+    elapsed = 0.0
+    for i in xrange(loops):
+        player.discard = []
+        player.drawdeck = DrawPile([Copper() for j in xrange(5)])
+        player.played.extend([Village(), Silver(), Silver()])
+        start = timer()
+        player.cleanup()
+        elapsed += timer() - start
+    return elapsed
+
+def _benchPlay(cardName):
+    def benchPlay(loops):
+        base = makeGame(ATTACKS if cardName in ATTACKS else FIRST_GAME, (SmithyBot, SmithyBot, SmithyBot))
+        player = base.currentPlayer
+        # something to act on for the cards that need it
+        for name in ("Silver", "Estate", "Copper", "Village"):
+            card = base.cardFactory.newCard(name)
+            player.addToDeck(card)
+            player.hand.append(card)
+        card = base.cardFactory.newCard(cardName)
+        player.addToDeck(card)
+        player.hand.append(card)
+        elapsed = 0.0
+        for i in xrange(loops):
+            game = _withBots(base.clone(), (SmithyBot, SmithyBot, SmithyBot))
+            player = game.currentPlayer
+            card = player.hand[-1]
+            start = timer()
+            resultOf(player.play(card))
+            elapsed += timer() - start
+        return elapsed
+    return benchPlay
+
+for _info in CardFactory().getCardInfos():
+    if _info.kingdom and _info.isAction:
+        benchmark("play_%s" % _info.name)(_benchPlay(_info.name))
+
+@benchmark("play_treasure")
+def benchPlayTreasure(loops):
+    game = makeGame()
+    player = game.currentPlayer
+    player.turnphase = "BUY"
+    cards = [Copper() for i in xrange(loops)]
+    player.hand.extend(cards)
+    start = timer()
+    for card in cards:
+        player.play(card)
+    return timer() - start
+
+@benchmark("getAvailableCardsToBuy")
+def benchAvailable(loops):
+    game = makeGame()
+    start = timer()
+    for i in xrange(loops):
+        for coins in xrange(9):
+            game.getAvailableCardsToBuy(coins)
+    return timer() - start
+
+@benchmark("end")
+def benchEnd(loops):
+    game = makeGame()
+    start = timer()
+    for i in xrange(loops):
+        game.end()
+    return timer() - start
+
+@benchmark("doAttack")
+def benchDoAttack(loops):
+    game = makeGame(ATTACKS, (SmithyBot, SmithyBot, SmithyBot))
+    moat = game.cardFactory.newCard("Moat")
+    game.players[1].addToDeck(moat)
+    game.players[1].hand.append(moat)
+    start = timer()
+    for i in xrange(loops):
+        resultOf(game.doAttack(game.currentPlayer))
+    return timer() - start
+
+@benchmark("setup")
+def benchSetup(loops):
+    start = timer()
+    for i in xrange(loops):
+        makeGame(seed=i)
+    return timer() - start
+
+def _benchGame(bots, cards):
+    def benchGame(loops):
+        start = timer()
+        for i in xrange(loops):
+            simulation.playGame(bots, cards, seed=i)
+        return timer() - start
+    return benchGame
+
+benchmark("game_bigmoney")(_benchGame((BigMoneyBot, BigMoneyBot), FIRST_GAME))
+benchmark("game_smithy")(_benchGame((SmithyBot, BigMoneyBot), FIRST_GAME))
+benchmark("game_random_3p")(_benchGame((RandomBot, RandomBot, RandomBot), ATTACKS))
+
+def runBenchmark(function, repeats=DEFAULT_REPEATS, minTime=MIN_TIME):
+    """Finds a number of loops taking at least minTime, then times that many
+    loops repeats times. Returns the statistics of the time per loop"""
+    loops = 1
+    while True:
+        elapsed = function(loops)
+        if elapsed >= minTime or loops >= 1 << 20:
+            break
+        loops *= 10 if elapsed < minTime / 10 else 2
+    times = [function(loops) / loops for i in xrange(repeats)]
+    times.sort()
+    mean = sum(times) / len(times)
+    return {
+            "loops": loops,
+            "min": times[0],
+            "median": times[len(times) // 2],
+            "mean": mean,
+            "stdev": (sum([(x - mean) ** 2 for x in times]) / len(times)) ** 0.5,
+            }
+
+def runBenchmarks(names=None, repeats=DEFAULT_REPEATS, minTime=MIN_TIME, out=None):
+    """Runs the benchmarks whose names start with one of names, or all of
+    them, and returns the results in the form saved as JSON"""
+    results = {}
+    for name, function in BENCHMARKS:
+        if names and not any(name.startswith(x) for x in names):
+            continue
+        results[name] = runBenchmark(function, repeats, minTime)
+        if out:
+            out.write("%-28s %s\n" % (name, formatTime(results[name]["min"])))
+            out.flush()
+    return {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "repeats": repeats,
+            "results": results,
+            }
+
+def compare(base, new, threshold=DEFAULT_THRESHOLD, key="min"):
+    """Compares two result sets. Returns (name, base time, new time, ratio,
+    flag) for every benchmark in both, where flag is 'slower' or 'faster'
+    if the change is beyond threshold"""
+    rows = []
+    for name in sorted(set(base["results"]) & set(new["results"])):
+        before = base["results"][name][key]
+        after = new["results"][name][key]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "slower"
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        rows.append((name, before, after, ratio, flag))
+    return rows
+
+def formatTime(seconds):
+    if seconds >= 1:
+        return "%.2f s" % seconds
+    if seconds >= 1e-3:
+        return "%.2f ms" % (seconds * 1e3)
+    return "%.2f us" % (seconds * 1e6)
+
+def main():
+    parser = OptionParser(usage="%prog run [options] [BENCHMARK...]\n"
+                                "       %prog compare [options] BASE.json NEW.json\n"
+                                "       %prog list")
+    parser.add_option("-o", "--output", help="save the results to this JSON file")
+    parser.add_option("-r", "--repeats", type="int", default=DEFAULT_REPEATS)
+    parser.add_option("-m", "--min-time", type="float", default=MIN_TIME,
+            help="minimum seconds per repeat")
+    parser.add_option("-t", "--threshold", type="float", default=DEFAULT_THRESHOLD,
+            help="relative change that counts as a regression")
+    options, args = parser.parse_args()
+    command = args[0] if args else "run"
+
+    if command == "list":
+        for name, function in BENCHMARKS:
+            print name
+    elif command == "run":
+        results = runBenchmarks(args[1:], options.repeats, options.min_time, sys.stdout)
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=1, sort_keys=True)
+    elif command == "compare":
+        if len(args) != 3:
+            parser.error("compare needs two result files")
+        with open(args[1]) as f:
+            base = json.load(f)
+        with open(args[2]) as f:
+            new = json.load(f)
+        rows = compare(base, new, options.threshold)
+        for name, before, after, ratio, flag in rows:
+            print "%-28s %10s %10s %6.2fx %s" % (name, formatTime(before), formatTime(after), ratio, flag)
+        if [x for x in rows if x[4] == "slower"]:
+            sys.exit(1)
+    else:
+        parser.error("unknown command %s" % command)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,273 @@
 from zope.interface import Interface
 from collections import Counter
-from itertools import cycle
 from twisted.internet import defer
+from twisted.python import failure
+import functools
 import random
+import copy
+
+from events import *
 
 _cardLookup = {}
+_cardInfo = {}
 _kingdomCardList = []
 
+# run the methods decorated with maybeInlineCallbacks as plain calls when
+# nothing they wait on is asynchronous. When False they always go through
+# inlineCallbacks and return Deferreds
+synchronous = True
+
+def maybeInlineCallbacks(f):
+    """Like defer.inlineCallbacks, but as long as the generator only yields
+    plain values and Deferreds that have already fired it runs as a plain
+    call: its result is returned and its exceptions are raised directly.
+    Only once it yields a Deferred that has yet to fire is the rest of it
+    run under inlineCallbacks, and a Deferred returned. Callers must accept
+    either, e.g. by yielding the result from inlineCallbacks code."""
+    deferred = defer.inlineCallbacks(f)
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        if not synchronous:
+            return deferred(*args, **kwargs)
+        return _runGenerator(f(*args, **kwargs))
+    return wrapper
+
+def _runGenerator(gen):
+    result = None
+    error = None
+    while True:
+        try:
+            if error is not None:
+                value = error.throwExceptionIntoGenerator(gen)
+            else:
+                value = gen.send(result)
+        except StopIteration:
+            return None
+        except defer._DefGen_Return as e:
+            return e.value
+        error = None
+        if not isinstance(value, defer.Deferred):
+            result = value
+            continue
+        results = []
+        value.addBoth(results.append)
+        if not results:
+            waiting = defer.Deferred()
+            def fired(ignored):
+                if isinstance(results[0], failure.Failure):
+                    waiting.errback(results[0])
+                else:
+                    waiting.callback(results[0])
+            value.addCallback(fired)
+            return _resumeGenerator(gen, waiting)
+        result = results[0]
+        if isinstance(result, failure.Failure):
+            error = result
+            result = None
+
+@defer.inlineCallbacks
+def _resumeGenerator(gen, waiting):
+    """Runs the rest of gen under inlineCallbacks once waiting fires"""
+    result = None
+    error = None
+    try:
+        result = yield waiting
+    except Exception:
+        error = failure.Failure()
+    while True:
+        try:
+            if error is not None:
+                value = error.throwExceptionIntoGenerator(gen)
+            else:
+                value = gen.send(result)
+        except StopIteration:
+            defer.returnValue(None)
+        except defer._DefGen_Return as e:
+            defer.returnValue(e.value)
+        error = None
+        try:
+            result = yield value
+        except Exception:
+            error = failure.Failure()
+
+def gatherResults(results):
+    """Like defer.gatherResults, but takes plain values as well as Deferreds
+    and returns a plain list if there are no Deferreds among them"""
+    if not [x for x in results if isinstance(x, defer.Deferred)]:
+        return list(results)
+    return defer.gatherResults([x if isinstance(x, defer.Deferred) else defer.succeed(x) for x in results])
+
+def attempt(f, *args, **kwargs):
+    """Calls f and returns its result, or a Failure if it raised, for
+    gatherOutcomes"""
+    try:
+        return f(*args, **kwargs)
+    except Exception:
+        return failure.Failure()
+
+def gatherOutcomes(results):
+    """Like gatherResults, but waits for all of results even if some of them
+    fail. Gives (success, value) pairs like a DeferredList consuming errors,
+    the value of a result that failed being its Failure. results may hold
+    Failures, as returned by attempt()"""
+    if not [x for x in results if isinstance(x, defer.Deferred)]:
+        return [(not isinstance(x, failure.Failure), x) for x in results]
+    deferreds = []
+    for x in results:
+        if isinstance(x, failure.Failure):
+            x = defer.fail(x)
+        elif not isinstance(x, defer.Deferred):
+            x = defer.succeed(x)
+        deferreds.append(x)
+    return defer.DeferredList(deferreds, consumeErrors=True)
+
+def raiseFailures(outcomes):
+    """Raises the first failure among the outcomes of gatherOutcomes"""
+    for success, value in outcomes:
+        if not success:
+            value.raiseException()
+
+def _joinWords(words):
+    if len(words) < 3:
+        return " and ".join(words)
+    return "%s, and %s" % (", ".join(words[:-1]), words[-1])
+
+class Effect(object):
+    """The stat changes of an action card declared as data, for example
+
+        class Village(Action):
+            cost = 3
+            plusCards = 1
+            plusActions = 2
+
+    A card declaring any of plusCards, plusActions, plusBuys, plusCoins or
+    othersDraw (cards drawn by every other player) and no doAction of its
+    own gets an Effect when CardType registers it. Playing the card applies
+    it in one step, with the log line built once up front."""
+    __slots__ = ("name", "cards", "actions", "buys", "coins", "othersDraw",
+                 "message", "othersMessage")
+
+    def __init__(self, name, cards=0, actions=0, buys=0, coins=0, othersDraw=0):
+        self.name = name
+        self.cards = cards
+        self.actions = actions
+        self.buys = buys
+        self.coins = coins
+        self.othersDraw = othersDraw
+
+        plural = lambda n: "" if n == 1 else "s"
+        gets = []
+        if actions:
+            gets.append("+%d action%s" % (actions, plural(actions)))
+        if buys:
+            gets.append("+%d buy%s" % (buys, plural(buys)))
+        if coins:
+            gets.append("+$%d" % coins)
+        words = []
+        if cards:
+            words.append("drawing %%d card%s" % plural(cards))
+        if gets:
+            words.append("getting %s" % _joinWords(gets))
+        self.message = " and ".join(words) + "."
+        self.othersMessage = "%%s draws %%d card%s" % plural(othersDraw)
+
+    @staticmethod
+    def compile(klass):
+        """Returns the Effect declared by card class klass, or None if it
+        declares none or plays itself through doAction"""
+        values = [getattr(klass, x, 0) for x in ("plusCards", "plusActions",
+                "plusBuys", "plusCoins", "othersDraw")]
+        if not any(values):
+            return None
+        for base in klass.__mro__:
+            if "doAction" in base.__dict__:
+                # the default doAction of Action applies the effect
+                if base.__name__ != "Action":
+                    return None
+                break
+        return Effect(klass.__name__, *values)
+
+    def apply(self, player):
+        player.actions += self.actions
+        player.buys += self.buys
+        player.coins += self.coins
+        if self.cards:
+            player.addToLog(self.message, len(player.draw(self.cards)))
+        else:
+            player.addToLog(self.message)
+        if self.othersDraw:
+            for other in player.game.players:
+                if other is not player:
+                    drawnCards = other.draw(self.othersDraw)
+                    if drawnCards:
+                        player.addToLog(self.othersMessage, other.name, len(drawnCards))
+                    else:
+                        player.addToLog("%s draws no cards", other.name)
+
+    def __repr__(self):
+        return "<Effect %s>" % self.name
+
 class CardFactory:
     def newCard(self, cardType):
-        if cardType in _cardLookup.keys():
-            return _cardLookup[cardType]()
+        klass = _cardLookup.get(cardType)
+        if klass:
+            return klass()
+
+    def getCardInfo(self, cardType):
+        """Returns the CardInfo of the named card type without creating a card"""
+        return _cardInfo.get(cardType)
+
+    def getCardInfos(self):
+        """Returns the CardInfo of every card type, ordered by id"""
+        return sorted(_cardInfo.itervalues(), key=lambda x: x.id)
+
+def _getCardInfo(cardType):
+    return _cardInfo[cardType]
+
+class CardInfo(object):
+    """Static metadata of a card type. Built once by CardType when the card
+    class is defined and shared by every instance of it"""
+    def __init__(self, name, klass, kingdom, id):
+        # small integer identifying the card type, in order of definition
+        self.id = id
+        self.name = name
+        self.klass = klass
+        self.displayName = klass.displayName
+        self.cost = klass.cost
+        self.kingdom = kingdom
+        # the card type classes may not all exist yet, so go by name
+        types = set([x.__name__ for x in klass.__mro__])
+        self.isAction = "Action" in types
+        self.isTreasure = "Treasure" in types
+        self.isVictory = "Victory" in types
+        self.isCurse = "Curse" in types
+        self.isAttack = "Attack" in types
+        self.isAttackReaction = "AttackReaction" in types
+        self.treasure = getattr(klass, "treasure", 0)
+        victory = getattr(klass, "victory", 0)
+        # None for cards whose value depends on the game state (Gardens)
+        self.victory = None if isinstance(victory, property) else victory
+        self.effect = Effect.compile(klass)
+
+    def __repr__(self):
+        return "<CardInfo %s>" % self.name
+
+    def __reduce__(self):
+        # unpickle to the registered instance, which is compared by identity
+        return (_getCardInfo, (self.name,))
 
 class CardType(type):
     def __new__(cls, name, bases, attrs):
         new = super(CardType, cls).__new__
         klass = new(cls, name,  bases, attrs)
+        if "displayName" not in attrs:
+            klass.displayName = name
+        kingdom = 'cost' in attrs and attrs['__module__'] != 'core'
+        if kingdom:
+            _kingdomCardList.append(name)
         if not attrs.pop("abstract", None):
             _cardLookup[name] = klass
-        if 'cost' in attrs and attrs['__module__'] != 'core':
-            _kingdomCardList.append(name)
+            klass.info = _cardInfo[name] = CardInfo(name, klass, kingdom, len(_cardInfo))
         return klass
 
 class Card:
@@ -45,7 +293,7 @@ class Card:
         return True
 
     def __repr__(self):
-        return self.__class__.__name__
+        return self.displayName
 
     def __lt__(self, other):
         return self.__repr__() < other.__repr__()
@@ -68,6 +316,16 @@ class Victory(Card):
 class Action(Card):
     abstract = True
 
+    # see Effect
+    plusCards = 0
+    plusActions = 0
+    plusBuys = 0
+    plusCoins = 0
+    othersDraw = 0
+
+    def doAction(self):
+        self.info.effect.apply(self.owner)
+
 class Attack(Action):
     abstract = True
 
@@ -147,8 +405,9 @@ class IUserService(Interface):
     def chooseCardForBuy():
         """Ask the user to choose a card to buy"""
 
-    def getCardInstance(validChoices):
-        """Ask the user to choose a card from their hand of specified type"""
+    def getCardInstance(validChoices, prompt):
+        """Ask the user to choose one of the cards validChoices, saying what
+        for with prompt if given"""
 
     def getCardNameByCost(validChoices):
         """Ask the user for what they want to buy given the valid choices"""
@@ -156,8 +415,9 @@ class IUserService(Interface):
     def getYesNoChoice(question):
         """Ask the user to respond to a yes or no question"""
 
-    def getChoice(prompt):
-        """Ask the user for input after printing the prompt"""
+    def getChoice(prompt, minimum, maximum):
+        """Ask the user for input after printing the prompt. Prompts for a
+        number give the least and the most it may be"""
 
     def noBuysRemain():
         """Notifies the user service object that the user is unable to do anything else"""
@@ -165,15 +425,118 @@ class IUserService(Interface):
 class IllegalAction(Exception):
     pass
 
+class Zone:
+    """A collection of cards with O(1) add, membership test and removal by
+    card. Removing a card moves the last card into its slot, so the order of
+    the remaining cards is not kept."""
+    def __init__(self, cards=()):
+        self.cards = []
+        self.index = {}
+        self.extend(cards)
+
+    def append(self, card):
+        self.index[card] = len(self.cards)
+        self.cards.append(card)
+
+    def extend(self, cards):
+        for card in cards:
+            self.append(card)
+
+    def remove(self, card):
+        try:
+            i = self.index.pop(card)
+        except KeyError:
+            raise ValueError("%r is not in the zone" % card)
+        last = self.cards.pop()
+        if last is not card:
+            self.cards[i] = last
+            self.index[last] = i
+
+    def takeAll(self):
+        """Empties the zone and returns the cards that were in it"""
+        cards = self.cards
+        self.cards = []
+        self.index = {}
+        return cards
+
+    def __contains__(self, card):
+        return card in self.index
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __getitem__(self, i):
+        return self.cards[i]
+
+    def __repr__(self):
+        return repr(self.cards)
+
+    def copy(self, cards):
+        """Returns a copy of the zone holding the cards mapped to by cards"""
+        zone = Zone()
+        zone.cards = [cards[x] for x in self.cards]
+        zone.index = dict((x, i) for i, x in enumerate(zone.cards))
+        return zone
+
+class DrawPile:
+    """A player's draw pile. The top of the pile is kept at the end of the
+    underlying list so drawing and putting cards back on top are O(1) per
+    card, however big the pile is."""
+    def __init__(self, cards=()):
+        self.cards = list(cards)
+
+    def draw(self, number):
+        """Removes up to number cards from the top and returns them, top card
+        first"""
+        if number >= len(self.cards):
+            drawnCards = self.cards
+            self.cards = []
+        else:
+            drawnCards = self.cards[-number:]
+            del self.cards[-number:]
+        drawnCards.reverse()
+        return drawnCards
+
+    def putOnTop(self, card):
+        self.cards.append(card)
+
+    def takeAll(self):
+        """Empties the pile and returns its cards, top card first"""
+        return self.draw(len(self.cards))
+
+    def __iter__(self):
+        return reversed(self.cards)
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def copy(self, cards):
+        pile = DrawPile()
+        pile.cards = [cards[x] for x in self.cards]
+        return pile
+
 class Player:
+    # recount the score after every change and fail if the incremental score
+    # disagrees with it
+    debugScore = False
+
     def __init__(self, name):
         self.name = name
-        self.hand = []
-        self.played = []
-        self.drawdeck = []
+        self.hand = Zone()
+        self.played = Zone()
+        self.drawdeck = DrawPile()
         self.discard = []
-        self.deck = []
+        self.deck = Zone()
         self.score = 0
+        self.fixedScore = 0
+        self.variableScore = 0
+        self.variableVictoryCards = []
         self.turn = 1
 
         self.turnphase = "IDLE"
@@ -181,176 +544,378 @@ class Player:
         self.buys = 1
         self.coins = 0
 
-        self.logBuffer = []
-        self.logLevel = ""
+        # nesting level of the narrative, e.g. inside a Throne Room
+        self.logDepth = 0
 
     def __repr__(self):
         return self.name
 
     def draw(self, number, placeInHand=True):
-        if not self.drawdeck and not self.discard:
-            return []
-        if len(self.drawdeck) < number:
-            drawnCards = self.drawdeck[:]
-            remaining = number - len(self.drawdeck)
-            if placeInHand:
-                self.hand.extend(drawnCards)
-            self.drawdeck[:] = self.discard[:]
-            self.discard[:] = []
-            random.shuffle(self.drawdeck)
-            self.addToLog("(%s reshuffles.)" % self.name)
-            drawnCards.extend(self.draw(remaining, placeInHand))
-            return drawnCards
-        else:
-            drawnCards = self.drawdeck[:number]
-            if placeInHand:
-                self.hand.extend(drawnCards)
-            self.drawdeck[:] = self.drawdeck[number:]
-            return drawnCards
+        drawnCards = self.drawdeck.draw(number)
+        if len(drawnCards) < number and self.discard:
+            self.reshuffle()
+            drawnCards.extend(self.drawdeck.draw(number - len(drawnCards)))
+        if placeInHand:
+            self.hand.extend(drawnCards)
+        if drawnCards and self.game.events.subscribers:
+            self.game.events.publish(DrawEvent(self, drawnCards, placeInHand))
+        return drawnCards
+
+    def reshuffle(self):
+        """Shuffles the discard pile and places it under the draw pile"""
+        cards = self.discard
+        self.discard = []
+        self.game.random.shuffle(cards)
+        cards.extend(self.drawdeck.cards)
+        self.drawdeck.cards = cards
+        if self.game.events.subscribers:
+            self.game.events.publish(ReshuffleEvent(self))
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def play(self, card):
         assert card in self.hand
-        if self.turnphase == "ACTION" and isinstance(card, Action) and self.actions > 0:
-            self.played.append(card)
-            self.hand.remove(card)
-            self.pushLogLevel()
-            yield card.doAction()
-            self.popLogLevel()
-            shouldTrash = False
-            try:
-                shouldTrash = card.markedForTrash
-            except AttributeError:
-                pass
-            if shouldTrash:
-                self.trashFromPlay(card)
-            self.actions -= 1
-            defer.returnValue(True)
-        elif self.turnphase == "ACTION" and isinstance(card, Treasure):
-            self.turnphase = "BUY"
-
-        if self.turnphase == "BUY" and isinstance(card, Treasure):
-            self.coins += card.getTreasure()
-            self.played.append(card)
-            self.hand.remove(card)
-            defer.returnValue(True)
-
-        defer.returnValue(False)
-
-    @defer.inlineCallbacks
+        self.game.startAction("play", self, card.info.name, self.hand.index[card])
+        try:
+            if self.turnphase == "ACTION" and isinstance(card, Action) and self.actions > 0:
+                self.played.append(card)
+                self.hand.remove(card)
+                if self.game.events.subscribers:
+                    self.game.events.publish(PlayEvent(self, card))
+                self.pushLogLevel()
+                effect = card.info.effect
+                if effect is not None:
+                    effect.apply(self)
+                else:
+                    yield card.doAction()
+                self.popLogLevel()
+                shouldTrash = False
+                try:
+                    shouldTrash = card.markedForTrash
+                except AttributeError:
+                    pass
+                if shouldTrash:
+                    self.trashFromPlay(card)
+                self.actions -= 1
+                defer.returnValue(True)
+            elif self.turnphase == "ACTION" and isinstance(card, Treasure):
+                self.turnphase = "BUY"
+
+            if self.turnphase == "BUY" and isinstance(card, Treasure):
+                self.coins += card.getTreasure()
+                self.played.append(card)
+                self.hand.remove(card)
+                if self.game.events.subscribers:
+                    self.game.events.publish(PlayEvent(self, card))
+                defer.returnValue(True)
+
+            defer.returnValue(False)
+        finally:
+            self.game.endAction()
+
+    @maybeInlineCallbacks
     def buy(self, cardName):
         #assert card.getCost() <= self.coins
         self.turnphase = "BUY"
         if self.buys > 0:
-            card = self.game.getCardFromSupply(cardName)
-            yield self.gainToDiscard(card)
-            self.coins -= card.getCost()
-            self.buys -= 1
-            self.addToLog("%s buys a %s" % (self.name, repr(card)))
-            if self.buys == 0:
-                self.userService.noBuysRemain()
+            self.game.startAction("buy", self, cardName)
+            try:
+                card = self.game.getCardFromSupply(cardName)
+                yield self.gainToDiscard(card)
+                self.coins -= card.getCost()
+                self.buys -= 1
+                self.addToLog("%s buys a %s", self.name, card)
+                if self.buys == 0:
+                    self.userService.noBuysRemain()
+            finally:
+                self.game.endAction()
             defer.returnValue(True)
         defer.returnValue(False)
 
     def cleanup(self):
-        cardsToDiscard = [x for x in self.played if x.discard()]
-        self.played[:] = [x for x in self.played if x not in cardsToDiscard]
-        self.discard += cardsToDiscard
-        self.discard += self.hand
-        self.hand = []
+        for card in self.played.takeAll():
+            if card.discard():
+                self.discard.append(card)
+            else:
+                self.played.append(card)
+        self.discard.extend(self.hand.takeAll())
         self.turnphase = "IDLE"
         self.actions = 1
         self.buys = 1
         self.coins = 0
         self.draw(5)
 
-        self.logLevel = ''
-        #self.logBuffer = ''
+        self.logDepth = 0
 
-    def updateScore(self):
-        self.score = 0
+    def addToDeck(self, card):
+        """Makes card part of this player's deck and updates the score"""
+        card.owner = self
+        self.deck.append(card)
+        victory = card.info.victory
+        if victory is None:
+            self.variableVictoryCards.append(card)
+            self.updateVariableScore()
+        else:
+            self.fixedScore += victory
+            if self.variableVictoryCards and len(self.deck) % 10 == 0:
+                self.updateVariableScore()
+        self.score = self.fixedScore + self.variableScore
+        if self.debugScore:
+            self.checkScore()
+
+    def removeFromDeck(self, card):
+        """Removes card from this player's deck and updates the score"""
+        card.owner = None
+        self.deck.remove(card)
+        victory = card.info.victory
+        if victory is None:
+            self.variableVictoryCards.remove(card)
+            self.updateVariableScore()
+        else:
+            self.fixedScore -= victory
+            if self.variableVictoryCards and len(self.deck) % 10 == 9:
+                self.updateVariableScore()
+        self.score = self.fixedScore + self.variableScore
+        if self.debugScore:
+            self.checkScore()
+
+    def updateVariableScore(self):
+        """Re-evaluates the cards whose victory value depends on the deck
+        (Gardens). Only needed when one of them enters or leaves the deck or
+        the deck size crosses a multiple of 10"""
+        self.variableScore = sum([x.victory for x in self.variableVictoryCards])
+
+    def countScore(self):
+        """Counts the score from scratch"""
+        score = 0
         for card in self.deck:
             if isinstance(card, Victory) or isinstance(card, Curse):
-                self.score += card.victory
+                score += card.victory
+        return score
+
+    def updateScore(self):
+        self.score = self.countScore()
+
+    def checkScore(self):
+        score = self.countScore()
+        if score != self.score:
+            raise AssertionError("%s's incremental score %d does not match the recount %d" % (self.name, self.score, score))
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def gainInHand(self, card):
         shouldGain = yield self._gain(card)
         if shouldGain:
             self.hand.append(card)
         defer.returnValue(shouldGain)
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def gainToDiscard(self, card):
         shouldGain = yield self._gain(card)
         if shouldGain:
             self.discard.append(card)
         defer.returnValue(shouldGain)
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def _gain(self, card):
         shouldGain = yield card.onGain()
         if shouldGain:
-            card.owner = self
-            self.deck.append(card)
-            self.updateScore()
+            self.addToDeck(card)
+            if self.game.events.subscribers:
+                self.game.events.publish(GainEvent(self, card))
         defer.returnValue(shouldGain)
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def trashFromHand(self, card):
         assert card in self.hand
         shouldTrash = yield self._trash(card)
         if shouldTrash:
             self.hand.remove(card)
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def trashFromPlay(self, card):
         assert card in self.played
-        shouldTrash = yield card.onTrash()
+        shouldTrash = yield self._trash(card)
         if shouldTrash:
             self.played.remove(card)
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def _trash(self, card):
         shouldTrash = yield card.onTrash()
         if shouldTrash:
-            card.owner = None
-            self.deck.remove(card)
+            self.removeFromDeck(card)
             self.game.trash.append(card)
+            if self.game.events.subscribers:
+                self.game.events.publish(TrashEvent(self, card))
         defer.returnValue(shouldTrash)
 
-    def addToLog(self, message):
-        self.logBuffer.append(self.logLevel + message)
+    def reveal(self, cards):
+        """Shows cards to the other players"""
+        if self.game.events.subscribers:
+            self.game.events.publish(RevealEvent(self, cards))
 
-    def flushLog(self):
-        temp = self.logBuffer
-        self.logBuffer = []
-        self.logLevel = ""
-        return '\n'.join(temp)
+    def addToLog(self, message, *args):
+        """Adds a line to the game log. message is only formatted with args
+        if somebody renders the log"""
+        if self.game.events.subscribers:
+            self.game.events.publish(MessageEvent(self, message, args))
 
     def pushLogLevel(self):
-        self.logLevel += "... "
+        self.logDepth += 1
 
     def popLogLevel(self):
-        self.logLevel = self.logLevel[:-4]
+        self.logDepth -= 1
+
+    def clone(self, game, cards):
+        """Returns a copy of this player for the cloned game, with copies of
+        the cards in its deck. The copies are added to cards, which maps the
+        cards of the original game to them. The copy has no user service"""
+        player = copy.copy(self)
+        player.game = game
+        player.userService = None
+        for card in self.deck:
+            cards[card] = _copyCard(card, player)
+        player.hand = self.hand.copy(cards)
+        player.played = self.played.copy(cards)
+        player.deck = self.deck.copy(cards)
+        player.drawdeck = self.drawdeck.copy(cards)
+        player.discard = [cards[x] for x in self.discard]
+        player.variableVictoryCards = [cards[x] for x in self.variableVictoryCards]
+        return player
+
+class Supply:
+    """The supply piles of a game. Non-empty piles are kept in buckets by
+    cost, together with a running count of empty piles, so the buy queries and
+    the end of game check never have to scan every pile. Supports the parts
+    of the dict interface used by display code; assigning a pile count keeps
+    the index up to date."""
+    def __init__(self, piles):
+        self.piles = {}
+        self.buckets = {}
+        self.costs = []
+        self.emptyPiles = 0
+        self.provinceEmpty = False
+        for cardName, count in piles.iteritems():
+            self[cardName] = count
+
+    def __getitem__(self, cardName):
+        return self.piles[cardName]
+
+    def __setitem__(self, cardName, count):
+        info = _cardInfo[cardName]
+        if cardName not in self.piles:
+            self.piles[cardName] = 0
+            self.emptyPiles += 1
+        before = self.piles[cardName]
+        self.piles[cardName] = count
+        if before > 0 and count <= 0:
+            self.buckets[info.cost].remove(info)
+            self.emptyPiles += 1
+        elif before <= 0 and count > 0:
+            bucket = self.buckets.get(info.cost)
+            if bucket is None:
+                bucket = self.buckets[info.cost] = []
+                self.costs.append(info.cost)
+                self.costs.sort()
+            bucket.append(info)
+            bucket.sort(key=lambda x: x.name)
+            self.emptyPiles -= 1
+        if cardName == "Province":
+            self.provinceEmpty = count <= 0
+
+    def __contains__(self, cardName):
+        return cardName in self.piles
+
+    def __iter__(self):
+        return iter(self.piles)
+
+    def __len__(self):
+        return len(self.piles)
+
+    def keys(self):
+        return self.piles.keys()
+
+    def iteritems(self):
+        return self.piles.iteritems()
+
+    def itervalues(self):
+        return self.piles.itervalues()
+
+    def take(self, cardName):
+        """Removes one card from the named pile. Returns False if the pile
+        was already empty"""
+        count = self.piles[cardName]
+        if count <= 0:
+            return False
+        if count == 1:
+            self[cardName] = 0
+        else:
+            self.piles[cardName] = count - 1
+        return True
+
+    def available(self, maxCost, klass=None):
+        """Returns the names of the non-empty piles costing at most maxCost,
+        optionally only those whose cards are of type klass"""
+        cards = []
+        for cost in self.costs:
+            if cost > maxCost:
+                break
+            for info in self.buckets[cost]:
+                if klass is None or issubclass(info.klass, klass):
+                    cards.append(info.name)
+        return cards
+
+    def isGameOver(self):
+        return self.provinceEmpty or self.emptyPiles >= 3
+
+    def copy(self):
+        supply = Supply({})
+        supply.piles = self.piles.copy()
+        supply.buckets = dict((cost, list(bucket)) for cost, bucket in self.buckets.iteritems())
+        supply.costs = list(self.costs)
+        supply.emptyPiles = self.emptyPiles
+        supply.provinceEmpty = self.provinceEmpty
+        return supply
+
+def _copyCard(card, owner):
+    clone = card.__class__.__new__(card.__class__)
+    clone.__dict__ = card.__dict__.copy()
+    clone.owner = owner
+    return clone
 
 class GameManager:
-    def __init__(self, players):
+    def __init__(self, players, seed=None):
         self.players = players
-        self.playerCycle = cycle(players)
-        self.currentPlayer = self.playerCycle.next()
+        for i, player in enumerate(players):
+            player.seat = i
+            player.game = self
+        self.currentPlayer = players[0]
         self.cardFactory = CardFactory()
         self.trash = []
 
+        # every game has its own random number generator, so a game is
+        # reproducible from its seed and the decisions of its players
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        self.events = EventBus()
+
+        # the top level action (play or buy) being resolved, if any
+        self.pendingAction = None
+        # log of top level actions and user service answers; None unless
+        # the game is being recorded (see replay.py)
+        self.decisions = None
+
     def setup(self, cards = None):
         for player in self.players:
             player.game = self
-            player.deck = [self.cardFactory.newCard(x) for x in Counter({"Estate" : 3, "Copper" : 7}).elements()]
-            #player.deck = [self.cardFactory.newCard(x) for x in ["Estate", "Copper", "Moat", "Witch", "Copper", "Gold", "Silver", "Militia"]]
-            for card in player.deck:
-                card.owner = player
-            player.drawdeck[:] = player.deck[:]
-            random.shuffle(player.drawdeck)
+            startingCards = Counter({"Estate" : 3, "Copper" : 7}).elements()
+            #startingCards = ["Estate", "Copper", "Moat", "Witch", "Copper", "Gold", "Silver", "Militia"]
+            for cardName in startingCards:
+                player.addToDeck(self.cardFactory.newCard(cardName))
+            drawdeck = list(player.deck)
+            self.random.shuffle(drawdeck)
+            player.drawdeck = DrawPile(drawdeck)
             player.draw(5)
 
         provinces = None
@@ -376,45 +941,52 @@ class GameManager:
                 "Curse": max((len(self.players)-1) * 10, 10)
                 }
 
+        self.randomKingdom = not cards
         if not cards:
-            cards = random.sample(_kingdomCardList, 10)
-        nonVictoryCardPiles = {key: 10 for key in [card for card in cards if not isinstance(self.cardFactory.newCard(card), Victory)]}
-        victoryCardPiles = {key: vpcards for key in [card for card in cards if isinstance(self.cardFactory.newCard(card), Victory)]}
-        self.supplyPile = dict(supplyPile.items() + nonVictoryCardPiles.items() + victoryCardPiles.items())
+            cards = self.random.sample(_kingdomCardList, 10)
+        self.kingdom = sorted(cards)
+        nonVictoryCardPiles = {key: 10 for key in [card for card in cards if not _cardInfo[card].isVictory]}
+        victoryCardPiles = {key: vpcards for key in [card for card in cards if _cardInfo[card].isVictory]}
+        self.supplyPile = Supply(dict(supplyPile.items() + nonVictoryCardPiles.items() + victoryCardPiles.items()))
 
         self.currentPlayer.turnphase = "ACTION"
 
     def getCardFromSupply(self, cardName):
-        assert cardName in self.supplyPile.keys() and self.supplyPile[cardName] > 0
-        card = self.cardFactory.newCard(cardName)
-        self.supplyPile[cardName] -= 1
-        return card
+        """Takes a card off the named supply pile. Returns None if the pile
+        is empty"""
+        assert cardName in self.supplyPile
+        if not self.supplyPile.take(cardName):
+            return None
+        return self.cardFactory.newCard(cardName)
 
     def getAvailableCardsToBuy(self, availableCoin):
-        cards = []
-        for cardName, remaining in self.supplyPile.iteritems():
-            if remaining > 0:
-                card = self.cardFactory.newCard(cardName)
-                if card.getCost() <= availableCoin:
-                    cards.append(cardName)
-        return cards
+        return self.supplyPile.available(availableCoin)
 
     def getAvailableCardOfType(self, klass, availableCoins):
-        cards = []
-        for cardName, remaining in self.supplyPile.iteritems():
-            if remaining > 0:
-                card = self.cardFactory.newCard(cardName)
-                if isinstance(card, klass) and card.getCost() <= availableCoins:
-                    cards.append(cardName)
-        return cards
+        return self.supplyPile.available(availableCoins, klass)
+
+    def startAction(self, kind, player, cardName, handIndex=None):
+        """Marks the start of a top level action, i.e. playing or buying a
+        card, and logs it if decisions are being recorded. handIndex is the
+        position of a played card in the hand"""
+        self.pendingAction = (kind, player.seat, cardName, handIndex)
+        if self.decisions is not None:
+            self.decisions.append(self.pendingAction)
+        if self.events.subscribers:
+            self.events.publish(ActionEvent(player, kind, cardName))
+
+    def endAction(self):
+        self.pendingAction = None
 
     def endTurn(self):
+        if self.decisions is not None:
+            self.decisions.append(("end", self.currentPlayer.seat, None, None))
         self.currentPlayer.cleanup()
-        self.currentPlayer = self.playerCycle.next()
+        self.currentPlayer = self.players[(self.currentPlayer.seat + 1) % len(self.players)]
         self.currentPlayer.turnphase = "ACTION"
         self.currentPlayer.turn += 1
 
-    @defer.inlineCallbacks
+    @maybeInlineCallbacks
     def doAttack(self, player):
         """Lets users perform reactions to attacks. Returns list of players who should
         be affected by the attack."""
@@ -427,27 +999,41 @@ class GameManager:
                         d = card.doReaction(player)
                         deferreds.append(d)
                         potentialImmunePlayers.append(otherPlayer)
-        result = yield defer.gatherResults(deferreds)
+        result = yield gatherResults(deferreds)
+        immunePlayers = [x for i, x in enumerate(potentialImmunePlayers) if result[i]]
         playersAffected = []
-        for i, otherPlayer in enumerate(potentialImmunePlayers):
-            if not result[i]:
-                playersAffected.append(otherPlayer)
         for otherPlayer in self.players:
-            if otherPlayer not in potentialImmunePlayers and otherPlayer != player:
+            if otherPlayer not in immunePlayers and otherPlayer != player:
                 playersAffected.append(otherPlayer)
+        if self.events.subscribers:
+            self.events.publish(AttackEvent(player, playersAffected, immunePlayers))
         defer.returnValue(playersAffected)
 
 
     def end(self):
-        if self.supplyPile["Province"] == 0:
-            return True
-        threePileEnding = 0
-        for remaining in self.supplyPile.itervalues():
-            if remaining == 0:
-                threePileEnding += 1
-                if threePileEnding >= 3:
-                    return True
-        return False
+        return self.supplyPile.isGameOver()
+
+    def clone(self):
+        """Returns an independent copy of the game state, e.g. to look ahead
+        from. Cards are copied with their instance state and keep sharing
+        their CardInfo. The copy continues with the same random sequence, has
+        a bus without subscribers, records no decisions and its players have
+        no user services: assign them before playing on. Only clone between
+        top level actions or at the start of one (see startAction), when no
+        card is on its way between two zones."""
+        game = copy.copy(self)
+        cards = {}
+        game.players = [x.clone(game, cards) for x in self.players]
+        game.currentPlayer = game.players[self.currentPlayer.seat]
+        game.trash = [_copyCard(x, None) for x in self.trash]
+        # skip seeding, which reads from the OS and is slower than the copy
+        game.random = random.Random.__new__(random.Random)
+        game.random.setstate(self.random.getstate())
+        game.events = EventBus()
+        game.decisions = None
+        if hasattr(self, "supplyPile"):
+            game.supplyPile = self.supplyPile.copy()
+        return game
 
     def getWinners(self):
         winners = []
@@ -458,12 +1044,12 @@ class GameManager:
                 winners[:] = []
                 winners.append(player)
                 highScore = player.score
-                lowerTurns = player.turn
+                lowestTurns = player.turn
             elif player.score == highScore and player.turn < lowestTurns:
                 winners[:] = []
                 winners.append(player)
                 highScore = player.score
-                lowerTurns = player.turn
+                lowestTurns = player.turn
             elif player.score == highScore and player.turn == lowestTurns:
                 winners.append(player)
 
@@ -0,0 +1,141 @@
+"""Deadlines for the prompts of the players. A player who lets a prompt's
+deadline pass, or whose client goes away, is answered for by a fallback, a
+bot from simulation, and so is every prompt after it until the client
+answers again. The game goes on either way."""
+
+from zope.interface import implements
+from zope.interface.verify import verifyClass
+from twisted.internet import defer, error
+from twisted.python import failure
+from twisted.spread import pb
+
+from core import *
+from simulation import BotUserService, BOTS
+from timerwheel import TimerWheel
+
+class DefaultActions(BotUserService):
+    """Plays all treasures, buys nothing, declines reactions and plays no
+    actions. Where a choice has to be made it gives up its least useful
+    cards and takes the most expensive ones."""
+
+    def chooseCardFromHand(self, klass=Card):
+        if klass in (Action, (Action, Treasure)):
+            return None
+        return BotUserService.chooseCardFromHand(self, klass)
+
+FALLBACKS = dict(BOTS, default=DefaultActions)
+
+# the failures of a call to a client that has gone away
+LOST = (pb.DeadReferenceError, pb.PBConnectionLost, error.ConnectionDone,
+        error.ConnectionLost)
+
+class DeadlineService:
+    """Wraps the IUserService of a player so that every prompt has seconds
+    to be answered before fallback answers it instead"""
+    implements(IUserService)
+
+    def __init__(self, service, fallback, seconds, wheel):
+        self.service = service
+        self.fallback = fallback
+        self.seconds = seconds
+        self.wheel = wheel
+        # whether the client missed a deadline and has not answered since
+        self.away = False
+        self.timeouts = 0
+
+    def __getattr__(self, name):
+        # everything but the prompts is the wrapped service's
+        return getattr(self.service, name)
+
+    def sendMessage(self, message):
+        self.service.sendMessage(message)
+
+    def noBuysRemain(self):
+        self.service.noBuysRemain()
+
+    def prompt(self, name, *args):
+        if self.away:
+            return getattr(self.fallback, name)(*args)
+        try:
+            result = getattr(self.service, name)(*args)
+        except LOST:
+            result = defer.fail()
+        if not isinstance(result, defer.Deferred):
+            return result
+        d = defer.Deferred()
+        if result.called:
+            # answered already, or the client was gone before it was asked
+            result.addBoth(self.answered, d, name, args, None)
+            return d
+        timeout = self.wheel.schedule(self.seconds, self.expired, d, name, args)
+        result.addBoth(self.answered, d, name, args, timeout)
+        return d
+
+    def answered(self, answer, d, name, args, timeout):
+        if timeout is None or timeout.active():
+            if timeout is not None:
+                timeout.cancel()
+            if isinstance(answer, failure.Failure) and answer.check(*LOST):
+                self.expired(d, name, args)
+            else:
+                d.callback(answer)
+        elif not isinstance(answer, failure.Failure):
+            # a late answer: the client is back for the next prompt
+            self.away = False
+
+    def expired(self, d, name, args):
+        self.away = True
+        self.timeouts += 1
+        try:
+            self.service.sendMessage("(Out of time, the choice was made for you.)")
+        except pb.DeadReferenceError:
+            pass
+        defer.maybeDeferred(getattr(self.fallback, name), *args).chainDeferred(d)
+
+    def chooseCardFromHand(self, klass=Card):
+        return self.prompt("chooseCardFromHand", klass)
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        if ignore is None:
+            return self.prompt("chooseCardsFromHand", klass, number)
+        return self.prompt("chooseCardsFromHand", klass, number, ignore)
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        return self.prompt("chooseCardFromSupply", klass, availableCoins)
+
+    def chooseCardForBuy(self):
+        return self.prompt("chooseCardForBuy")
+
+    def getCardInstance(self, validChoices, prompt=None):
+        if prompt is None:
+            return self.prompt("getCardInstance", validChoices)
+        return self.prompt("getCardInstance", validChoices, prompt)
+
+    def getCardNameByCost(self, validChoices):
+        return self.prompt("getCardNameByCost", validChoices)
+
+    def getYesNoChoice(self, question):
+        return self.prompt("getYesNoChoice", question)
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is None:
+            return self.prompt("getChoice", prompt)
+        return self.prompt("getChoice", prompt, minimum, maximum)
+
+    def chooseOption(self, options):
+        return self.prompt("chooseOption", options)
+
+verifyClass(IUserService, DeadlineService)
+
+class Deadlines:
+    """Puts deadlines of seconds on the prompts of the players of a server,
+    all kept in one TimerWheel. fallback names the bot answering for late
+    players, 'default' for DefaultActions or one of simulation.BOTS"""
+
+    def __init__(self, seconds, fallback="default", wheel=None):
+        self.seconds = seconds
+        self.fallback = FALLBACKS[fallback]
+        self.wheel = wheel if wheel is not None else TimerWheel()
+
+    def wrap(self, service, game, player):
+        return DeadlineService(service, self.fallback(game, player), self.seconds, self.wheel)
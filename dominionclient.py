@@ -1,4 +1,5 @@
 import sys
+from collections import deque
 
 from twisted.spread import pb
 from twisted.internet import reactor, stdio, defer
@@ -9,6 +10,7 @@ from twisted.python import log
 from zope.interface import implements
 
 from core import *
+from protocol import StateMirror, decodeDelta
 
 class DominionClient(basic.LineReceiver):
 
@@ -24,9 +26,8 @@ class DominionClient(basic.LineReceiver):
     def lineReceived(self, line):
         if not line: return
 
-        if self.perspective.captureNextLine:
-            self.perspective.captureNextLine.callback(line)
-            self.perspective.captureNextLine = None
+        if self.perspective.prompts:
+            self.perspective.answer(line)
             return
 
         self.perspective.sendLine(line)
@@ -47,8 +48,17 @@ class DominionClient(basic.LineReceiver):
 
 class DominionClientPerspective(pb.Referenceable):
 
-    def __init__(self):
-        self.captureNextLine = None
+    def __init__(self, structured=False, queue=None):
+        # (show, Deferred) of the prompts waiting for a line, the first one
+        # shown. The server may ask several at once
+        self.prompts = deque()
+        self.shown = False
+        self.structured = structured
+        # (size, kingdom, botsAllowed) to wait for a table of the matchmaker
+        # instead of joining #EA
+        self.queue = queue
+        self.game = None
+        self.mirror = StateMirror()
 
     def remote_print(self, message):
         #self.service.sendMessage(message)
@@ -56,11 +66,57 @@ class DominionClientPerspective(pb.Referenceable):
 
     def remote_getChoice(self, message):
         #self.service.sendMessage(message)
-        print message
+        def show():
+            print message
+        return self.ask(show)
+
+    def remote_update(self, data):
+        for message in self.mirror.apply(decodeDelta(data)):
+            print message
+
+    def remote_choose(self, data):
+        delta = decodeDelta(data)
+        for message in self.mirror.apply(delta):
+            print message
+        return self.choose(*delta["choice"])
+
+    def choose(self, kind, prompt, options, minimum, maximum):
+        def show():
+            if kind == "menu":
+                print self.mirror.renderHand()
+            print self.mirror.renderChoice(kind, prompt, options, minimum, maximum)
+        d = self.ask(show)
+        def answered(line):
+            # the hand and the game area are shown without asking the server
+            if kind == "menu" and line.strip() in ("4", "5"):
+                if line.strip() == "4":
+                    print self.mirror.renderHand()
+                else:
+                    print self.mirror.renderGameArea()
+                return self.choose(kind, prompt, options, minimum, maximum)
+            return self.mirror.parseAnswer(kind, options, minimum, maximum, line)
+        return d.addCallback(answered)
+
+    def ask(self, show):
+        """Returns a Deferred firing with the line typed in answer to the
+        prompt show prints. Prompts asked while another one is waiting are
+        shown once the ones before them are answered"""
         d = defer.Deferred()
-        self.captureNextLine = d
+        self.prompts.append((show, d))
+        self.showNext()
         return d
 
+    def answer(self, line):
+        show, d = self.prompts.popleft()
+        self.shown = False
+        d.callback(line)
+        self.showNext()
+
+    def showNext(self):
+        if self.prompts and not self.shown:
+            self.shown = True
+            self.prompts[0][0]()
+
     def connect(self, user, password):
         factory = pb.PBClientFactory()
         reactor.connectTCP("localhost", 8800, factory)
@@ -69,17 +125,32 @@ class DominionClientPerspective(pb.Referenceable):
         reactor.run()
 
     def connected(self, perspective):
-        print "connected, joining game #EA"
         self.perspective = perspective
-        d = perspective.callRemote("joinGame", "#EA")
+        if self.queue is not None:
+            size, kingdom, botsAllowed = self.queue
+            print "connected, waiting for a table of %d" % size
+            d = perspective.callRemote("enqueue", size, kingdom, botsAllowed, self.structured)
+            d.addCallback(self.seated)
+            d.addErrback(self.failed)
+            return
+        print "connected, joining game #EA"
+        d = perspective.callRemote("joinGame", "#EA", self.structured)
         d.addCallback(self.gotgame)
 
+    def seated(self, gameId):
+        print "seated at %s" % gameId
+
+    def failed(self, reason):
+        print reason.getErrorMessage()
+        reactor.stop()
+
     def gotgame(self, game):
         print "joined game"
         self.game = game
 
     def sendLine(self, message):
-        d = self.game.callRemote("send", message)
+        if self.game is not None:
+            d = self.game.callRemote("send", message)
 
     def shutdown(self, result):
         reactor.stop()
@@ -87,7 +158,13 @@ class DominionClientPerspective(pb.Referenceable):
 def main():
     argv = sys.argv
 
-    clientPerspective = DominionClientPerspective()
+    # USER PASSWORD [--structured] [--queue SIZE [--bots] [--kingdom CARD,CARD,...]]
+    queue = None
+    if "--queue" in argv[3:]:
+        size = int(argv[argv.index("--queue") + 1])
+        kingdom = argv[argv.index("--kingdom") + 1].split(",") if "--kingdom" in argv[3:] else None
+        queue = (size, kingdom, "--bots" in argv[3:])
+    clientPerspective = DominionClientPerspective("--structured" in argv[3:], queue)
     client = DominionClient(clientPerspective)
     stdio.StandardIO(client)
     clientPerspective.connect(argv[1], argv[2])
@@ -1,33 +1,81 @@
-from sys import stdout
+import os
+from sys import stdout, executable
+from optparse import OptionParser, SUPPRESS_HELP
 
 from zope.interface import implements
 from zope.interface.verify import verifyClass
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
-from twisted.python.log import startLogging
+from twisted.python.log import startLogging, msg, err
 from twisted.cred.checkers import ANONYMOUS, AllowAnonymousAccess
 from twisted.cred.checkers import InMemoryUsernamePasswordDatabaseDontUse
 from twisted.cred.portal import IRealm, Portal
 from twisted.internet import reactor, defer
-from twisted.spread.pb import Avatar, Viewable, IPerspective, PBServerFactory
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.spread.pb import Avatar, Viewable, IPerspective, PBServerFactory, PBClientFactory
+from twisted.spread.pb import Referenceable, Root, ViewPoint, DeadReferenceError, Error
 
 from core import *
 from base import *
+import profiling
+import metrics
+from outbox import Outbox, DEFAULT_FLUSH_DELAY, MAX_OUTSTANDING, MAX_QUEUED_BYTES
+from deadlines import Deadlines, FALLBACKS, LOST
+from simulation import BOTS
+from replay import recordGame, getRecord
+from records import GameRecordWriter
+from matchmaking import Matchmaker, DEFAULT_MAX_WAIT, TABLE_PREFIX
+import protocol
+
+# seconds a game may go without a turn before it is dropped
+IDLE_TIMEOUT = 30 * 60.0
+# seconds between looks for idle games
+REAP_INTERVAL = 60.0
+# avatars kept for named users while they are logged out
+MAX_DETACHED = 1000
 
 class OptionCancelled(Exception):
     pass
 
+class ClientGone(Error):
+    """What a shard worker hears when the client it calls through the
+    front is gone"""
+
+# the failures of a call to a client that has gone away, in a worker too
+LOST = LOST + (ClientGone,)
+
 class CLIUserService:
     implements(IUserService)
 
-    def __init__(self, game, remoteUser, player):
+    # whether the client keeps its own copy of the game state, see protocol
+    structured = False
+
+    def __init__(self, game, remoteUser, player, metrics=None, stats=None,
+                 flushDelay=DEFAULT_FLUSH_DELAY):
         self.game = game
         self.remoteUser = remoteUser
         self.player = player
+        self.metrics = metrics
+        self.stats = stats
+        self.outbox = Outbox(self._callRemote, flushDelay)
+
+    def callRemote(self, method, *args):
+        """Every call to the client goes through here. Printed messages are
+        coalesced by the outbox and return nothing"""
+        if method == "print":
+            self.outbox.add(*args)
+            return None
+        return self.outbox.call(method, *args)
+
+    def _callRemote(self, method, *args):
+        if self.metrics is None:
+            return self.remoteUser.callRemote(method, *args)
+        return self.metrics.track(self.stats, method, self.remoteUser.callRemote, *args)
 
     def sendMessage(self, message):
         #print message
-        self.remoteUser.callRemote("print", message)
+        self.callRemote("print", message)
 
     @defer.inlineCallbacks
     def chooseCardFromHand(self, klass=Card):
@@ -65,13 +113,13 @@ class CLIUserService:
         defer.returnValue(choice)
 
     @defer.inlineCallbacks
-    def getCardInstance(self, validChoices):
+    def getCardInstance(self, validChoices, prompt=None):
         if not validChoices:
             defer.returnValue(None)
-        prompt = ""
+        prompt = prompt + "\n" if prompt else ""
         for i, card in enumerate(validChoices):
             prompt += "%d: %s" % (i+1, repr(card)) + "\n"
-        choice = yield self.remoteUser.callRemote("getChoice", prompt)
+        choice = yield self.callRemote("getChoice", prompt)
         if choice == "c" or int(choice)-1 < 0 or int(choice)-1 >= len(validChoices):
             #defer.returnValue(None)
             raise OptionCancelled()
@@ -79,70 +127,450 @@ class CLIUserService:
 
     @defer.inlineCallbacks
     def getCardNameByCost(self, validChoices):
-        cardList = []
-        for choice in validChoices:
-            cardList.append(self.game.cardFactory.newCard(choice))
-        cardList = sorted(cardList, key=lambda x: x.cost, reverse=True)
+        cardFactory = self.game.cardFactory
+        cardList = [cardFactory.getCardInfo(x) for x in validChoices]
+        cardList.sort(key=lambda x: x.cost, reverse=True)
         prompt = ""
-        for i, card in enumerate(cardList):
-            prompt += "%d: (%d) %s" % (i+1, card.cost, repr(card)) + "\n"
-        choice = yield self.remoteUser.callRemote("getChoice", prompt)
+        for i, info in enumerate(cardList):
+            prompt += "%d: (%d) %s" % (i+1, info.cost, info.displayName) + "\n"
+        choice = yield self.callRemote("getChoice", prompt)
         if choice == "c" or int(choice)-1 < 0 or int(choice)-1 >= len(validChoices):
             raise OptionCancelled()
-        defer.returnValue(cardList[int(choice)-1].__name__())
+        defer.returnValue(cardList[int(choice)-1].name)
 
     @defer.inlineCallbacks
     def getYesNoChoice(self, question):
         prompt = question + "\n1: No\n2: Yes"
-        choice = yield self.remoteUser.callRemote("getChoice", prompt)
+        choice = yield self.callRemote("getChoice", prompt)
         if choice == "2":
             defer.returnValue(True)
         else:
             defer.returnValue(False)
 
     @defer.inlineCallbacks
-    def getChoice(self, prompt):
-        choice = yield self.remoteUser.callRemote("getChoice", prompt)
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is not None:
+            prompt = "%s (min %d, max %d)" % (prompt, minimum, maximum)
+        choice = yield self.callRemote("getChoice", prompt)
         if choice == "c":
             raise OptionCancelled()
         defer.returnValue(choice)
 
+    def chooseOption(self, options):
+        """Asks for one of the menu options, given as (key, label)"""
+        prompt = ""
+        for key, label in options:
+            prompt += "%s: %s" % (key, label) + "\n"
+        return self.getChoice(prompt)
+
     def noBuysRemain(self):
         self.game.endTurn()
 
 verifyClass(IUserService, CLIUserService)
 
+class StructuredUserService(CLIUserService):
+    """Talks to clients using the structured protocol: instead of rendered
+    text they get the changes to their view of the game and choice requests
+    listing card ids, and render both themselves"""
+
+    structured = True
+
+    def __init__(self, game, remoteUser, player, metrics=None, stats=None,
+                 flushDelay=DEFAULT_FLUSH_DELAY):
+        CLIUserService.__init__(self, game, remoteUser, player, metrics, stats, flushDelay)
+        self.view = protocol.PlayerView(game, player)
+        self.outbox = protocol.StateOutbox(self._callRemote, self.view, flushDelay)
+
+    def choose(self, kind, prompt, options, minimum=1, maximum=1):
+        return self.callRemote("choose", kind, prompt, options, minimum, maximum)
+
+    @defer.inlineCallbacks
+    def chooseCardsFromHand(self, klass, number):
+        validChoices = [val for val in self.player.hand if isinstance(val, klass)]
+        number = min(number, len(validChoices))
+        if number <= 0:
+            defer.returnValue([])
+        options = sorted(set([x.info.id for x in validChoices]))
+        answer = yield self.choose("hand", None, options, number, number)
+        if not isinstance(answer, list) or len(answer) != number:
+            raise OptionCancelled()
+        choices = []
+        for id in answer:
+            card = self._findCard(validChoices, id)
+            validChoices.remove(card)
+            choices.append(card)
+        defer.returnValue(choices)
+
+    @defer.inlineCallbacks
+    def getCardInstance(self, validChoices, prompt=None):
+        if not validChoices:
+            defer.returnValue(None)
+        options = sorted(set([x.info.id for x in validChoices]))
+        answer = yield self.choose("hand", prompt, options)
+        defer.returnValue(self._findCard(validChoices, answer))
+
+    @defer.inlineCallbacks
+    def getCardNameByCost(self, validChoices):
+        cardFactory = self.game.cardFactory
+        infos = dict((cardFactory.getCardInfo(x).id, x) for x in validChoices)
+        answer = yield self.choose("supply", None, sorted(infos))
+        if answer not in infos:
+            raise OptionCancelled()
+        defer.returnValue(infos[answer])
+
+    @defer.inlineCallbacks
+    def getYesNoChoice(self, question):
+        answer = yield self.choose("yesno", question, [])
+        defer.returnValue(answer is True)
+
+    @defer.inlineCallbacks
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is None:
+            answer = yield self.choose("text", prompt, [])
+            if not isinstance(answer, basestring):
+                raise OptionCancelled()
+            defer.returnValue(answer)
+        answer = yield self.choose("count", prompt, [], minimum, maximum)
+        if not isinstance(answer, int) or not minimum <= answer <= maximum:
+            raise OptionCancelled()
+        defer.returnValue(answer)
+
+    def chooseOption(self, options):
+        # the labels go out once, as part of the state
+        self.view.menu = dict(options)
+        return self.choose("menu", None, None)
+
+    def _findCard(self, validChoices, id):
+        for card in validChoices:
+            if card.info.id == id:
+                return card
+        raise OptionCancelled()
+
+verifyClass(IUserService, StructuredUserService)
+
 class DominionServer:
     def __init__(self):
         self.games = {}
+        self.metrics = None
+        self.flushDelay = DEFAULT_FLUSH_DELAY
+        # a Deadlines for the prompts, if they have any
+        self.deadlines = None
+        # a records.GameRecordWriter the finished games are written to
+        self.archive = None
+        self.idleTimeout = IDLE_TIMEOUT
+        # called with each game that is dropped
+        self.onRetire = None
+        self.archived = 0
+        self.reaped = 0
+        # the bot taking the empty seats at tables of the matchmaker
+        self.bot = BOTS["bigmoney"]
+        self.matchmaker = Matchmaker(self.startTable)
+
+    def joinGame(self, gameId, user):
+        game = self.games.get(gameId)
+        if game is None:
+            game = self.newGame(gameId)
+        game.addUser(user)
+        return game
+
+    def startTable(self, gameId, users, cards, bots):
+        """Starts a game of users and bots bots, made by the matchmaker"""
+        game = self.newGame(gameId, size=len(users) + bots, cards=cards, bots=[self.bot] * bots)
+        for user in users:
+            game.addUser(user)
+
+    def newGame(self, gameId, **kwargs):
+        if gameId in self.games:
+            raise ValueError("there is a game %s already" % gameId)
+        game = self.games[gameId] = Game(gameId, self.metrics, self.flushDelay,
+                self.deadlines, self.archive is not None, **kwargs)
+        game.done.addCallback(self.retire)
+        return game
+
+    def retire(self, game):
+        """Archives a game that is over and drops it"""
+        if self.games.get(game.name) is not game:
+            # reaped before it got here
+            return
+        if self.archive is not None:
+            self.archive.write(getRecord(game.gameManager))
+            self.archived += 1
+        self.drop(game)
+
+    def reap(self):
+        """Drops the games that have gone without a turn for idleTimeout
+        seconds: ones that never started, lost their players or wait for
+        prompts nobody answers"""
+        now = reactor.seconds()
+        for game in self.games.values():
+            if now - game.lastActive > self.idleTimeout:
+                self.reaped += 1
+                self.drop(game)
+        if self.archive is not None:
+            self.archive.flush()
+
+    def seated(self, user):
+        """Whether user has a seat in a game that is not over"""
+        player = user.player
+        if player is None:
+            return False
+        # the game manager is there once the game has started
+        game = getattr(player, "game", None)
+        return game is None or not game.end()
+
+    def drop(self, game):
+        del self.games[game.name]
+        game.stopped = True
+        for user, player in game.users.iteritems():
+            # the avatar would keep the whole game alive
+            if user.player is player:
+                user.player = None
+        if self.metrics is not None:
+            self.metrics.forget(game.name)
+        if self.onRetire is not None:
+            self.onRetire(game)
+
+class ShardedServer(Referenceable):
+    """Stands in for the DominionServer in the front process when games run
+    in shard workers. Each game lives in one worker, the one with the fewest
+    games when it was created; the players' calls are passed on to it and
+    the game's calls to the players come back through a ClientRelay. The
+    workers tell it when a game is dropped."""
+
+    def __init__(self, shards):
+        # RemoteReferences to the WorkerRoot of each worker
+        self.shards = shards
+        self.load = [0] * len(shards)
+        self.games = {}
+        # the ids of the games each player name has a seat in
+        self.seats = defaultdict(set)
+        self.matchmaker = Matchmaker(self.startTable)
+
+    def shardOf(self, gameId):
+        shard = self.games.get(gameId)
+        if shard is None:
+            shard = self.load.index(min(self.load))
+            self.games[gameId] = shard
+            self.load[shard] += 1
+        return shard
+
+    def relayOf(self, user):
+        if user.relay is None:
+            user.relay = ClientRelay(user)
+        return user.relay
 
     def joinGame(self, gameId, user):
-        if not self.games.has_key(gameId):
-            self.games[gameId] = Game(gameId)
-        self.games[gameId].addUser(user)
-        return self.games[gameId]
+        shard = self.shardOf(gameId)
+        self.seats[user.name].add(gameId)
+        d = self.shards[shard].callRemote("joinGame", gameId, user.name,
+                self.relayOf(user), user.structured)
+        return d.addCallback(self.joined, shard)
+
+    def startTable(self, gameId, users, cards, bots):
+        shard = self.shardOf(gameId)
+        players = [(x.name, self.relayOf(x), x.structured) for x in users]
+        for user in users:
+            self.seats[user.name].add(gameId)
+        d = self.shards[shard].callRemote("startTable", gameId, players, cards, bots)
+        d.addCallback(self.loaded, shard)
+        d.addErrback(err, "table %s did not start" % gameId)
+
+    def joined(self, result, shard):
+        """Returns what the client sees of the game, like the Game a
+        DominionServer returns"""
+        load, view = result
+        self.loaded(load, shard)
+        return GameRelay(view)
+
+    def loaded(self, load, shard):
+        # the worker knows best how many games it still runs
+        self.load[shard] = load
+
+    def seated(self, user):
+        """Whether user has a seat in a game that is not over"""
+        return bool(self.seats.get(user.name))
+
+    def remote_gameOver(self, gameId, load, names):
+        """Hears from a worker that the game gameId, of the players names,
+        is dropped"""
+        shard = self.games.pop(gameId, None)
+        if shard is not None:
+            self.load[shard] = load
+        for name in names:
+            gameIds = self.seats.get(name)
+            if gameIds is not None:
+                gameIds.discard(gameId)
+                if not gameIds:
+                    del self.seats[name]
+
+class ClientRelay(Referenceable):
+    """Passes the calls a game in a shard worker makes to a player on to the
+    player's client"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def relay(self, method, *args):
+        # an Error is passed on to the worker without logging a traceback
+        if self.user.remote is None:
+            raise ClientGone("Calling Stale Broker")
+        try:
+            d = self.user.remote.callRemote(method, *args)
+        except DeadReferenceError:
+            raise ClientGone("Calling Stale Broker")
+        return d.addErrback(self.lost)
+
+    def lost(self, failure):
+        failure.trap(*LOST)
+        raise ClientGone(failure.getErrorMessage())
+
+    def remote_print(self, message):
+        return self.relay("print", message)
+
+    def remote_getChoice(self, prompt):
+        return self.relay("getChoice", prompt)
+
+    def remote_update(self, data):
+        return self.relay("update", data)
+
+    def remote_choose(self, data):
+        return self.relay("choose", data)
+
+class GameRelay(Referenceable):
+    """Passes the calls a client makes to its game on to the game in the
+    shard worker, where they come from the player's ShardUser"""
+
+    def __init__(self, view):
+        # a RemoteReference to the worker's ViewPoint of the game
+        self.view = view
+
+    def remote_hand(self):
+        return self.view.callRemote("hand")
+
+class RelayedClient:
+    """The client of a ShardUser, called through its ClientRelay. Failures
+    of a client that is gone come out as DeadReferenceError, as they would
+    for a client of this process"""
+
+    def __init__(self, relay):
+        self.relay = relay
 
+    def callRemote(self, method, *args):
+        return self.relay.callRemote(method, *args).addErrback(self.lost)
+
+    def lost(self, failure):
+        if failure.check(*LOST):
+            raise DeadReferenceError(failure.getErrorMessage())
+        return failure
+
+class ShardUser:
+    """A player as seen by a shard worker: the client is reached through the
+    ClientRelay of the front process"""
+
+    def __init__(self, name):
+        self.name = name
+        self.remote = None
+        self.structured = False
+
+class WorkerRoot(Root):
+    """What the front process sees of a shard worker"""
+
+    def __init__(self, server):
+        self.server = server
+        self.users = {}
+        self.front = None
+
+    def remote_attach(self, front):
+        """Makes front, the ShardedServer, hear of the games dropped"""
+        self.front = front
+        self.server.onRetire = self.gameOver
+
+    def gameOver(self, game):
+        games = self.server.games.values()
+        for user in game.users:
+            if not [x for x in games if user in x.users]:
+                self.users.pop(user.name, None)
+        self.front.callRemote("gameOver", game.name, self.load(),
+                [x.name for x in game.users])
+
+    def load(self):
+        return len([x for x in self.server.games.itervalues() if not x.finished])
+
+    def remote_joinGame(self, gameId, name, relay, structured):
+        """Adds the player name to the game gameId. Returns the number of
+        games in the worker that are not finished and the player's view of
+        the game"""
+        user = self.user(name, relay, structured)
+        game = self.server.joinGame(gameId, user)
+        return self.load(), ViewPoint(user, game)
+
+    def remote_startTable(self, gameId, players, cards, bots):
+        """Starts a game made by the matchmaker of the front, players given
+        as (name, relay, structured). Returns the number of games in the
+        worker that are not finished"""
+        users = [self.user(*x) for x in players]
+        self.server.startTable(gameId, users, cards, bots)
+        return self.load()
+
+    def user(self, name, relay, structured):
+        # calls to the front are small and mostly wait for the one before
+        relay.broker.transport.setTcpNoDelay(True)
+        if name not in self.users:
+            self.users[name] = ShardUser(name)
+        user = self.users[name]
+        user.remote = RelayedClient(relay)
+        user.structured = bool(structured)
+        return user
 
 class DominionRealm(object):
     implements(IRealm)
 
-    def __init__(self):
+    def __init__(self, maxDetached=MAX_DETACHED):
         self.anoncount = 0
         self.avatars = {}
+        # the avatars of named users who logged out, least recently first
+        self.detached = OrderedDict()
+        self.maxDetached = maxDetached
+        # the DominionServer or ShardedServer, set once it is up
+        self.server = None
 
     def requestAvatar(self, avatarId, mind, *interfaces):
         assert IPerspective in interfaces
-        if avatarId is ANONYMOUS:
+        anonymous = avatarId is ANONYMOUS
+        if anonymous:
             avatarId = "Anonymous%s" % str(self.anoncount)
             self.anoncount +=1 
         if not self.avatars.has_key(avatarId):
             avatar = User(avatarId)
+            avatar.anonymous = anonymous
             self.avatars[avatarId] = avatar
             avatar.server = self.server
         else:
             avatar = self.avatars[avatarId]
+            self.detached.pop(avatarId, None)
         avatar.attached(mind)
-        return IPerspective, avatar, lambda a=avatar:a.detached(mind)
+        return IPerspective, avatar, lambda a=avatar:self.logout(a, mind)
+
+    def logout(self, avatar, mind):
+        avatar.detached(mind)
+        self.server.matchmaker.leave(avatar)
+        if avatar.anonymous:
+            # every anonymous login gets a new name, this one is not coming back
+            self.avatars.pop(avatar.name, None)
+            return
+        self.detached[avatar.name] = avatar
+        excess = len(self.detached) - self.maxDetached
+        if excess <= 0:
+            return
+        for name, avatar in self.detached.items():
+            if excess <= 0:
+                break
+            if self.server.seated(avatar):
+                # the player may yet come back to the game
+                continue
+            del self.detached[name]
+            del self.avatars[name]
+            excess -= 1
 
 class User(Avatar):
     """
@@ -153,19 +581,57 @@ class User(Avatar):
     """
     def __init__(self, name):
         self.name = name
+        self.structured = False
+        self.relay = None
+        self.anonymous = False
+        self.player = None
     def attached(self, mind):
         self.remote = mind
     def detached(self, mind):
         self.remote = None
-    def perspective_joinGame(self, gameId):
+    def perspective_joinGame(self, gameId, structured=False):
+        """Joins the game gameId. Structured clients are sent state changes
+        and choice requests instead of text, see protocol"""
+        if gameId.startswith(TABLE_PREFIX):
+            raise Error("game ids starting with %s are the matchmaker's" % TABLE_PREFIX)
+        self.structured = bool(structured)
         return self.server.joinGame(gameId, self)
+    def perspective_enqueue(self, size=2, kingdom=None, botsAllowed=False, structured=False):
+        """Waits for a table of size players, 2 to 6, playing with the
+        kingdom cards or a random kingdom, with bots in the empty seats if
+        botsAllowed and nobody comes. Returns the id of the game"""
+        self.structured = bool(structured)
+        try:
+            return self.server.matchmaker.enqueue(self, size, kingdom, botsAllowed)
+        except ValueError, e:
+            # the client asked for a table there cannot be
+            raise Error(str(e))
 
 class Game(Viewable):
-    def __init__(self, gameId):
+    def __init__(self, gameId, metrics=None, flushDelay=DEFAULT_FLUSH_DELAY, deadlines=None,
+                 record=False, size=2, cards=None, bots=()):
         self.name = gameId
         self.users = {}
         self.players = []
+        # the game starts once size players are seated, users and bots, the
+        # latter given as the IUserService classes playing them
+        self.size = size
+        self.cards = cards
+        self.bots = list(bots)
         self.inProgress = False
+        self.finished = False
+        self.metrics = metrics
+        self.flushDelay = flushDelay
+        self.deadlines = deadlines
+        # whether the decisions are logged, so the game can be archived
+        self.record = record
+        self.lastActive = reactor.seconds()
+        # whether every user is away, the fallbacks playing for them all
+        self.away = False
+        # set when the server drops the game, which ends its loop
+        self.stopped = False
+        # fires with the game once it is over
+        self.done = defer.Deferred()
 
     def addUser(self, user):
         if user not in self.users and not self.inProgress:
@@ -174,7 +640,7 @@ class Game(Viewable):
             self.users[user] = player
             self.players.append(player)
 
-        if len(self.users) == 2 and not self.inProgress:
+        if len(self.users) + len(self.bots) >= self.size and not self.inProgress:
             self.startGame()
             self.inProgress = True
 
@@ -186,18 +652,30 @@ class Game(Viewable):
         pass
 
     def startGame(self):
+        botPlayers = [Player("Bot%d" % (i+1)) for i in xrange(len(self.bots))]
+        self.players.extend(botPlayers)
         self.gameManager = GameManager(self.players)
+        for botClass, player in zip(self.bots, botPlayers):
+            player.userService = botClass(self.gameManager, player)
 
+        stats = self.metrics.gameStats(self.name) if self.metrics else None
         for user, player in self.users.iteritems():
-            player.userService = CLIUserService(self.gameManager, user.remote, player)
+            serviceClass = StructuredUserService if user.structured else CLIUserService
+            player.userService = serviceClass(self.gameManager, user.remote, player,
+                    self.metrics, stats, self.flushDelay)
+            if self.deadlines is not None:
+                player.userService = self.deadlines.wrap(player.userService, self.gameManager, player)
+        if self.record:
+            recordGame(self.gameManager)
 
-        self.gameManager.setup()
+        self.log = TextLog(self.gameManager.events)
+        self.gameManager.setup(self.cards and list(self.cards))
 
         self.menu = Menu(self)
 
         turnOrder = "Turn order will be "
         turnOrder += ' then '.join(["%s" % x for x in self.players]) + "\n"
-        turnOrder += "Game: %s" % ', '.join(sorted([x for x in self.gameManager.supplyPile.keys() if self.gameManager.cardFactory.newCard(x).__module__ != 'core']))
+        turnOrder += "Game: %s" % ', '.join(sorted([x for x in self.gameManager.supplyPile.keys() if self.gameManager.cardFactory.getCardInfo(x).kingdom]))
         self.sendToAll(turnOrder)
 
         self.gameLoop()
@@ -206,19 +684,51 @@ class Game(Viewable):
     def gameLoop(self):
         prevPlayer = None
         while not self.gameManager.end():
+            if self.stopped:
+                return
+            if self.abandoned():
+                # the fallbacks play on, at the pace of the deadlines rather
+                # than as fast as they answer. Turns nobody is there for
+                # don't count as activity, so the reaper drops the game if
+                # nobody comes back
+                if not self.away:
+                    self.away = True
+                    self.sendToAll("(Everybody is away, the game goes on with the choices made for you.)")
+                yield deferLater(reactor, self.deadlines.seconds, lambda: None)
+            else:
+                self.away = False
+                self.lastActive = reactor.seconds()
             player = self.gameManager.currentPlayer
             if prevPlayer != player:
-                self.sendToAll("\n------------------\n\n%s's turn!\nTurn: %d" % (player, player.turn))
+                if self.metrics:
+                    self.metrics.turnStarted()
+                self.sendToAll(protocol.turnBanner(player.name, player.turn), derived=True)
                 prevPlayer = player
 
             self.menu.showHand(player)
-            yield self.menu.handle_options(player)
-
+            try:
+                yield self.menu.handle_options(player)
+            except LOST:
+                # without deadlines nobody answers for a player who left.
+                # The game stays as it is until the reaper drops it
+                msg("game %s stopped, %s is gone" % (self.name, player.name))
+                return
+
+        self.finished = True
         self.menu.showSummary()
+        self.done.callback(self)
 
-    def sendToAll(self, message):
+    def abandoned(self):
+        """Whether every user has missed a prompt's deadline and not come
+        back since"""
+        return all([getattr(x.userService, "away", False) for x in self.users.itervalues()])
+
+    def sendToAll(self, message, derived=False):
+        """Sends message to every player. Derived messages only tell what
+        structured clients can see from their state and are not sent to them"""
         for player in self.players:
-            player.userService.sendMessage(message)
+            if not (derived and player.userService.structured):
+                player.userService.sendMessage(message)
 
 class Menu:
     def __init__(self, game):
@@ -233,11 +743,9 @@ class Menu:
     @defer.inlineCallbacks
     def handle_options(self, player):
         option = "-1"
+        options = [(key, self._options[key].__doc__) for key in sorted(self._options.iterkeys())]
         while option not in self._options:
-            prompt = ""
-            for key in sorted(self._options.iterkeys()):
-                prompt += "%s: %s" % (key, self._options[key].__doc__) + "\n"
-            option = yield player.userService.getChoice(prompt)
+            option = yield player.userService.chooseOption(options)
 
         try:
             yield self._options[option](player)
@@ -250,38 +758,45 @@ class Menu:
     def playCard(self, player):
         """Play card"""
         card = yield player.userService.chooseCardFromHand((Action, Treasure))
+        if card is None:
+            return
         self.game.sendToAll("%s plays a %s." % (player, repr(card)))
         played = yield player.play(card)
         if played:
             #self.game.sendToAll("%s played %s" % (player, repr(card)))
-            self.game.sendToAll(player.flushLog())
+            self.game.sendToAll(self.game.log.flush())
         else:
-            player.flushLog()
+            self.game.log.flush()
 
     def playTreasures(self, player):
         """Play all treasure cards"""
         cardsPlayed = defaultdict(int)
-        hand = player.hand[:]
+        hand = list(player.hand)
         for card in hand:
             if isinstance(card, Treasure):
                 cardsPlayed[repr(card)] += 1
                 player.play(card)
         message = "%s plays %s." % (player, ', '.join(["%d %ss" % (x, y) for y, x in cardsPlayed.iteritems()]))
         self.game.sendToAll(message)
-        #self.game.sendToAll(player.flushLog())
-        player.flushLog()
+        #self.game.sendToAll(self.game.log.flush())
+        self.game.log.flush()
 
     @defer.inlineCallbacks
     def buyCard(self, player):
         """Buy card"""
         cardName = yield player.userService.chooseCardForBuy()
+        if cardName is None:
+            return
         bought = yield player.buy(cardName)
-        self.game.sendToAll(player.flushLog())
+        self.game.sendToAll(self.game.log.flush())
         #if bought:
             #self.game.sendToAll("%s buys a %s" % (player, repr(self.game.gameManager.cardFactory.newCard(cardName))))
 
     def showHand(self, player):
         """Show hand"""
+        if player.userService.structured:
+            # the client shows it from its own copy of the state
+            return
         cardCount = defaultdict(int)
         for card in player.hand:
             cardCount[repr(card)] += 1
@@ -295,6 +810,8 @@ class Menu:
 
     def showGameArea(self, player):
         """Show game area"""
+        if player.userService.structured:
+            return
         message = ""
         for card, remaining in self.game.gameManager.supplyPile.iteritems():
             message += "%s: %d" % (card, remaining) + "\n"
@@ -310,13 +827,13 @@ class Menu:
     def endTurn(self, player):
         """End turn"""
         self.game.gameManager.endTurn()
-        self.game.sendToAll(player.flushLog())
+        self.game.sendToAll(self.game.log.flush())
 
     def showSummary(self):
         winners = self.game.gameManager.getWinners()
         message = "\n"
         if len(winners) > 1:
-            message += "Game is a tie between %s!" % (' and '.join([x for x in winners]))
+            message += "Game is a tie between %s!" % (' and '.join([x.name for x in winners]))
         else:
             message += "%s wins!" % winners[0] + "\n"
         for player in self.game.gameManager.players:
@@ -329,11 +846,132 @@ class Menu:
             message += "\n"
         self.game.sendToAll(message)
 
+class ShardProcess(ProcessProtocol):
+    def __init__(self, port):
+        self.port = port
+
+    def processEnded(self, reason):
+        msg("shard worker on port %d ended: %s" % (self.port, reason.getErrorMessage()))
+
+def startShards(options):
+    """Starts options.shards worker processes, listening on local ports from
+    options.shard_port on. Returns a Deferred firing with the RemoteReferences
+    of their WorkerRoots once they all accept connections"""
+    ports = range(options.shard_port, options.shard_port + options.shards)
+    for i, port in enumerate(ports):
+        args = [executable, os.path.abspath(__file__), "--worker", str(port),
+                "--flush-delay", repr(options.flush_delay),
+                "--max-outstanding", str(options.max_outstanding),
+                "--max-queued-bytes", str(options.max_queued_bytes),
+                "--on-timeout", options.on_timeout]
+        if options.prompt_deadline:
+            args += ["--prompt-deadline", repr(options.prompt_deadline)]
+        if options.archive:
+            args += ["--archive", "%s.%d" % (options.archive, i)]
+        args += ["--idle-timeout", repr(options.idle_timeout), "--table-bot", options.table_bot]
+        if options.profile:
+            args += ["--profile", "%s.%d" % (options.profile, i)]
+        if options.metrics_port:
+            args += ["--metrics-port", str(options.metrics_port + i + 1)]
+        reactor.spawnProcess(ShardProcess(port), executable, args, env=os.environ,
+                childFDs={1: 1, 2: 2})
+    return defer.gatherResults([connectShard(port) for port in ports])
+
+def connectShard(port, attempts=100):
+    """Connects to the shard worker on port, trying again while it starts"""
+    factory = PBClientFactory()
+    reactor.connectTCP("127.0.0.1", port, factory)
+    d = factory.getRootObject()
+    def connected(root):
+        # as for the worker's end, see WorkerRoot.remote_joinGame
+        root.broker.transport.setTcpNoDelay(True)
+        return root
+    def retry(f):
+        if attempts <= 1:
+            return f
+        return deferLater(reactor, 0.1, connectShard, port, attempts - 1)
+    return d.addCallbacks(connected, retry)
+
+def watchParent():
+    """Stops a shard worker once the front process that started it is gone"""
+    parent = os.getppid()
+    def check():
+        if os.getppid() != parent:
+            reactor.stop()
+    LoopingCall(check).start(1.0, now=False)
+
+def configure(server, options):
+    """Sets up a DominionServer, of this process or of a shard worker"""
+    server.flushDelay = options.flush_delay
+    server.bot = BOTS[options.table_bot]
+    if options.prompt_deadline:
+        server.deadlines = Deadlines(options.prompt_deadline, options.on_timeout)
+    server.idleTimeout = options.idle_timeout
+    if options.archive:
+        server.archive = GameRecordWriter(options.archive)
+        reactor.addSystemEventTrigger("before", "shutdown", server.archive.close)
+    LoopingCall(server.reap).start(min(REAP_INTERVAL, options.idle_timeout), now=False)
+
 def main():
-    startLogging(stdout)
+    parser = OptionParser()
+    parser.add_option("--profile", metavar="FILE",
+            help="profile plays, cards and prompts and write the statistics to FILE on shutdown "
+                 "(FILE.0, FILE.1 ... for the shard workers)")
+    parser.add_option("--metrics-port", type="int", metavar="PORT",
+            help="serve runtime metrics as text over HTTP on localhost:PORT "
+                 "(and PORT+1, PORT+2 ... for the shard workers)")
+    parser.add_option("--flush-delay", type="float", default=DEFAULT_FLUSH_DELAY, metavar="SECONDS",
+            help="how long messages to a client may be held back to be sent together "
+                 "(default: until the end of the current game step)")
+    parser.add_option("--max-outstanding", type="int", default=MAX_OUTSTANDING, metavar="N",
+            help="hold messages back from a client while N calls sending it messages are "
+                 "unanswered (default: %default)")
+    parser.add_option("--max-queued-bytes", type="int", default=MAX_QUEUED_BYTES, metavar="BYTES",
+            help="drop the oldest messages held back for a client beyond BYTES (default: %default)")
+    parser.add_option("--prompt-deadline", type="float", metavar="SECONDS",
+            help="give players SECONDS to answer each prompt before it is answered for them "
+                 "(default: no deadline)")
+    parser.add_option("--on-timeout", choices=sorted(FALLBACKS), default="default", metavar="BOT",
+            help="how late players are answered for: 'default' plays all treasures, buys nothing "
+                 "and declines reactions, or one of the bots %s" % ", ".join(sorted(BOTS)))
+    parser.add_option("--archive", metavar="FILE",
+            help="write finished games to the game record file FILE "
+                 "(FILE.0, FILE.1 ... for the shard workers)")
+    parser.add_option("--idle-timeout", type="float", default=IDLE_TIMEOUT, metavar="SECONDS",
+            help="drop games that go SECONDS without a turn (default: %default)")
+    parser.add_option("--max-detached", type="int", default=MAX_DETACHED, metavar="N",
+            help="keep the avatars of the N users who logged out most recently (default: %default)")
+    parser.add_option("--max-wait", type="float", default=DEFAULT_MAX_WAIT, metavar="SECONDS",
+            help="start a table of the matchmaker once its first player has waited SECONDS, "
+                 "with bots in the empty seats if its players allow them (default: %default)")
+    parser.add_option("--table-bot", choices=sorted(BOTS), default="bigmoney", metavar="BOT",
+            help="the bot taking empty seats, one of %s (default: %%default)" % ", ".join(sorted(BOTS)))
+    parser.add_option("--shards", type="int", default=0, metavar="N",
+            help="run the games in N worker processes instead of this one")
+    parser.add_option("--shard-port", type="int", default=8810, metavar="PORT",
+            help="local port of the first shard worker, the others follow (default: 8810)")
+    parser.add_option("--worker", type="int", metavar="PORT", help=SUPPRESS_HELP)
+    options, args = parser.parse_args()
 
-    realm = DominionRealm()
-    realm.server = DominionServer()
+    startLogging(stdout)
+    Outbox.maxOutstanding = options.max_outstanding
+    Outbox.maxBytes = options.max_queued_bytes
+    if options.profile:
+        profiler = profiling.enable([CLIUserService])
+        reactor.addSystemEventTrigger("before", "shutdown", profiler.export, options.profile)
+
+    if options.worker:
+        server = DominionServer()
+        configure(server, options)
+        if options.metrics_port:
+            server.metrics = metrics.ServerMetrics(server)
+            metrics.listen(server.metrics, options.metrics_port)
+        watchParent()
+        reactor.listenTCP(options.worker, PBServerFactory(WorkerRoot(server)), interface="127.0.0.1")
+        reactor.run()
+        return
+
+    realm = DominionRealm(options.max_detached)
     c1 = InMemoryUsernamePasswordDatabaseDontUse()
     c1.addUser("john", "1234")
     c1.addUser("bo", "9876")
@@ -342,7 +980,28 @@ def main():
     c2 = AllowAnonymousAccess()
     p = Portal(realm, [c1, c2])
 
-    reactor.listenTCP(8800, PBServerFactory(p))
+    if options.shards:
+        # players log in here, the games run in the workers
+        if options.metrics_port:
+            metrics.listen(metrics.ServerMetrics(realm=realm), options.metrics_port)
+        def started(shards):
+            realm.server = ShardedServer(shards)
+            realm.server.matchmaker.maxWait = options.max_wait
+            for shard in shards:
+                shard.callRemote("attach", realm.server)
+            reactor.listenTCP(8800, PBServerFactory(p))
+        def failed(f):
+            err(f, "shard workers did not start")
+            reactor.stop()
+        startShards(options).addCallbacks(started, failed)
+    else:
+        realm.server = DominionServer()
+        configure(realm.server, options)
+        realm.server.matchmaker.maxWait = options.max_wait
+        if options.metrics_port:
+            realm.server.metrics = metrics.ServerMetrics(realm.server, realm)
+            metrics.listen(realm.server.metrics, options.metrics_port)
+        reactor.listenTCP(8800, PBServerFactory(p))
     reactor.run()
 
 if __name__ == '__main__':
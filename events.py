@@ -0,0 +1,158 @@
+from collections import defaultdict
+
+class EventBus:
+    """Publishes the typed events of one game to its subscribers. Publishers
+    check subscribers before creating an event, so a bus nobody listens to
+    costs next to nothing."""
+    def __init__(self):
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        """callback is called with every event published from now on"""
+        self.subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def publish(self, event):
+        for callback in self.subscribers:
+            callback(event)
+
+class CardList:
+    """Renders a list of cards lazily, as 'Copper, Estate' or with counts as
+    'Copper: 2, Estate: 1'"""
+    def __init__(self, cards, counts=False):
+        self.cards = cards
+        self.counts = counts
+
+    def __str__(self):
+        if not self.counts:
+            return ', '.join([repr(x) for x in self.cards])
+        cardCount = defaultdict(int)
+        for card in self.cards:
+            cardCount[repr(card)] += 1
+        return ', '.join(["%s: %d" % (name, count) for name, count in cardCount.iteritems()])
+
+class GameEvent(object):
+    """Base class of game events. Events only hold references to the objects
+    involved; text is rendered when a subscriber asks for it. Events with
+    logged set make up the game log shown to the players."""
+    __slots__ = ("player", "depth")
+    logged = False
+
+    def __init__(self, player):
+        self.player = player
+        self.depth = player.logDepth
+
+    def render(self):
+        raise NotImplementedError
+
+    def text(self):
+        return "... " * self.depth + self.render()
+
+class MessageEvent(GameEvent):
+    """A line of narrative, formatted only when rendered"""
+    __slots__ = ("message", "args")
+    logged = True
+
+    def __init__(self, player, message, args):
+        GameEvent.__init__(self, player)
+        self.message = message
+        self.args = args
+
+    def render(self):
+        if self.args:
+            return self.message % self.args
+        return self.message
+
+class DrawEvent(GameEvent):
+    __slots__ = ("cards", "toHand")
+
+    def __init__(self, player, cards, toHand):
+        GameEvent.__init__(self, player)
+        self.cards = cards
+        self.toHand = toHand
+
+    def render(self):
+        return "%s draws %s." % (self.player, CardList(self.cards))
+
+class ReshuffleEvent(GameEvent):
+    __slots__ = ()
+    logged = True
+
+    def render(self):
+        return "(%s reshuffles.)" % self.player
+
+class PlayEvent(GameEvent):
+    __slots__ = ("card",)
+
+    def __init__(self, player, card):
+        GameEvent.__init__(self, player)
+        self.card = card
+
+    def render(self):
+        return "%s plays a %s." % (self.player, self.card)
+
+class GainEvent(PlayEvent):
+    __slots__ = ()
+
+    def render(self):
+        return "%s gains a %s." % (self.player, self.card)
+
+class TrashEvent(PlayEvent):
+    __slots__ = ()
+
+    def render(self):
+        return "%s trashes a %s." % (self.player, self.card)
+
+class RevealEvent(DrawEvent):
+    __slots__ = ()
+
+    def __init__(self, player, cards):
+        DrawEvent.__init__(self, player, cards, False)
+
+    def render(self):
+        return "%s reveals %s." % (self.player, CardList(self.cards))
+
+class ActionEvent(GameEvent):
+    """A top level action is about to be resolved, see GameManager.startAction"""
+    __slots__ = ("kind", "cardName")
+
+    def __init__(self, player, kind, cardName):
+        GameEvent.__init__(self, player)
+        self.kind = kind
+        self.cardName = cardName
+
+    def render(self):
+        return "%s %ss a %s." % (self.player, self.kind, self.cardName)
+
+class AttackEvent(GameEvent):
+    """Which players an attack by player affects once reactions are resolved"""
+    __slots__ = ("affected", "immune")
+
+    def __init__(self, player, affected, immune):
+        GameEvent.__init__(self, player)
+        self.affected = affected
+        self.immune = immune
+
+    def render(self):
+        text = "%s attacks %s." % (self.player, ', '.join([x.name for x in self.affected]) or "nobody")
+        if self.immune:
+            text += " (%s immune)" % ', '.join([x.name for x in self.immune])
+        return text
+
+class TextLog:
+    """Collects the logged events of a game and renders them when flushed"""
+    def __init__(self, bus):
+        self.events = []
+        bus.subscribe(self.append)
+
+    def append(self, event):
+        if event.logged:
+            self.events.append(event)
+
+    def flush(self):
+        events = self.events
+        self.events = []
+        return '\n'.join([x.text() for x in events])
@@ -0,0 +1,329 @@
+import sys
+import json
+import time
+import random
+from optparse import OptionParser
+
+from twisted.spread import pb
+from twisted.internet import reactor, defer, task
+from twisted.cred import credentials
+
+from protocol import StateMirror, decodeDelta
+
+timer = time.time
+# at most this many latency and login time samples are kept; beyond that
+# they are sampled
+MAX_SAMPLES = 100000
+
+class LoadStats:
+    def __init__(self):
+        self.started = timer()
+        self.gamesStarted = 0
+        self.gamesFinished = 0
+        self.prompts = 0
+        self.messages = 0
+        self.turns = 0
+        self.errors = 0
+        self.seen = 0
+        self.latencies = []
+        self.logins = 0
+        self.loginTimes = []
+        self.random = random.Random(0)
+
+    def addLatency(self, latency):
+        self.seen += 1
+        self.sample(self.latencies, self.seen, latency)
+
+    def addLoginTime(self, seconds):
+        self.logins += 1
+        self.sample(self.loginTimes, self.logins, seconds)
+
+    def sample(self, samples, seen, value):
+        """Adds the seen-th value to samples. Reservoir sampling keeps
+        memory bounded on long runs"""
+        if len(samples) < MAX_SAMPLES:
+            samples.append(value)
+        else:
+            i = self.random.randrange(seen)
+            if i < MAX_SAMPLES:
+                samples[i] = value
+
+    def percentiles(self, values, fractions=(0.5, 0.9, 0.99, 1.0)):
+        values = sorted(values)
+        if not values:
+            return dict((x, 0.0) for x in fractions)
+        return dict((x, values[min(int(x * len(values)), len(values) - 1)]) for x in fractions)
+
+    def toDict(self, activeGames):
+        elapsed = timer() - self.started
+        return {
+                "seconds": elapsed,
+                "activeGames": activeGames,
+                "gamesStarted": self.gamesStarted,
+                "gamesFinished": self.gamesFinished,
+                "turns": self.turns,
+                "turnsPerSecond": self.turns / elapsed,
+                "prompts": self.prompts,
+                "promptsPerSecond": self.prompts / elapsed,
+                "messages": self.messages,
+                "errors": self.errors,
+                "latency": self.percentiles(self.latencies),
+                "login": self.percentiles(self.loginTimes),
+                }
+
+class ScriptedClient(pb.Referenceable):
+    """A simulated player. It answers the text prompts of the server the way
+    a simple Big Money player would: play all treasures, buy the most
+    expensive card it can afford, take the first choice anywhere else.
+
+    The latency recorded is the time between answering a prompt and hearing
+    from the server again, i.e. how long the server took to act on it."""
+
+    structured = False
+
+    def __init__(self, test, game):
+        self.test = test
+        self.game = game
+        self.perspective = None
+        self.menuStep = 0
+        self.answered = None
+
+    def connect(self, host, port):
+        factory = pb.PBClientFactory()
+        reactor.connectTCP(host, port, factory)
+        start = timer()
+        d = factory.login(credentials.Anonymous(), client=self)
+        def loggedIn(perspective):
+            self.test.stats.addLoginTime(timer() - start)
+            # the server logs the avatar out once this reference goes away
+            self.perspective = perspective
+            self.factory = factory
+            return perspective.callRemote("joinGame", self.game.gameId, self.structured)
+        return d.addCallback(loggedIn)
+
+    def disconnect(self):
+        if self.perspective is not None:
+            self.factory.disconnect()
+            self.perspective = None
+
+    def _heard(self):
+        if self.answered is not None:
+            self.test.stats.addLatency(timer() - self.answered)
+            self.answered = None
+
+    def remote_print(self, message):
+        self._heard()
+        self.test.stats.messages += 1
+        # the server may send several messages, even several turns, at once
+        turns = message.count("'s turn!")
+        if turns:
+            self.menuStep = 0
+            if self is self.game.clients[0]:
+                self.test.stats.turns += turns
+        if " wins!" in message or "Game is a tie" in message:
+            self.game.finished(self)
+
+    def remote_getChoice(self, prompt):
+        self._heard()
+        self.test.stats.prompts += 1
+        return self.reply(self.answer(prompt))
+
+    def reply(self, answer):
+        """Returns answer, after thinking for a while if the test says so"""
+        if not self.test.think:
+            self.answered = timer()
+            return answer
+        def answerLater():
+            self.answered = timer()
+            return answer
+        return task.deferLater(reactor, self.test.random.expovariate(1.0 / self.test.think), answerLater)
+
+    def answer(self, prompt):
+        if "6: End turn" in prompt:
+            # the turn ends by itself once the last buy is made
+            option = ("2", "3", "6")[min(self.menuStep, 2)]
+            self.menuStep += 1
+            return option
+        if "\n1: No\n2: Yes" in prompt:
+            return "2"
+        if "(min " in prompt:
+            return "0"
+        if "1: " in prompt:
+            # card lists are shown most expensive first
+            return "1"
+        return "c"
+
+class StructuredClient(ScriptedClient):
+    """A ScriptedClient using the structured protocol, making the same
+    choices from its copy of the game state"""
+
+    structured = True
+
+    def __init__(self, test, game):
+        ScriptedClient.__init__(self, test, game)
+        self.mirror = StateMirror()
+
+    def remote_update(self, data):
+        self.update(decodeDelta(data))
+
+    def update(self, delta):
+        messages = self.mirror.apply(delta)
+        if messages:
+            self.remote_print("\n".join(messages))
+        else:
+            self._heard()
+
+    def answer(self, kind, prompt, options, minimum, maximum):
+        if kind == "menu":
+            option = ("2", "3", "6")[min(self.menuStep, 2)]
+            self.menuStep += 1
+            return option
+        if kind == "yesno":
+            return True
+        if kind == "count":
+            return minimum
+        if kind == "hand":
+            if maximum == 1:
+                return options[0]
+            hand = self.mirror["hand"]
+            return [x for x in options for i in xrange(hand.get(x, 0))][:maximum]
+        if kind == "supply":
+            return max(options, key=lambda x: self.mirror.cards[x].cost)
+        return None
+
+    def remote_choose(self, data):
+        delta = decodeDelta(data)
+        self.update(delta)
+        self.test.stats.prompts += 1
+        return self.reply(self.answer(*delta["choice"]))
+
+class LoadGame:
+    def __init__(self, test, gameId, numPlayers):
+        self.test = test
+        self.gameId = gameId
+        clientClass = StructuredClient if test.structured else ScriptedClient
+        self.clients = [clientClass(test, self) for i in xrange(numPlayers)]
+        self.done = False
+
+    def start(self):
+        self.test.stats.gamesStarted += 1
+        ds = [x.connect(self.test.host, self.test.port) for x in self.clients]
+        d = defer.gatherResults(ds)
+        d.addErrback(self.failed)
+        return d
+
+    def finished(self, client):
+        # every client hears the summary; count the game once
+        if self.done:
+            return
+        self.done = True
+        self.test.stats.gamesFinished += 1
+        self.test.gameFinished(self)
+        for client in self.clients:
+            reactor.callLater(0, client.disconnect)
+
+    def failed(self, f):
+        self.test.stats.errors += 1
+        if not self.done:
+            self.done = True
+            self.test.gameFinished(self)
+            for client in self.clients:
+                client.disconnect()
+        sys.stderr.write("game %s failed: %s\n" % (self.gameId, f.getErrorMessage()))
+
+class LoadTest:
+    """Ramps up to target concurrent games against a running server, adding
+    rampRate games per second, and keeps that many games going by starting
+    a new one whenever one finishes, until duration seconds have passed"""
+
+    def __init__(self, host="localhost", port=8800, target=10, rampRate=5.0,
+                 duration=60.0, numPlayers=2, think=0.0, reportEvery=5.0, seed=0,
+                 structured=False):
+        self.host = host
+        self.port = port
+        self.target = target
+        self.rampRate = rampRate
+        self.duration = duration
+        self.numPlayers = numPlayers
+        self.think = think
+        self.reportEvery = reportEvery
+        self.structured = structured
+        self.random = random.Random(seed)
+        self.stats = LoadStats()
+        self.active = set()
+        self.nextId = 0
+        self.stopping = False
+        self.reports = []
+
+    def run(self):
+        """Runs the reactor until the test is over and returns the reports"""
+        self.runId = "%x" % self.random.getrandbits(32)
+        self.ramp = task.LoopingCall(self.startGame)
+        self.ramp.start(1.0 / self.rampRate)
+        self.reporter = task.LoopingCall(self.report)
+        self.reporter.start(self.reportEvery, now=False)
+        reactor.callLater(self.duration, self.stop)
+        reactor.run()
+        return self.reports
+
+    def startGame(self):
+        if self.stopping or len(self.active) >= self.target:
+            return
+        game = LoadGame(self, "load-%s-%d" % (self.runId, self.nextId), self.numPlayers)
+        self.nextId += 1
+        self.active.add(game)
+        game.start()
+
+    def gameFinished(self, game):
+        self.active.discard(game)
+
+    def report(self):
+        stats = self.stats.toDict(len(self.active))
+        self.reports.append(stats)
+        latency = stats["latency"]
+        print ("%6.1fs %4d games active %5d finished %7.1f turns/s %7.1f prompts/s  "
+               "latency p50 %.1fms p90 %.1fms p99 %.1fms  errors %d" % (stats["seconds"],
+                stats["activeGames"], stats["gamesFinished"], stats["turnsPerSecond"],
+                stats["promptsPerSecond"], latency[0.5] * 1e3, latency[0.9] * 1e3,
+                latency[0.99] * 1e3, stats["errors"]))
+        sys.stdout.flush()
+
+    def stop(self):
+        self.stopping = True
+        self.ramp.stop()
+        self.reporter.stop()
+        self.report()
+        for game in list(self.active):
+            for client in game.clients:
+                client.disconnect()
+        reactor.callLater(0.1, reactor.stop)
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-H", "--host", default="localhost")
+    parser.add_option("-p", "--port", type="int", default=8800)
+    parser.add_option("-g", "--games", type="int", default=10,
+            help="number of concurrent games to ramp up to")
+    parser.add_option("-r", "--ramp", type="float", default=5.0,
+            help="games started per second while ramping up")
+    parser.add_option("-d", "--duration", type="float", default=60.0,
+            help="seconds to run for")
+    parser.add_option("-t", "--think", type="float", default=0.0,
+            help="mean seconds a client waits before answering a prompt")
+    parser.add_option("-i", "--interval", type="float", default=5.0,
+            help="seconds between reports")
+    parser.add_option("-S", "--structured", action="store_true",
+            help="use the structured protocol instead of text")
+    parser.add_option("-o", "--output", help="write the reports to this JSON file")
+    options, args = parser.parse_args()
+
+    test = LoadTest(options.host, options.port, options.games, options.ramp,
+            options.duration, think=options.think, reportEvery=options.interval,
+            structured=options.structured)
+    reports = test.run()
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(reports, f, indent=1)
+
+if __name__ == '__main__':
+    main()
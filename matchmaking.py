@@ -0,0 +1,128 @@
+from collections import OrderedDict
+
+from twisted.internet import reactor, defer
+
+from core import CardFactory
+import base
+from timerwheel import TimerWheel
+
+MIN_PLAYERS = 2
+MAX_PLAYERS = 6
+# seconds the first player at a table waits for it to fill
+DEFAULT_MAX_WAIT = 30.0
+# starts the ids of the games of the matchmaker, which clients may not use
+TABLE_PREFIX = "*"
+
+class Bucket:
+    """The players waiting for tables of one kind, first come first"""
+    def __init__(self, size, cards, botsAllowed):
+        self.size = size
+        self.cards = cards
+        self.botsAllowed = botsAllowed
+        # user: (Deferred, time queued)
+        self.waiting = OrderedDict()
+        self.timeout = None
+
+class Matchmaker:
+    """Seats queued players at tables. Players are kept in buckets by what
+    they asked for, the size of the table, the kingdom and whether bots may
+    sit in, and a bucket seats its first players as soon as it holds enough
+    of them, so queueing a player takes constant time however many wait.
+
+    Once the first player of a bucket has waited maxWait seconds its players
+    are seated anyway: with bots in the empty seats if they allow bots, else
+    at a smaller table if there are at least MIN_PLAYERS of them.
+
+    startTable(gameId, users, cards, bots) starts each game."""
+
+    def __init__(self, startTable, maxWait=DEFAULT_MAX_WAIT, wheel=None, clock=reactor):
+        self.startTable = startTable
+        self.maxWait = maxWait
+        self.clock = clock
+        self.wheel = wheel if wheel is not None else TimerWheel(clock=clock)
+        self.buckets = {}
+        # user: the Bucket it waits in
+        self.queued = {}
+        self.tables = 0
+        self.kingdomCards = set([x.name for x in CardFactory().getCardInfos() if x.kingdom])
+
+    def enqueue(self, user, size=MIN_PLAYERS, cards=None, botsAllowed=False):
+        """Queues user for a table of size players playing with the kingdom
+        cards, or a random one. Returns a Deferred firing with the id of the
+        game once user is seated, or None if user leaves the queue first"""
+        if not MIN_PLAYERS <= size <= MAX_PLAYERS:
+            raise ValueError("tables seat %d to %d players" % (MIN_PLAYERS, MAX_PLAYERS))
+        if cards:
+            unknown = [x for x in cards if x not in self.kingdomCards]
+            if unknown:
+                raise ValueError("not kingdom cards: %s" % ", ".join(unknown))
+            cards = tuple(sorted(set(cards)))
+        else:
+            cards = None
+        self.leave(user)
+        key = (size, cards, bool(botsAllowed))
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = Bucket(*key)
+        d = defer.Deferred()
+        bucket.waiting[user] = (d, self.clock.seconds())
+        self.queued[user] = bucket
+        if len(bucket.waiting) >= size:
+            self.seat(bucket, size)
+        elif bucket.timeout is None:
+            bucket.timeout = self.wheel.schedule(self.maxWait, self.expired, bucket)
+        return d
+
+    def leave(self, user):
+        """Takes user out of the queue, if it is waiting"""
+        bucket = self.queued.pop(user, None)
+        if bucket is None:
+            return
+        d, queued = bucket.waiting.pop(user)
+        if not bucket.waiting:
+            self._remove(bucket)
+        d.callback(None)
+
+    def __len__(self):
+        return len(self.queued)
+
+    def seat(self, bucket, count):
+        """Starts a table for the first count players of bucket, with bots
+        in the empty seats if they allow them"""
+        users = []
+        for i in xrange(count):
+            user, (d, queued) = bucket.waiting.popitem(last=False)
+            del self.queued[user]
+            users.append((user, d))
+        bots = bucket.size - count if bucket.botsAllowed else 0
+        self.tables += 1
+        gameId = "%stable-%d" % (TABLE_PREFIX, self.tables)
+        if bucket.timeout is not None:
+            bucket.timeout.cancel()
+            bucket.timeout = None
+        if bucket.waiting:
+            # the next deadline is the one of the player now first in line
+            d, queued = bucket.waiting.itervalues().next()
+            wait = max(0.0, queued + self.maxWait - self.clock.seconds())
+            bucket.timeout = self.wheel.schedule(wait, self.expired, bucket)
+        else:
+            self._remove(bucket)
+        self.startTable(gameId, [x[0] for x in users], bucket.cards, bots)
+        for user, d in users:
+            d.callback(gameId)
+
+    def expired(self, bucket):
+        bucket.timeout = None
+        count = len(bucket.waiting)
+        if bucket.botsAllowed or count >= MIN_PLAYERS:
+            self.seat(bucket, count)
+        else:
+            bucket.timeout = self.wheel.schedule(self.maxWait, self.expired, bucket)
+
+    def _remove(self, bucket):
+        if bucket.timeout is not None:
+            bucket.timeout.cancel()
+            bucket.timeout = None
+        key = (bucket.size, bucket.cards, bucket.botsAllowed)
+        if self.buckets.get(key) is bucket:
+            del self.buckets[key]
@@ -0,0 +1,343 @@
+import sys
+import math
+import time
+import random
+import cPickle
+import multiprocessing
+from itertools import combinations
+from optparse import OptionParser
+
+from zope.interface.verify import verifyClass
+from twisted.python import threadable
+
+from core import *
+from base import *
+import simulation
+from simulation import BotUserService, SmithyBot, resultOf, runGame
+from replay import ReplayUserService, ReplayedFailure, ReplayError, recordGame
+
+# seconds to think about each decision, some 400 rollouts on one core
+DEFAULT_BUDGET = 1.0
+# rollouts per decision below which the search plays badly: with 30 it
+# buys mostly Copper and loses every game to BigMoney, with 100 it still
+# loses most, with 300 it wins about two games in three
+MIN_ROLLOUTS = 300
+# most candidate answers considered at one prompt, e.g. sets of cards to
+# discard
+MAX_CANDIDATES = 20
+# exploration constant of UCB1
+EXPLORATION = 0.7
+# score margin at which a rollout counts as a complete win or loss
+MARGIN_SCALE = 30.0
+
+_pools = {}
+
+def getPool(processes):
+    """Returns the worker pool with the given number of processes, shared by
+    every MCTS player"""
+    pool = _pools.get(processes)
+    if pool is None:
+        pool = _pools[processes] = multiprocessing.Pool(processes)
+    return pool
+
+class RolloutUserService(ReplayUserService):
+    """Answers prompts in a rollout: first from a queue of forced answers
+    (those already given in the real game plus the candidate being tried),
+    then like bot. A forced answer for another prompt than the one asked is
+    left for later."""
+    def __init__(self, game, player, answers, bot):
+        ReplayUserService.__init__(self, game, player, answers)
+        self.bot = bot
+
+    def chooseCardFromHand(self, klass=Card):
+        return self._answer("chooseCardFromHand", klass)
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        return self._answer("chooseCardsFromHand", klass, number, ignore)
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        return self._answer("chooseCardFromSupply", klass, availableCoins)
+
+    def chooseCardForBuy(self):
+        return self._answer("chooseCardForBuy")
+
+    def getCardInstance(self, validChoices, prompt=None):
+        return self._answer("getCardInstance", validChoices)
+
+    def getCardNameByCost(self, validChoices):
+        return self._answer("getCardNameByCost", validChoices)
+
+    def getYesNoChoice(self, question):
+        return self._answer("getYesNoChoice", question)
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        return self._answer("getChoice", prompt, minimum, maximum)
+
+    def _answer(self, method, *args):
+        if self.answers and self.answers[0][0] == method:
+            return getattr(ReplayUserService, method)(self, *args)
+        return getattr(self.bot, method)(*args)
+
+verifyClass(IUserService, RolloutUserService)
+
+def rollout(snapshot, action, answers, seat, rng, botClass, horizon):
+    """Plays a copy of snapshot to the end, or for horizon more turns, and
+    returns seat's reward between 0 and 1. If action is given, the snapshot was
+    taken at its start and it is resolved first with the forced answers.
+    The draw piles are shuffled once the forced answers are used up, as the
+    player cannot know their order."""
+    game = snapshot.clone()
+    for player in game.players:
+        bot = botClass(game, player)
+        bot.random = random.Random(rng.getrandbits(32))
+        player.userService = RolloutUserService(game, player, answers[player.seat], bot)
+    if action is not None:
+        kind, actionSeat, cardName, handIndex = action
+        player = game.players[actionSeat]
+        try:
+            if kind == "play":
+                resultOf(player.play(player.userService._findCard(player.hand, (handIndex, cardName))))
+            else:
+                resultOf(player.buy(cardName))
+        except ReplayedFailure:
+            pass
+    game.random.seed(rng.getrandbits(32))
+    for player in game.players:
+        game.random.shuffle(player.drawdeck.cards)
+    maxTurns = simulation.MAX_TURNS
+    if horizon is not None:
+        maxTurns = min(maxTurns, game.currentPlayer.turn + horizon)
+    winners = resultOf(runGame(game, maxTurns))
+    # a win counts most, but the margin breaks ties between rollouts that
+    # are all won or all lost, which makes the estimates much less noisy
+    player = game.players[seat]
+    margin = player.score - max([x.score for x in game.players if x is not player])
+    reward = 0.5 + 0.5 * max(-1.0, min(1.0, margin / MARGIN_SCALE))
+    if player in winners:
+        return 0.5 * reward + 0.5 / len(winners)
+    return 0.5 * reward
+
+def search(snapshot, action, answers, seat, method, candidates, deadline=None,
+           rollouts=None, seed=None, botClass=SmithyBot, horizon=None):
+    """Tries the candidate answers to seat's pending prompt with UCB1 until
+    the deadline passes or the rollouts are used up. Returns the summed
+    rewards and the number of rollouts of every candidate"""
+    rng = random.Random(seed)
+    rewards = [0.0] * len(candidates)
+    visits = [0] * len(candidates)
+    total = 0
+    while (rollouts is None or total < rollouts) and (deadline is None or time.time() < deadline):
+        if total < len(candidates):
+            i = total
+        else:
+            logTotal = math.log(total)
+            i = max(xrange(len(candidates)), key=lambda x: rewards[x] / visits[x] +
+                    EXPLORATION * math.sqrt(logTotal / visits[x]))
+        forced = [list(x) for x in answers]
+        forced[seat].append((method, candidates[i], False))
+        try:
+            rewards[i] += rollout(snapshot, action, forced, seat, rng, botClass, horizon)
+        except ReplayError:
+            # the forced answers did not fit the rollout; count it as a loss
+            pass
+        visits[i] += 1
+        total += 1
+    return rewards, visits
+
+def _searchTask(args):
+    snapshot = cPickle.loads(args[0])
+    return search(snapshot, *args[1:])
+
+class MCTSUserService(BotUserService):
+    """Computer player that makes every decision by Monte Carlo search: each
+    candidate answer is tried in rollouts played by rolloutBot from copies of
+    the game, and the most visited one wins.
+
+    Prompts made while a play or buy is being resolved (Militia discards,
+    Remodel targets, ...) are searched from a copy taken at the start of that
+    action, replaying the answers given since. This needs the decision log,
+    so games with MCTS players must be recorded (see replay.recordGame);
+    otherwise those prompts are answered by rolloutBot directly.
+
+    Each decision takes budget seconds, or exactly rollouts rollouts if
+    given; either should allow for MIN_ROLLOUTS or more. With processes > 1
+    the rollouts are spread over a shared pool of worker processes.
+
+    Every decision blocks until its search is done, so the service is for
+    simulations only: it must not answer prompts from the reactor thread
+    of a running server, and refuses to use the pool there."""
+
+    def __init__(self, game, player, budget=DEFAULT_BUDGET, rollouts=None,
+                 processes=1, rolloutBot=SmithyBot, horizon=None):
+        BotUserService.__init__(self, game, player)
+        self.budget = budget
+        self.rollouts = rollouts
+        self.processes = processes
+        self.rolloutBot = rolloutBot
+        self.horizon = horizon
+        self.fallback = rolloutBot(game, player)
+        self.snapshot = None
+        self.mark = None
+        game.events.subscribe(self.onEvent)
+
+    def onEvent(self, event):
+        if isinstance(event, ActionEvent):
+            self.snapshot = self.game.clone()
+            if self.game.decisions is not None:
+                self.mark = len(self.game.decisions)
+
+    def chooseCardFromHand(self, klass=Card):
+        validChoices = [x for x in self.player.hand if isinstance(x, klass)]
+        if not validChoices:
+            return None
+        candidates = self._cardChoices(validChoices, self.player.hand.index)
+        if klass is Action:
+            candidates.append((None, None))
+        return self._decide("chooseCardFromHand", candidates,
+                lambda: self.fallback.chooseCardFromHand(klass))
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        validChoices = [x for x in self.player.hand if isinstance(x, klass) and x is not ignore]
+        number = min(number, len(validChoices))
+        byName = {}
+        for card in validChoices:
+            byName.setdefault(card.info.name, []).append(card)
+        names = sorted(set(combinations(sorted([x.info.name for x in validChoices]), number)))
+        if len(names) > MAX_CANDIDATES:
+            names = self.random.sample(names, MAX_CANDIDATES)
+        candidates = []
+        for cardNames in names:
+            cards = [byName[x][cardNames[:i].count(x)] for i, x in enumerate(cardNames)]
+            candidates.append(([(self.player.hand.index[x], x.info.name) for x in cards], cards))
+        return self._decide("chooseCardsFromHand", candidates,
+                lambda: self.fallback.chooseCardsFromHand(klass, number, ignore))
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        validChoices = self.game.getAvailableCardOfType(klass, availableCoins)
+        return self._decide("chooseCardFromSupply", [(x, x) for x in validChoices],
+                lambda: self.fallback.chooseCardFromSupply(klass, availableCoins))
+
+    def chooseCardForBuy(self):
+        validChoices = self.game.getAvailableCardsToBuy(self.player.coins)
+        return self._decide("chooseCardForBuy", [(x, x) for x in validChoices] + [(None, None)],
+                self.fallback.chooseCardForBuy)
+
+    def getCardInstance(self, validChoices, prompt=None):
+        if not validChoices:
+            return None
+        candidates = self._cardChoices(validChoices, dict((x, i) for i, x in enumerate(validChoices)))
+        return self._decide("getCardInstance", candidates,
+                lambda: self.fallback.getCardInstance(validChoices))
+
+    def getCardNameByCost(self, validChoices):
+        return self._decide("getCardNameByCost", [(x, x) for x in validChoices],
+                lambda: self.fallback.getCardNameByCost(validChoices))
+
+    def getYesNoChoice(self, question):
+        return self._decide("getYesNoChoice", [(True, True), (False, False)],
+                lambda: self.fallback.getYesNoChoice(question))
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        """Only prompts for a number are searched"""
+        if minimum is None:
+            return self.fallback.getChoice(prompt)
+        low, high = minimum, min(maximum, len(self.player.hand))
+        candidates = [(str(x), str(x)) for x in xrange(low, max(low, high) + 1)]
+        return self._decide("getChoice", candidates, lambda: self.fallback.getChoice(prompt, minimum, maximum))
+
+    def _cardChoices(self, cards, positions):
+        """One candidate per distinct card name, as (logged answer, card)"""
+        byName = {}
+        for card in cards:
+            byName.setdefault(card.info.name, card)
+        return [((positions[x], name), x) for name, x in sorted(byName.iteritems())]
+
+    def _decide(self, method, candidates, default):
+        """candidates are (logged answer, answer) pairs"""
+        if len(candidates) < 2:
+            return candidates[0][1] if candidates else default()
+        seat = self.player.seat
+        if self.game.pendingAction is None:
+            snapshot = self.game.clone()
+            action = None
+            answers = [[] for x in self.game.players]
+        elif self.snapshot is not None and self.mark is not None:
+            snapshot = self.snapshot
+            action = snapshot.pendingAction
+            answers = [[] for x in self.game.players]
+            for decision in self.game.decisions[self.mark:]:
+                if decision[0] == "answer":
+                    answers[decision[1]].append(decision[2:])
+        else:
+            return default()
+
+        logged = [x[0] for x in candidates]
+        deadline = None if self.rollouts else time.time() + self.budget
+        seed = self.random.getrandbits(32)
+        if self.processes == 1:
+            rewards, visits = search(snapshot, action, answers, seat, method, logged,
+                    deadline, self.rollouts, seed, self.rolloutBot, self.horizon)
+        else:
+            if threadable.isInIOThread():
+                raise RuntimeError("MCTS searches block, they cannot run in the reactor thread")
+            data = cPickle.dumps(snapshot, cPickle.HIGHEST_PROTOCOL)
+            rollouts = None
+            if self.rollouts:
+                rollouts = -(-self.rollouts // self.processes)
+            tasks = [(data, action, answers, seat, method, logged, deadline,
+                      rollouts, seed + i, self.rolloutBot, self.horizon)
+                     for i in xrange(self.processes)]
+            results = getPool(self.processes).map(_searchTask, tasks)
+            rewards = [sum(x) for x in zip(*[x[0] for x in results])]
+            visits = [sum(x) for x in zip(*[x[1] for x in results])]
+        best = max(xrange(len(candidates)), key=lambda x: (visits[x], rewards[x]))
+        return candidates[best][1]
+
+verifyClass(IUserService, MCTSUserService)
+
+def main():
+    parser = OptionParser(usage="%prog [options] [BOT...]")
+    parser.add_option("-n", "--games", type="int", default=10)
+    parser.add_option("-s", "--seed", type="int", default=0)
+    parser.add_option("-b", "--budget", type="float", default=DEFAULT_BUDGET,
+            help="seconds per decision")
+    parser.add_option("-r", "--rollouts", type="int",
+            help="fixed number of rollouts per decision instead of a time budget, "
+                 "at least %d for sound play" % MIN_ROLLOUTS)
+    parser.add_option("-j", "--processes", type="int", default=1)
+    parser.add_option("--horizon", type="int",
+            help="turns to look ahead in rollouts (default: to the end of the game)")
+    parser.add_option("-k", "--kingdom",
+            help="comma separated list of kingdom cards (default: random)")
+    options, args = parser.parse_args()
+    bots = [simulation.BOTS[x] for x in args or ["smithy"]]
+    cards = options.kingdom.split(",") if options.kingdom else None
+
+    wins = 0.0
+    start = time.time()
+    for i in xrange(options.games):
+        # rotate the seat of the MCTS player
+        seat = i % (len(bots) + 1)
+        names = [x.__name__ for x in bots]
+        names.insert(seat, "MCTS")
+        players = [Player("%s%d" % (x, j+1)) for j, x in enumerate(names)]
+        game = GameManager(players, options.seed + i)
+        opponents = iter(bots)
+        for player in players:
+            if player.seat == seat:
+                player.userService = MCTSUserService(game, player, options.budget,
+                        options.rollouts, options.processes, horizon=options.horizon)
+            else:
+                player.userService = opponents.next()(game, player)
+        recordGame(game)
+        game.setup(cards)
+        winners = resultOf(runGame(game))
+        if players[seat] in winners:
+            wins += 1.0 / len(winners)
+        print "game %d: %s" % (i+1, ', '.join(["%s %d" % (x.name, x.score) for x in players]))
+        sys.stdout.flush()
+    elapsed = time.time() - start
+    print "MCTS won %.1f of %d games in %.1fs" % (wins, options.games, elapsed)
+
+if __name__ == '__main__':
+    main()
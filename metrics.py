@@ -0,0 +1,205 @@
+import sys
+import time
+import resource
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.web import server
+from twisted.web.resource import Resource
+
+timer = time.time
+# number of recent prompt round trips the latency percentiles are taken from
+LATENCY_SAMPLES = 1000
+# seconds over which the turn rate is averaged
+RATE_WINDOW = 60.0
+PERCENTILES = (0.5, 0.9, 0.99)
+# the calls asking a client to decide, of the text and structured protocols
+PROMPTS = ("getChoice", "choose")
+
+def _size(value):
+    """Rough number of bytes value takes on the wire: the length of strings
+    and a few bytes for every other atom"""
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        return sum([_size(k) + _size(v) for k, v in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return sum([_size(x) for x in value])
+    return 2
+
+class GameStats:
+    """Traffic of one game"""
+    def __init__(self, name):
+        self.name = name
+        self.messages = 0
+        self.bytesSent = 0
+        self.prompts = 0
+
+class ServerMetrics:
+    """Runtime metrics of a DominionServer. Every call to a client goes
+    through track(), which counts the bytes sent, the calls outstanding and
+    the round trip time of prompts; the game loop reports the start of each
+    turn. The rest, such as the depth of the players' outboxes, is read from
+    the server and the realm when rendered."""
+    def __init__(self, server=None, realm=None):
+        self.server = server
+        self.realm = realm
+        self.started = timer()
+        self.outstanding = 0
+        self.calls = 0
+        self.errors = 0
+        self.bytesSent = 0
+        self.turns = 0
+        self.turnTimes = deque()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.games = {}
+
+    def gameStats(self, name):
+        stats = self.games.get(name)
+        if stats is None:
+            stats = self.games[name] = GameStats(name)
+        return stats
+
+    def forget(self, name):
+        """Drops the stats of a game the server is done with"""
+        self.games.pop(name, None)
+
+    def track(self, stats, method, callRemote, *args):
+        """Calls callRemote(method, *args) and accounts for it in stats, a
+        GameStats, and the totals"""
+        size = sum([_size(x) for x in args])
+        self.calls += 1
+        self.bytesSent += size
+        if stats is not None:
+            stats.bytesSent += size
+            if method in PROMPTS:
+                stats.prompts += 1
+            else:
+                stats.messages += 1
+        start = timer()
+        try:
+            d = callRemote(method, *args)
+        except Exception:
+            # e.g. DeadReferenceError, the client is gone
+            self.errors += 1
+            raise
+        self.outstanding += 1
+        def done(result):
+            self.outstanding -= 1
+            if method in PROMPTS:
+                self.latencies.append(timer() - start)
+            return result
+        def failed(f):
+            self.errors += 1
+            return f
+        d.addBoth(done)
+        d.addErrback(failed)
+        return d
+
+    def turnStarted(self):
+        now = timer()
+        self.turns += 1
+        self.turnTimes.append(now)
+        while self.turnTimes and self.turnTimes[0] < now - RATE_WINDOW:
+            self.turnTimes.popleft()
+
+    def turnsPerSecond(self):
+        now = timer()
+        while self.turnTimes and self.turnTimes[0] < now - RATE_WINDOW:
+            self.turnTimes.popleft()
+        return len(self.turnTimes) / min(RATE_WINDOW, max(now - self.started, 1.0))
+
+    def latencyPercentiles(self):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return [(x, 0.0) for x in PERCENTILES]
+        return [(x, latencies[min(int(x * len(latencies)), len(latencies) - 1)]) for x in PERCENTILES]
+
+    def memory(self):
+        """Resident and peak resident set size of the process in bytes"""
+        try:
+            # both from the same place, so the peak is never below the
+            # resident size
+            with open("/proc/self/status") as f:
+                fields = dict([x.split(":", 1) for x in f if ":" in x])
+            resident = int(fields["VmRSS"].split()[0]) * 1024
+            peak = int(fields["VmHWM"].split()[0]) * 1024
+        except (IOError, OSError, KeyError, ValueError):
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # in bytes on macOS, in kilobytes elsewhere
+            if sys.platform != "darwin":
+                peak *= 1024
+            resident = peak
+        return resident, max(peak, resident)
+
+    def collect(self):
+        """Returns the metrics as (name, labels, value) triples"""
+        values = []
+        if self.server is not None:
+            games = self.server.games.values()
+            values.append(("dominion_games", "", len(games)))
+            values.append(("dominion_games_active", "",
+                    len([x for x in games if x.inProgress and not x.finished])))
+            values.append(("dominion_games_archived_total", "", self.server.archived))
+            values.append(("dominion_games_reaped_total", "", self.server.reaped))
+            outboxes = [x.userService.outbox for game in games if game.inProgress
+                    for x in game.users.itervalues()]
+            values.append(("dominion_outbox_queued_bytes", "", sum([x.queuedBytes for x in outboxes])))
+            values.append(("dominion_outbox_queued_bytes_max", "", max([x.queuedBytes for x in outboxes] or [0])))
+            values.append(("dominion_outbox_queued_messages", "", sum([len(x.pending) for x in outboxes])))
+            values.append(("dominion_outbox_outstanding_calls", "", sum([x.outstanding for x in outboxes])))
+            values.append(("dominion_outbox_dropped_messages", "", sum([x.droppedTotal for x in outboxes])))
+            values.append(("dominion_outbox_failed_calls", "", sum([x.failures for x in outboxes])))
+        if self.realm is not None:
+            values.append(("dominion_avatars", "", len(self.realm.avatars)))
+            values.append(("dominion_avatars_connected", "",
+                    len([x for x in self.realm.avatars.itervalues() if getattr(x, "remote", None)])))
+            matchmaker = getattr(self.realm.server, "matchmaker", None)
+            if matchmaker is not None:
+                values.append(("dominion_matchmaking_queued", "", len(matchmaker)))
+                values.append(("dominion_matchmaking_tables_total", "", matchmaker.tables))
+        values.append(("dominion_turns_total", "", self.turns))
+        values.append(("dominion_turns_per_second", "", self.turnsPerSecond()))
+        for percentile, latency in self.latencyPercentiles():
+            values.append(("dominion_prompt_latency_seconds", 'quantile="%s"' % percentile, latency))
+        values.append(("dominion_remote_calls_total", "", self.calls))
+        values.append(("dominion_remote_calls_outstanding", "", self.outstanding))
+        values.append(("dominion_remote_call_errors_total", "", self.errors))
+        values.append(("dominion_bytes_sent_total", "", self.bytesSent))
+        for name, stats in sorted(self.games.iteritems()):
+            label = 'game="%s"' % name
+            values.append(("dominion_game_bytes_sent", label, stats.bytesSent))
+            values.append(("dominion_game_messages", label, stats.messages))
+            values.append(("dominion_game_prompts", label, stats.prompts))
+        resident, peak = self.memory()
+        values.append(("process_resident_memory_bytes", "", resident))
+        values.append(("process_peak_resident_memory_bytes", "", peak))
+        values.append(("process_uptime_seconds", "", timer() - self.started))
+        return values
+
+    def render(self):
+        """Renders the metrics as text, one 'name{labels} value' per line"""
+        lines = []
+        for name, labels, value in self.collect():
+            if labels:
+                name = "%s{%s}" % (name, labels)
+            if isinstance(value, float):
+                lines.append("%s %.6g" % (name, value))
+            else:
+                lines.append("%s %d" % (name, value))
+        return "\n".join(lines) + "\n"
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def __init__(self, metrics):
+        Resource.__init__(self)
+        self.metrics = metrics
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; charset=utf-8")
+        return self.metrics.render()
+
+def listen(metrics, port, interface="127.0.0.1"):
+    """Serves the metrics over HTTP on port, by default to local clients only"""
+    return reactor.listenTCP(port, server.Site(MetricsResource(metrics)), interface=interface)
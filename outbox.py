@@ -0,0 +1,130 @@
+from twisted.internet import reactor, defer
+from twisted.spread import pb
+
+# seconds informational messages may wait to be sent. With 0 they go out
+# once the reactor regains control, i.e. at the end of the current game step
+DEFAULT_FLUSH_DELAY = 0.0
+# calls sending messages a client may leave unanswered before more messages
+# are held back for it
+MAX_OUTSTANDING = 4
+# bytes of messages held back for a client before the oldest are dropped
+MAX_QUEUED_BYTES = 64 * 1024
+
+class Outbox:
+    """Coalesces the messages printed to one client. Messages are queued
+    and sent together as a single 'print' call when the flush delay has
+    passed, or sooner if any other call is made to the client, so they
+    always arrive before the prompt that follows them.
+
+    A client that is slow to take its messages gets no more of them while
+    maxOutstanding of the calls sending them are unanswered. They are held
+    in the queue instead, and once that holds more than maxBytes the oldest
+    are dropped and the client is told how many it missed. Prompts are
+    never held back."""
+
+    maxOutstanding = MAX_OUTSTANDING
+    maxBytes = MAX_QUEUED_BYTES
+
+    def __init__(self, callRemote, delay=DEFAULT_FLUSH_DELAY, clock=reactor):
+        self.callRemote = callRemote
+        self.delay = delay
+        self.clock = clock
+        self.pending = []
+        self.timer = None
+        # bytes in pending, the message calls not yet answered and the
+        # messages dropped since the last were sent
+        self.queuedBytes = 0
+        self.outstanding = 0
+        self.dropped = 0
+        self.droppedTotal = 0
+        # calls sending messages that failed, mostly as the client went away
+        self.failures = 0
+
+    def add(self, message):
+        self.pending.append(message)
+        self.queuedBytes += len(message)
+        if self.queuedBytes > self.maxBytes:
+            self.shed()
+        self._flushSoon()
+
+    def shed(self):
+        """Drops the oldest messages until at most half of maxBytes are
+        queued, always keeping the newest"""
+        keep = len(self.pending)
+        size = 0
+        while keep > 0 and size + len(self.pending[keep-1]) <= self.maxBytes // 2:
+            keep -= 1
+            size += len(self.pending[keep])
+        if keep == len(self.pending):
+            keep -= 1
+            size = len(self.pending[-1])
+        self.dropped += keep
+        self.droppedTotal += keep
+        del self.pending[:keep]
+        self.queuedBytes = size
+
+    def _flushSoon(self):
+        if self.timer is None and self.pending and self.outstanding < self.maxOutstanding:
+            self.timer = self.clock.callLater(self.delay, self._flushLater)
+
+    def take(self):
+        """Returns the queued messages and empties the queue"""
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
+        messages = self.pending
+        if self.dropped:
+            messages.insert(0, "(%d messages were dropped)" % self.dropped)
+            self.dropped = 0
+        self.pending = []
+        self.queuedBytes = 0
+        return messages
+
+    def flush(self):
+        """Sends the queued messages now. Returns the Deferred of the call or
+        None if there was nothing to send"""
+        return self.send(self.take())
+
+    def send(self, messages):
+        if not messages:
+            return None
+        return self.deliver("print", "\n".join(messages))
+
+    def deliver(self, method, *args):
+        """Makes a call sending messages, which counts as outstanding until
+        the client answers it"""
+        d = self.callClient(method, *args)
+        self.outstanding += 1
+        return d.addErrback(self._failed).addBoth(self._delivered)
+
+    def _failed(self, f):
+        # the client is gone or broken, there is nobody left to tell
+        self.failures += 1
+        self.pending = []
+        self.queuedBytes = 0
+
+    def _delivered(self, result):
+        self.outstanding -= 1
+        self._flushSoon()
+        return result
+
+    def _flushLater(self):
+        self.timer = None
+        if self.outstanding >= self.maxOutstanding:
+            # _delivered tries again
+            return
+        self.flush()
+
+    def call(self, method, *args):
+        """Flushes the queued messages, then calls method on the client"""
+        self.flush()
+        return self.callClient(method, *args)
+
+    def callClient(self, method, *args):
+        """Calls method on the client. Returns a Deferred, which has failed
+        already if the client is gone"""
+        try:
+            return self.callRemote(method, *args)
+        except pb.DeadReferenceError:
+            return defer.fail()
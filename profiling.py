@@ -0,0 +1,246 @@
+import sys
+import json
+import math
+import time
+import weakref
+from optparse import OptionParser
+
+from twisted.internet import defer
+
+from core import *
+from core import _cardLookup
+
+timer = time.time
+# histogram buckets are powers of two of microseconds, up to about 35 minutes
+NUM_BUCKETS = 32
+
+class Stats:
+    """Call count, total wall time, time waiting on users and a histogram of
+    wall times of one kind of call"""
+    def __init__(self):
+        self.count = 0
+        self.wall = 0.0
+        self.wait = 0.0
+        self.histogram = [0] * NUM_BUCKETS
+
+    def add(self, wall, wait):
+        self.count += 1
+        self.wall += wall
+        self.wait += wait
+        micros = wall * 1e6
+        bucket = int(math.log(micros, 2)) + 1 if micros >= 1 else 0
+        self.histogram[min(bucket, NUM_BUCKETS - 1)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of calls, in
+        seconds"""
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= target:
+                return (1 << bucket) / 1e6
+        return 0.0
+
+    def toDict(self):
+        return {
+                "count": self.count,
+                "wall": self.wall,
+                "wait": self.wait,
+                "compute": self.wall - self.wait,
+                # bucket i counts calls taking less than 2**i microseconds
+                "histogram": dict((str(1 << i), x) for i, x in enumerate(self.histogram) if x),
+                }
+
+class Profiler:
+    """Times the engine's entry points by wrapping them in place: plays and
+    buys per card, each card's doAction and doReaction, cleanup, doAttack
+    and every prompt of the given user service classes. Nothing is wrapped
+    until install() is called and uninstall() puts the original methods
+    back, so a disabled profiler costs nothing.
+
+    Calls returning a Deferred are timed until it fires. Time during which a
+    game had a prompt outstanding that had not been answered synchronously
+    counts as waiting on the user, the rest as computing."""
+
+    def __init__(self, serviceClasses=()):
+        self.serviceClasses = serviceClasses
+        self.stats = {}
+        self.patched = []
+        # per game: number of outstanding prompts, start of the current wait
+        # and total time waited
+        self.waiting = weakref.WeakKeyDictionary()
+
+    def install(self):
+        if self.patched:
+            return
+        self._patch(Player, "play", "play", lambda player, card, *args: card.info.name)
+        self._patch(Player, "buy", "buy", lambda player, cardName, *args: cardName)
+        self._patch(Player, "cleanup", "cleanup")
+        self._patch(GameManager, "doAttack", "attack")
+        # the cards declared as data have no doAction of their own
+        self._patch(Effect, "apply", "action", lambda effect, player: effect.name)
+        for name, klass in sorted(_cardLookup.iteritems()):
+            for method, phase in (("doAction", "action"), ("doReaction", "reaction")):
+                if method in klass.__dict__:
+                    self._patch(klass, method, "%s:%s" % (phase, name))
+        for klass in self.serviceClasses:
+            for method in IUserService.names():
+                if method in klass.__dict__ and method != "sendMessage":
+                    self._patchPrompt(klass, method)
+
+    def uninstall(self):
+        for klass, method, original in reversed(self.patched):
+            setattr(klass, method, original)
+        self.patched = []
+
+    def reset(self):
+        self.stats = {}
+
+    def record(self, key, wall, wait):
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = Stats()
+        stats.add(wall, wait)
+
+    def waited(self, game):
+        """Total time game has spent waiting on its users so far"""
+        if game is None:
+            return 0.0
+        state = self.waiting.get(game)
+        if state is None:
+            return 0.0
+        outstanding, start, total = state
+        if outstanding:
+            total += timer() - start
+        return total
+
+    def _startWait(self, game):
+        outstanding, start, total = self.waiting.get(game, (0, 0.0, 0.0))
+        if not outstanding:
+            start = timer()
+        self.waiting[game] = (outstanding + 1, start, total)
+
+    def _endWait(self, game):
+        outstanding, start, total = self.waiting[game]
+        if outstanding == 1:
+            total += timer() - start
+        self.waiting[game] = (outstanding - 1, start, total)
+
+    def _patch(self, klass, method, phase, detail=None):
+        """Wraps klass.method so that each call is recorded under phase, or
+        under phase:detail(*args) if detail is given"""
+        original = klass.__dict__[method]
+        profiler = self
+        def wrapper(obj, *args, **kwargs):
+            key = phase if detail is None else "%s:%s" % (phase, detail(obj, *args))
+            game = _gameOf(obj)
+            start = timer()
+            waitStart = profiler.waited(game)
+            result = original(obj, *args, **kwargs)
+            if isinstance(result, defer.Deferred) and not result.called:
+                def done(value):
+                    profiler.record(key, timer() - start, profiler.waited(game) - waitStart)
+                    return value
+                result.addBoth(done)
+            else:
+                profiler.record(key, timer() - start, profiler.waited(game) - waitStart)
+            return result
+        wrapper.__name__ = original.__name__
+        wrapper.__doc__ = original.__doc__
+        self.patched.append((klass, method, original))
+        setattr(klass, method, wrapper)
+
+    def _patchPrompt(self, klass, method):
+        original = klass.__dict__[method]
+        profiler = self
+        key = "prompt:%s" % method
+        def wrapper(service, *args, **kwargs):
+            game = getattr(service, "game", None)
+            start = timer()
+            result = original(service, *args, **kwargs)
+            if isinstance(result, defer.Deferred) and not result.called:
+                if game is not None:
+                    profiler._startWait(game)
+                def answered(value):
+                    if game is not None:
+                        profiler._endWait(game)
+                    elapsed = timer() - start
+                    profiler.record(key, elapsed, elapsed)
+                    return value
+                result.addBoth(answered)
+            else:
+                profiler.record(key, timer() - start, 0.0)
+            return result
+        wrapper.__name__ = original.__name__
+        wrapper.__doc__ = original.__doc__
+        self.patched.append((klass, method, original))
+        setattr(klass, method, wrapper)
+
+    def toDict(self):
+        return dict((key, stats.toDict()) for key, stats in self.stats.iteritems())
+
+    def export(self, path):
+        """Writes the statistics to path as JSON"""
+        with open(path, "w") as f:
+            json.dump(self.toDict(), f, indent=1, sort_keys=True)
+
+    def report(self, out=sys.stdout):
+        """Prints a table of the statistics, ordered by phase and total time"""
+        out.write("%-28s %8s %10s %10s %10s %10s %10s\n" % ("call", "count", "total ms",
+                "wait ms", "mean us", "p50 us", "p99 us"))
+        for key in sorted(self.stats, key=lambda x: (x.split(":")[0], -self.stats[x].wall)):
+            stats = self.stats[key]
+            out.write("%-28s %8d %10.1f %10.1f %10.1f %10d %10d\n" % (key, stats.count,
+                    stats.wall * 1e3, stats.wait * 1e3, stats.wall * 1e6 / stats.count,
+                    stats.percentile(0.5) * 1e6, stats.percentile(0.99) * 1e6))
+
+def _gameOf(obj):
+    if isinstance(obj, GameManager):
+        return obj
+    if isinstance(obj, Player):
+        return getattr(obj, "game", None)
+    owner = getattr(obj, "owner", None)
+    return getattr(owner, "game", None)
+
+_profiler = None
+
+def enable(serviceClasses=()):
+    """Starts profiling every game in this process and returns the profiler"""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler(serviceClasses)
+        _profiler.install()
+    return _profiler
+
+def disable():
+    """Stops profiling and returns the profiler holding what was collected"""
+    global _profiler
+    profiler = _profiler
+    if profiler is not None:
+        profiler.uninstall()
+        _profiler = None
+    return profiler
+
+def main():
+    import simulation
+    parser = OptionParser(usage="%prog [options] BOT BOT [BOT...]")
+    parser.add_option("-n", "--games", type="int", default=200)
+    parser.add_option("-s", "--seed", type="int", default=0)
+    parser.add_option("-k", "--kingdom",
+            help="comma separated list of kingdom cards (default: random)")
+    parser.add_option("-o", "--output", help="export the statistics to this JSON file")
+    options, args = parser.parse_args()
+    bots = [simulation.BOTS[x] for x in args or ["smithy", "random"]]
+    cards = options.kingdom.split(",") if options.kingdom else None
+
+    profiler = enable(set(simulation.BOTS.values()) | set([simulation.BotUserService]))
+    for i in xrange(options.games):
+        simulation.playGame(bots, cards, seed=options.seed + i)
+    disable()
+    profiler.report()
+    if options.output:
+        profiler.export(options.output)
+
+if __name__ == '__main__':
+    main()
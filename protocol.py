@@ -0,0 +1,283 @@
+"""The structured client protocol. Instead of rendered text the server
+sends each client two kinds of calls, each with a single argument:
+
+update(data)
+    data holds what changed in the player's view of the game since the
+    last update, and 'log', the new log lines if there are any. Scalars
+    and lists are sent whole when they change; dicts, such as the hand and
+    the supply, only with their changed entries, 0 for cards that are
+    gone. The first update also carries 'cards', the table of card types
+    used in the game, 'players', the names of the players in turn order,
+    and 'you'. Cards are referred to by their id and players by their seat,
+    their position in turn order.
+
+    data is JSON, with the dicts flattened to lists of keys and values:
+    PB spends far longer on a nested structure than on a string. See
+    encodeDelta and decodeDelta.
+
+choose(data)
+    an update like the above that also holds 'choice', a request for the
+    player to decide: [kind, prompt, options, minimum, maximum]. kind is
+    one of
+
+        menu    pick one of the options, keys of the 'menu' labels, or of
+                all of them if options is None
+        hand    pick card ids from options, between minimum and maximum of
+                them, as a list if maximum > 1
+        supply  pick one card id from options
+        yesno   answer True or False to prompt
+        count   pick a number between minimum and maximum
+        text    answer prompt with a line of text
+
+    An answer of None or one that is not valid cancels the choice.
+
+The client keeps the state up to date in a StateMirror."""
+
+import json
+
+from outbox import Outbox, DEFAULT_FLUSH_DELAY
+
+# fields of the state that are dicts
+DICT_FIELDS = ("hand", "supply", "menu")
+_encoder = json.JSONEncoder(separators=(",", ":"))
+
+def encodeDelta(delta):
+    wire = dict(delta)
+    for key in DICT_FIELDS:
+        if key in wire:
+            wire[key] = [x for item in sorted(wire[key].iteritems()) for x in item]
+    return _encoder.encode(wire)
+
+def decodeDelta(data):
+    delta = json.loads(data)
+    for key in DICT_FIELDS:
+        if key in delta:
+            values = delta[key]
+            delta[key] = dict(zip(values[::2], values[1::2]))
+    return delta
+
+def turnBanner(name, turn):
+    return "\n------------------\n\n%s's turn!\nTurn: %d" % (name, turn)
+
+class PlayerView:
+    """What one player can see of a game, kept as it was last sent so that
+    only the changes go out"""
+
+    def __init__(self, game, player):
+        self.game = game
+        self.player = player
+        self.menu = None
+        self.sent = None
+        # card ids of the supply piles, which the state keeps by name. Set
+        # by the first delta, as the supply is only there once the game is
+        self.ids = None
+
+    def state(self):
+        """The view as plain values, built as cheaply as possible as this
+        runs every time something is sent"""
+        game = self.game
+        current = game.currentPlayer
+        hand = {}
+        for card in self.player.hand:
+            id = card.info.id
+            hand[id] = hand.get(id, 0) + 1
+        state = {
+                "current": current.seat,
+                "turn": current.turn,
+                "phase": current.turnphase,
+                "actions": current.actions,
+                "buys": current.buys,
+                "coins": current.coins,
+                "played": [x.info.id for x in current.played],
+                "hand": hand,
+                "draw": len(self.player.drawdeck),
+                "discard": len(self.player.discard),
+                "handSizes": [len(x.hand) for x in game.players],
+                "supply": dict(game.supplyPile.piles),
+                }
+        if self.menu is not None:
+            state["menu"] = self.menu
+        return state
+
+    def cardTable(self):
+        """(id, name, display name, cost, is action, is treasure, is victory)
+        of every card type in the supply"""
+        infos = [self.game.cardFactory.getCardInfo(x) for x in self.ids]
+        return [(x.id, x.name, x.displayName, x.cost, x.isAction, x.isTreasure, x.isVictory)
+                for x in sorted(infos, key=lambda x: x.id)]
+
+    def delta(self):
+        """Returns the changes since the last call and remembers the state"""
+        state = self.state()
+        delta = {}
+        if self.sent is None:
+            self.sent = {}
+            cardFactory = self.game.cardFactory
+            self.ids = dict((x, cardFactory.getCardInfo(x).id) for x in self.game.supplyPile.keys())
+            delta["cards"] = self.cardTable()
+            delta["players"] = [x.name for x in self.game.players]
+            delta["you"] = self.player.seat
+        for key, value in state.iteritems():
+            old = self.sent.get(key)
+            if value == old:
+                continue
+            if isinstance(value, dict) and old is not None:
+                changes = {}
+                for k, v in value.iteritems():
+                    if old.get(k) != v:
+                        changes[k] = v
+                for k in old:
+                    if k not in value:
+                        changes[k] = 0
+                delta[key] = changes
+            else:
+                delta[key] = value
+        if "supply" in delta:
+            ids = self.ids
+            delta["supply"] = dict([(ids[k], v) for k, v in delta["supply"].iteritems()])
+        self.sent = state
+        return delta
+
+class StateOutbox(Outbox):
+    """An Outbox that sends the queued messages together with the changes
+    to the player's view as a single update call"""
+
+    def __init__(self, callRemote, view, delay=DEFAULT_FLUSH_DELAY):
+        Outbox.__init__(self, callRemote, delay)
+        self.view = view
+
+    def encode(self, messages, choice=None):
+        """Returns the update holding messages, choice and the changes to
+        the view, or None if there is nothing to send"""
+        delta = self.view.delta()
+        if messages:
+            delta["log"] = messages
+        if choice is not None:
+            delta["choice"] = choice
+        if not delta:
+            return None
+        return encodeDelta(delta)
+
+    def send(self, messages):
+        data = self.encode(messages)
+        if data is None:
+            return None
+        return self.deliver("update", data)
+
+    def call(self, method, *args):
+        if method != "choose":
+            return Outbox.call(self, method, *args)
+        # choice requests carry the update leading up to them
+        return self.callClient(method, self.encode(self.take(), list(args)))
+
+class CardEntry:
+    def __init__(self, id, name, displayName, cost, isAction, isTreasure, isVictory):
+        self.id = id
+        self.name = name
+        self.displayName = displayName
+        self.cost = cost
+        self.isAction = isAction
+        self.isTreasure = isTreasure
+        self.isVictory = isVictory
+
+    def __repr__(self):
+        return self.displayName
+
+class StateMirror:
+    """The client's copy of its view of the game, built from the updates"""
+
+    def __init__(self):
+        self.cards = {}
+        self.players = []
+        self.you = None
+        self.state = {}
+
+    def apply(self, delta):
+        """Applies a decoded update and returns its log lines, with the start
+        of a turn announced like the server does for text clients"""
+        log = []
+        for key, value in delta.iteritems():
+            if key == "log":
+                log = value
+            elif key == "choice":
+                pass
+            elif key == "cards":
+                self.cards = dict((x[0], CardEntry(*x)) for x in value)
+            elif key == "players":
+                self.players = value
+            elif key == "you":
+                self.you = value
+            elif isinstance(value, dict) and isinstance(self.state.get(key), dict):
+                self.state[key].update(value)
+            else:
+                self.state[key] = value
+        if "current" in delta or "turn" in delta:
+            log.append(turnBanner(self.players[self.state["current"]], self.state["turn"]))
+        return log
+
+    def __getitem__(self, key):
+        return self.state[key]
+
+    def hand(self):
+        """The cards in hand as (card, count), ordered by name"""
+        hand = [(self.cards[x], count) for x, count in self.state.get("hand", {}).iteritems() if count]
+        hand.sort(key=lambda x: x[0].displayName)
+        return hand
+
+    def renderHand(self):
+        state = self.state
+        message = "\n"
+        message += "Hand:     " + ', '.join(["%s: %d" % (card, count) for card, count in self.hand()]) + "\n\n"
+        message += "Actions:  %d\t\tDraw: %d\n" % (state["actions"], state["draw"])
+        message += "Buys:     %d\t\tDiscard: %d\n" % (state["buys"], state["discard"])
+        message += "Treasure: %d\n" % state["coins"]
+        return message
+
+    def renderGameArea(self):
+        message = ""
+        for id, remaining in sorted(self.state["supply"].iteritems()):
+            message += "%s: %d" % (self.cards[id], remaining) + "\n"
+        message += "Cards played so far:\n"
+        for id in self.state["played"]:
+            message += repr(self.cards[id]) + "\n"
+        return message
+
+    def renderChoice(self, kind, prompt, options, minimum, maximum):
+        """Renders a choice request as the text prompt of the text protocol"""
+        lines = [prompt] if prompt else []
+        if kind == "menu":
+            menu = self.state["menu"]
+            lines += ["%s: %s" % (x, menu[x]) for x in options or sorted(menu)]
+        elif kind == "hand":
+            lines += ["%d: %s" % (i+1, self.cards[x]) for i, x in enumerate(options)]
+            if maximum > 1:
+                lines.append("(choose %d, separated by spaces)" % maximum)
+        elif kind == "supply":
+            lines += ["%d: (%d) %s" % (i+1, self.cards[x].cost, self.cards[x]) for i, x in enumerate(options)]
+        elif kind == "yesno":
+            lines += ["1: No", "2: Yes"]
+        elif kind == "count":
+            lines = ["%s (min %d, max %d)" % (prompt, minimum, maximum)]
+        return "\n".join(lines)
+
+    def parseAnswer(self, kind, options, minimum, maximum, line):
+        """Turns a line typed in answer to renderChoice into the answer sent
+        back, None if it is not valid"""
+        line = line.strip()
+        try:
+            if kind == "menu":
+                return line if line in (options or self.state["menu"]) else None
+            if kind in ("hand", "supply"):
+                choices = [options[int(x)-1] for x in line.split()]
+                if min(int(x) for x in line.split()) < 1:
+                    return None
+                if maximum > 1:
+                    return choices
+                return choices[0] if len(choices) == 1 else None
+            if kind == "yesno":
+                return line == "2"
+            if kind == "count":
+                return int(line)
+        except (ValueError, IndexError):
+            return None
+        return line
@@ -0,0 +1,373 @@
+import os
+import sys
+import mmap
+import time
+import struct
+from optparse import OptionParser
+
+from core import *
+from replay import GameRecord, getRecord, recordGame, replay
+
+MAGIC = "DREC"
+VERSION = 2
+NONE = 0xff
+
+# decision tags
+PLAY, BUY, END, ANSWER = 1, 2, 3, 4
+_actionTags = {"play": PLAY, "buy": BUY, "end": END}
+_actionNames = dict((v, k) for k, v in _actionTags.iteritems())
+
+METHODS = ("chooseCardFromHand", "chooseCardsFromHand", "chooseCardFromSupply",
+           "chooseCardForBuy", "getCardInstance", "getCardNameByCost",
+           "getYesNoChoice", "getChoice")
+_methodIds = dict((x, i) for i, x in enumerate(METHODS))
+# methods answering with the name of a supply pile
+_cardNameMethods = ("chooseCardFromSupply", "chooseCardForBuy", "getCardNameByCost")
+
+# value tags
+V_NONE, V_FALSE, V_TRUE, V_STR, V_CARD, V_CARDPOS, V_LIST, V_INT = range(8)
+
+# event tags, see EventRecorder
+E_DRAW, E_RESHUFFLE, E_PLAY, E_GAIN, E_TRASH, E_REVEAL, E_ATTACK = range(1, 8)
+_eventTags = {DrawEvent: E_DRAW, ReshuffleEvent: E_RESHUFFLE, PlayEvent: E_PLAY,
+              GainEvent: E_GAIN, TrashEvent: E_TRASH, RevealEvent: E_REVEAL,
+              AttackEvent: E_ATTACK}
+EVENT_NAMES = {E_DRAW: "draw", E_RESHUFFLE: "reshuffle", E_PLAY: "play",
+               E_GAIN: "gain", E_TRASH: "trash", E_REVEAL: "reveal",
+               E_ATTACK: "attack"}
+
+_header = struct.Struct("<4sBH")
+_length = struct.Struct("<I")
+_gameHeader = struct.Struct("<QBB")
+_action = struct.Struct("<BBBB")
+
+class RecordFormatError(Exception):
+    pass
+
+class EventRecorder:
+    """Subscribes to a game's event bus and keeps its typed events as compact
+    tuples of (tag, seat, depth, data) with cards as card type ids. Narrative
+    messages are not kept."""
+    def __init__(self, bus):
+        self.events = []
+        bus.subscribe(self.append)
+
+    def append(self, event):
+        tag = _eventTags.get(type(event))
+        if tag is None:
+            return
+        if tag == E_DRAW:
+            data = (event.toHand, tuple([x.info.id for x in event.cards]))
+        elif tag == E_REVEAL:
+            data = tuple([x.info.id for x in event.cards])
+        elif tag == E_ATTACK:
+            data = (tuple([x.seat for x in event.affected]), tuple([x.seat for x in event.immune]))
+        elif tag == E_RESHUFFLE:
+            data = None
+        else:
+            data = event.card.info.id
+        self.events.append((tag, event.player.seat, event.depth, data))
+
+def _pack(fmt, *args):
+    return struct.pack("<" + fmt, *args)
+
+def _encodeString(value, fmt="H"):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    limit = (1 << 8 * struct.calcsize(fmt)) - 1
+    if len(value) > limit:
+        # cut short between two characters
+        value = value[:limit].decode("utf-8", "ignore").encode("utf-8")
+    return _pack(fmt, len(value)) + value
+
+class _Encoder:
+    def __init__(self, cardIds):
+        self.cardIds = cardIds
+
+    def cardId(self, cardName):
+        if cardName is None:
+            return NONE
+        return self.cardIds[cardName]
+
+    def value(self, method, value):
+        if value is None:
+            return chr(V_NONE)
+        if value is True:
+            return chr(V_TRUE)
+        if value is False:
+            return chr(V_FALSE)
+        if isinstance(value, (int, long)):
+            return chr(V_INT) + _pack("i", value)
+        if isinstance(value, tuple):
+            return chr(V_CARDPOS) + _pack("BB", value[0], self.cardId(value[1]))
+        if isinstance(value, list):
+            return chr(V_LIST) + chr(len(value)) + ''.join([self.value(method, x) for x in value])
+        if method in _cardNameMethods and value in self.cardIds:
+            return chr(V_CARD) + chr(self.cardIds[value])
+        return chr(V_STR) + _encodeString(value)
+
+    def decisions(self, decisions):
+        parts = []
+        for decision in decisions:
+            if decision[0] == "answer":
+                tag, seat, method, value, failed = decision
+                parts.append(_action.pack(ANSWER, seat, _methodIds[method], failed and 1 or 0))
+                parts.append(self.value(method, value))
+            else:
+                kind, seat, cardName, handIndex = decision
+                parts.append(_action.pack(_actionTags[kind], seat, self.cardId(cardName),
+                        NONE if handIndex is None else handIndex))
+        return ''.join(parts)
+
+    def events(self, events):
+        parts = []
+        for tag, seat, depth, data in events:
+            parts.append(_pack("BBB", tag, seat, depth))
+            if tag == E_DRAW:
+                parts.append(chr(data[0] and 1 or 0) + chr(len(data[1])) + ''.join(map(chr, data[1])))
+            elif tag == E_REVEAL:
+                parts.append(chr(len(data)) + ''.join(map(chr, data)))
+            elif tag == E_ATTACK:
+                for seats in data:
+                    parts.append(chr(len(seats)) + ''.join(map(chr, seats)))
+            elif tag != E_RESHUFFLE:
+                parts.append(chr(data))
+        return ''.join(parts)
+
+    def record(self, record):
+        flags = (record.randomKingdom and 1 or 0) | (record.events is not None and 2 or 0)
+        parts = [_gameHeader.pack(record.seed, flags, len(record.playerNames))]
+        parts.extend([_encodeString(x) for x in record.playerNames])
+        parts.append(chr(len(record.kingdom)) + ''.join([chr(self.cardIds[x]) for x in record.kingdom]))
+        for blob in (self.decisions(record.decisions), self.events(record.events or ())):
+            parts.append(_length.pack(len(blob)))
+            parts.append(blob)
+        return ''.join(parts)
+
+def _readHeader(data):
+    """Returns the card names by id and the offset of the first record"""
+    if len(data) < _header.size:
+        raise RecordFormatError("file is too short")
+    magic, version, count = _header.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise RecordFormatError("not a version %d game record file" % VERSION)
+    offset = _header.size
+    cardNames = []
+    for i in xrange(count):
+        length = ord(data[offset])
+        cardNames.append(data[offset+1:offset+1+length])
+        offset += 1 + length
+    return cardNames, offset
+
+class GameRecordWriter:
+    """Appends games to a record file. A new file starts with a table of the
+    card names by id, so a file stays readable if the card registry
+    changes."""
+    def __init__(self, path):
+        infos = CardFactory().getCardInfos()
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb") as f:
+                cardNames, offset = _readHeader(f.read(64 * 1024))
+            if cardNames != [x.name for x in infos[:len(cardNames)]]:
+                raise RecordFormatError("%s was written with a different card registry" % path)
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "ab")
+            self.file.write(_header.pack(MAGIC, VERSION, len(infos)))
+            self.file.write(''.join([_encodeString(x.name, "B") for x in infos]))
+        self.encoder = _Encoder(dict((x.name, x.id) for x in infos))
+
+    def write(self, record):
+        data = self.encoder.record(record)
+        self.file.write(_length.pack(len(data)) + data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class GameRecordReader:
+    """Reads a record file through a memory map, one game at a time, so
+    files much larger than memory can be scanned in one pass"""
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cardNames, self.start = _readHeader(self.map)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def offsets(self):
+        """Yields the offset and length of every game in the file"""
+        data = self.map
+        offset = self.start
+        end = len(data)
+        while offset < end:
+            length, = _length.unpack_from(data, offset)
+            offset += _length.size
+            yield offset, length
+            offset += length
+
+    def scan(self):
+        """Yields (seed, playerNames, kingdom) of every game without decoding
+        its decisions and events"""
+        for offset, length in self.offsets():
+            yield self._readGameHeader(offset)[:3]
+
+    def __iter__(self):
+        """Yields every game as a replay.GameRecord"""
+        data = self.map
+        for offset, length in self.offsets():
+            seed, playerNames, kingdom, randomKingdom, hasEvents, offset = self._readGameHeader(offset)
+            size, = _length.unpack_from(data, offset)
+            offset += _length.size
+            decisions = self._readDecisions(offset, offset + size)
+            offset += size
+            size, = _length.unpack_from(data, offset)
+            offset += _length.size
+            events = self._readEvents(offset, offset + size) if hasEvents else None
+            yield GameRecord(seed, playerNames, kingdom, randomKingdom, decisions, events)
+
+    def _readGameHeader(self, offset):
+        data = self.map
+        seed, flags, numPlayers = _gameHeader.unpack_from(data, offset)
+        offset += _gameHeader.size
+        playerNames = []
+        for i in xrange(numPlayers):
+            length, = struct.unpack_from("<H", data, offset)
+            playerNames.append(data[offset+2:offset+2+length].decode("utf-8"))
+            offset += 2 + length
+        count = ord(data[offset])
+        kingdom = [self.cardNames[ord(x)] for x in data[offset+1:offset+1+count]]
+        offset += 1 + count
+        return seed, playerNames, kingdom, bool(flags & 1), bool(flags & 2), offset
+
+    def _cardName(self, cardId):
+        if cardId == NONE:
+            return None
+        return self.cardNames[cardId]
+
+    def _readValue(self, offset):
+        data = self.map
+        tag = ord(data[offset])
+        offset += 1
+        if tag == V_NONE:
+            return None, offset
+        if tag == V_TRUE:
+            return True, offset
+        if tag == V_FALSE:
+            return False, offset
+        if tag == V_INT:
+            return struct.unpack_from("<i", data, offset)[0], offset + 4
+        if tag == V_CARD:
+            return self.cardNames[ord(data[offset])], offset + 1
+        if tag == V_CARDPOS:
+            return (ord(data[offset]), self._cardName(ord(data[offset+1]))), offset + 2
+        if tag == V_STR:
+            length, = struct.unpack_from("<H", data, offset)
+            return data[offset+2:offset+2+length], offset + 2 + length
+        if tag == V_LIST:
+            count = ord(data[offset])
+            offset += 1
+            values = []
+            for i in xrange(count):
+                value, offset = self._readValue(offset)
+                values.append(value)
+            return values, offset
+        raise RecordFormatError("unknown value tag %d" % tag)
+
+    def _readDecisions(self, offset, end):
+        data = self.map
+        decisions = []
+        while offset < end:
+            tag, seat, a, b = _action.unpack_from(data, offset)
+            offset += _action.size
+            if tag == ANSWER:
+                value, offset = self._readValue(offset)
+                decisions.append(("answer", seat, METHODS[a], value, bool(b)))
+            else:
+                decisions.append((_actionNames[tag], seat, self._cardName(a), None if b == NONE else b))
+        return decisions
+
+    def _readEvents(self, offset, end):
+        data = self.map
+        events = []
+        while offset < end:
+            tag, seat, depth = ord(data[offset]), ord(data[offset+1]), ord(data[offset+2])
+            offset += 3
+            if tag == E_DRAW:
+                count = ord(data[offset+1])
+                eventData = (data[offset] == "\x01", tuple(map(ord, data[offset+2:offset+2+count])))
+                offset += 2 + count
+            elif tag == E_REVEAL:
+                count = ord(data[offset])
+                eventData = tuple(map(ord, data[offset+1:offset+1+count]))
+                offset += 1 + count
+            elif tag == E_ATTACK:
+                eventData = []
+                for i in xrange(2):
+                    count = ord(data[offset])
+                    eventData.append(tuple(map(ord, data[offset+1:offset+1+count])))
+                    offset += 1 + count
+                eventData = tuple(eventData)
+            elif tag == E_RESHUFFLE:
+                eventData = None
+            else:
+                eventData = ord(data[offset])
+                offset += 1
+            events.append((tag, seat, depth, eventData))
+        return events
+
+def main():
+    import simulation
+    parser = OptionParser(usage="%prog write FILE [options] BOT BOT [BOT...]\n"
+                                "       %prog scan|replay FILE")
+    parser.add_option("-n", "--games", type="int", default=1000)
+    parser.add_option("-s", "--seed", type="int", default=0)
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("need a command and a file")
+    command, path = args[:2]
+
+    start = time.time()
+    if command == "write":
+        bots = [simulation.BOTS[x] for x in args[2:] or ["smithy", "random"]]
+        writer = GameRecordWriter(path)
+        for i in xrange(options.games):
+            players = [Player("%s%d" % (bot.__name__, j+1)) for j, bot in enumerate(bots)]
+            game = GameManager(players, options.seed + i)
+            for bot, player in zip(bots, players):
+                player.userService = bot(game, player)
+            recorder = EventRecorder(game.events)
+            recordGame(game)
+            game.setup()
+            simulation.resultOf(simulation.runGame(game))
+            writer.write(getRecord(game, recorder.events))
+        writer.close()
+        count = options.games
+    elif command == "scan":
+        reader = GameRecordReader(path)
+        count = decisions = events = 0
+        for record in reader:
+            count += 1
+            decisions += len(record.decisions)
+            events += len(record.events or ())
+        reader.close()
+        print "%d decisions, %d events" % (decisions, events)
+    elif command == "replay":
+        reader = GameRecordReader(path)
+        count = 0
+        for record in reader:
+            replay(record)
+            count += 1
+        reader.close()
+    else:
+        parser.error("unknown command %s" % command)
+    elapsed = time.time() - start
+    print "%s: %d games in %.2fs (%.0f games/s), file is %d bytes" % (command, count,
+            elapsed, count / elapsed if elapsed else 0, os.path.getsize(path))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+import sys
+import time
+from collections import deque
+from optparse import OptionParser
+
+from zope.interface import implements
+from zope.interface.verify import verifyClass
+from twisted.internet import defer
+from twisted.python import failure
+
+from core import *
+from base import *
+
+class ReplayError(Exception):
+    """The decision log does not match the game being replayed"""
+    pass
+
+class ReplayedFailure(Exception):
+    """Raised by a replayed prompt where the recorded prompt failed, e.g.
+    because the user cancelled it"""
+    pass
+
+class GameRecord:
+    """Everything needed to re-execute a game: its seed, the players, the
+    kingdom and the decision log kept by GameManager.
+
+    The decision log holds the top level actions in the order they were taken
+    as ("play", seat, cardName, handIndex), ("buy", seat, cardName, None) and
+    ("end", seat, None, None), interleaved with the answers to the prompts
+    made while resolving them as ("answer", seat, method, value, failed).
+    Cards in answers are logged as (position, cardName) pairs, the position
+    being in the hand or in the list of valid choices.
+
+    events optionally holds the game's event stream in the compact form
+    kept by records.EventRecorder."""
+    def __init__(self, seed, playerNames, kingdom, randomKingdom, decisions, events=None):
+        self.seed = seed
+        self.playerNames = playerNames
+        self.kingdom = kingdom
+        self.randomKingdom = randomKingdom
+        self.decisions = decisions
+        self.events = events
+
+def getRecord(game, events=None):
+    return GameRecord(game.seed, [x.name for x in game.players], game.kingdom,
+            game.randomKingdom, list(game.decisions), events)
+
+def recordGame(game):
+    """Starts logging the decisions made in game. Call this after the user
+    services have been assigned and before setup()"""
+    game.decisions = []
+    for player in game.players:
+        player.userService = RecordingUserService(player.userService, game, player)
+
+class RecordingUserService:
+    """Wraps a user service and logs the answers it gives while a play or buy
+    is being resolved. Prompts made outside of one (menus, the simulation
+    driver) are not logged: the actions they lead to are logged by the game
+    itself."""
+    implements(IUserService)
+
+    def __init__(self, service, game, player):
+        self.service = service
+        self.game = game
+        self.player = player
+
+    def __getattr__(self, name):
+        return getattr(self.service, name)
+
+    def sendMessage(self, message):
+        self.service.sendMessage(message)
+
+    def chooseCardFromHand(self, klass=Card):
+        return self._call("chooseCardFromHand", self._encodeHandCard, klass)
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        if ignore is None:
+            return self._call("chooseCardsFromHand", self._encodeHandCards, klass, number)
+        return self._call("chooseCardsFromHand", self._encodeHandCards, klass, number, ignore)
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        return self._call("chooseCardFromSupply", None, klass, availableCoins)
+
+    def chooseCardForBuy(self):
+        return self._call("chooseCardForBuy", None)
+
+    def getCardInstance(self, validChoices, prompt=None):
+        def encode(card):
+            if card is None:
+                return None
+            return (validChoices.index(card), card.info.name)
+        if prompt is None:
+            return self._call("getCardInstance", encode, validChoices)
+        return self._call("getCardInstance", encode, validChoices, prompt)
+
+    def getCardNameByCost(self, validChoices):
+        return self._call("getCardNameByCost", None, validChoices)
+
+    def getYesNoChoice(self, question):
+        return self._call("getYesNoChoice", None, question)
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is None:
+            return self._call("getChoice", None, prompt)
+        return self._call("getChoice", None, prompt, minimum, maximum)
+
+    def noBuysRemain(self):
+        self.service.noBuysRemain()
+
+    def _encodeHandCard(self, card):
+        if card is None:
+            return None
+        return (self.player.hand.index[card], card.info.name)
+
+    def _encodeHandCards(self, cards):
+        if cards is None:
+            return None
+        return [self._encodeHandCard(x) for x in cards]
+
+    def _call(self, method, encode, *args):
+        if self.game.pendingAction is None:
+            return getattr(self.service, method)(*args)
+        try:
+            result = getattr(self.service, method)(*args)
+        except Exception:
+            self._log(method, None, True)
+            raise
+        if isinstance(result, defer.Deferred):
+            # prompts asked together may be answered in any order, but they
+            # are logged in the order they were asked, the order a replay
+            # asks them in. Until the answer comes the prompt counts as failed
+            index = self._log(method, None, True)
+            def answered(value):
+                self._log(method, encode(value) if encode else value, False, index)
+                return value
+            return result.addCallback(answered)
+        self._log(method, encode(result) if encode else result, False)
+        return result
+
+    def _log(self, method, value, failed, index=None):
+        decision = ("answer", self.player.seat, method, value, failed)
+        if index is None:
+            self.game.decisions.append(decision)
+            return len(self.game.decisions) - 1
+        self.game.decisions[index] = decision
+
+verifyClass(IUserService, RecordingUserService)
+
+class ReplayUserService:
+    """Answers every prompt from a recorded decision log, without any I/O"""
+    implements(IUserService)
+
+    def __init__(self, game, player, answers):
+        self.game = game
+        self.player = player
+        self.answers = deque(answers)
+
+    def sendMessage(self, message):
+        pass
+
+    def chooseCardFromHand(self, klass=Card):
+        return self._findCard(self.player.hand, self._next("chooseCardFromHand"))
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        answer = self._next("chooseCardsFromHand")
+        if answer is None:
+            return None
+        # all positions refer to the hand as it was before any was removed
+        return [self._findCard(self.player.hand, x) for x in answer]
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        return self._next("chooseCardFromSupply")
+
+    def chooseCardForBuy(self):
+        return self._next("chooseCardForBuy")
+
+    def getCardInstance(self, validChoices, prompt=None):
+        return self._findCard(validChoices, self._next("getCardInstance"))
+
+    def getCardNameByCost(self, validChoices):
+        return self._next("getCardNameByCost")
+
+    def getYesNoChoice(self, question):
+        return self._next("getYesNoChoice")
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        return self._next("getChoice")
+
+    def noBuysRemain(self):
+        """The end of the turn is in the log"""
+        pass
+
+    def _next(self, method):
+        if not self.answers:
+            raise ReplayError("%s has no recorded answer left for %s" % (self.player, method))
+        recordedMethod, value, failed = self.answers.popleft()
+        if recordedMethod != method:
+            raise ReplayError("%s was asked %s but the log has %s" % (self.player, method, recordedMethod))
+        if failed:
+            raise ReplayedFailure(method)
+        return value
+
+    def _findCard(self, cards, answer):
+        if answer is None:
+            return None
+        position, cardName = answer
+        if position >= len(cards) or cards[position].info.name != cardName:
+            raise ReplayError("%s does not have a %s at position %d" % (self.player, cardName, position))
+        return cards[position]
+
+verifyClass(IUserService, ReplayUserService)
+
+def _checkAction(action, *args):
+    """Like the menus, a failed action does not stop the game, but a log that
+    does not match the game does"""
+    try:
+        d = action(*args)
+    except ReplayError:
+        raise
+    except Exception:
+        return
+    if not isinstance(d, defer.Deferred):
+        return
+    results = []
+    d.addBoth(results.append)
+    if not results:
+        raise ReplayError("action is waiting on a prompt")
+    if isinstance(results[0], failure.Failure) and results[0].check(ReplayError):
+        results[0].raiseException()
+
+def replay(record):
+    """Re-executes a recorded game and returns the resulting GameManager"""
+    players = [Player(x) for x in record.playerNames]
+    game = GameManager(players, record.seed)
+    answers = [[] for x in players]
+    actions = []
+    for decision in record.decisions:
+        if decision[0] == "answer":
+            answers[decision[1]].append(decision[2:])
+        else:
+            actions.append(decision)
+    for player in players:
+        player.userService = ReplayUserService(game, player, answers[player.seat])
+    game.setup(None if record.randomKingdom else record.kingdom)
+
+    for kind, seat, cardName, handIndex in actions:
+        player = players[seat]
+        if kind == "play":
+            card = player.userService._findCard(player.hand, (handIndex, cardName))
+            _checkAction(player.play, card)
+        elif kind == "buy":
+            _checkAction(player.buy, cardName)
+        elif kind == "end":
+            if game.currentPlayer is not player:
+                raise ReplayError("log ends %s's turn during %s's" % (player, game.currentPlayer))
+            game.endTurn()
+        else:
+            raise ReplayError("unknown action %r" % kind)
+    return game
+
+def main():
+    """Records bot games, replays them and checks the replays match"""
+    import simulation
+    parser = OptionParser(usage="%prog [options] BOT BOT [BOT...]")
+    parser.add_option("-n", "--games", type="int", default=100)
+    parser.add_option("-s", "--seed", type="int", default=0)
+    options, args = parser.parse_args()
+    bots = [simulation.BOTS[x] for x in args or ["smithy", "random"]]
+
+    records = []
+    results = []
+    start = time.time()
+    for i in xrange(options.games):
+        game = simulation.playGame(bots, seed=options.seed + i, record=True)
+        records.append(getRecord(game))
+        results.append([(x.score, sorted([repr(y) for y in x.deck])) for x in game.players])
+    played = time.time() - start
+
+    start = time.time()
+    for record, result in zip(records, results):
+        game = replay(record)
+        if [(x.score, sorted([repr(y) for y in x.deck])) for x in game.players] != result:
+            print "game with seed %d did not replay identically" % record.seed
+            sys.exit(1)
+    replayed = time.time() - start
+    print "played %d games in %.2fs, replayed them in %.2fs" % (options.games, played, replayed)
+
+if __name__ == '__main__':
+    main()
@@ -49,7 +49,9 @@ class SimpleUserService:
         validChoices = self.game.getAvailableCardsToBuy(self.player.coins)
         return self.getCardNameByCost(validChoices)
 
-    def getCardInstance(self, validChoices):
+    def getCardInstance(self, validChoices, prompt=None):
+        if prompt:
+            print prompt
         for i, card in enumerate(validChoices):
             print "%d: %s" % (i+1, repr(card))
         choice = raw_input("Enter choice: ")
@@ -58,16 +60,15 @@ class SimpleUserService:
         return validChoices[int(choice)-1]
 
     def getCardNameByCost(self, validChoices):
-        cardList = []
-        for choice in validChoices:
-            cardList.append(self.game.cardFactory.newCard(choice))
-        cardList = sorted(cardList, key=lambda x: x.cost, reverse=True)
-        for i, card in enumerate(cardList):
-            print "%d: (%d) %s" % (i+1, card.cost, repr(card))
+        cardFactory = self.game.cardFactory
+        cardList = [cardFactory.getCardInfo(x) for x in validChoices]
+        cardList.sort(key=lambda x: x.cost, reverse=True)
+        for i, info in enumerate(cardList):
+            print "%d: (%d) %s" % (i+1, info.cost, info.displayName)
         choice = raw_input("Enter choice: ")
         if choice == "c" or choice == "" or int(choice)-1 < 0 or int(choice)-1 >= len(validChoices):
             return None
-        return cardList[int(choice)-1].__name__()
+        return cardList[int(choice)-1].name
 
     def getYesNoChoice(self, question):
         print question
@@ -79,7 +80,9 @@ class SimpleUserService:
         else:
             return False
 
-    def getChoice(self, prompt):
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is not None:
+            prompt = "%s (min %d, max %d)" % (prompt, minimum, maximum)
         print prompt
         choice = raw_input("Enter choice: ")
         if choice == "c" or choice == "":
@@ -129,7 +132,7 @@ class Menu:
 
     def playTreasures(self, player):
         """Play all treasure cards"""
-        hand = player.hand[:]
+        hand = list(player.hand)
         for card in hand:
             if isinstance(card, Treasure):
                 player.play(card)
@@ -227,7 +230,7 @@ def main():
 
     menu = Menu(game)
     #print "Turn order will be %s then %s" % (user1, user2)
-    print "Game: %s" % ', '.join(sorted([x for x in game.supplyPile.keys() if game.cardFactory.newCard(x).__module__ != 'core']))
+    print "Game: %s" % ', '.join(sorted([x for x in game.supplyPile.keys() if game.cardFactory.getCardInfo(x).kingdom]))
 
     while not game.end():
         player = game.currentPlayer
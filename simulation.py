@@ -0,0 +1,336 @@
+import sys
+import time
+import random
+from optparse import OptionParser
+
+from zope.interface import implements
+from zope.interface.verify import verifyClass
+from twisted.internet import defer
+from twisted.python import failure
+
+from core import *
+from base import *
+import core
+import replay
+
+MAX_TURNS = 100
+
+class BotUserService:
+    """Base class for computer players. Every prompt is answered
+    synchronously straight from the game objects, so no prompt strings are
+    ever built. Subclasses override the pick* methods to form a strategy."""
+    implements(IUserService)
+
+    # like the structured clients of the server, bots read the game state
+    # itself and need nothing rendered for them
+    structured = True
+
+    def __init__(self, game, player):
+        self.game = game
+        self.player = player
+        # bots get their own generator so that their choices don't disturb
+        # the game's shuffles
+        self.random = random.Random((game.seed << 3) + player.seat)
+        # (option, answer) settled on by chooseOption for the prompt the
+        # option leads to
+        self.chosen = None
+
+    def sendMessage(self, message):
+        pass
+
+    def chooseCardFromHand(self, klass=Card):
+        if klass == (Action, Treasure):
+            # the "play card" of the server's menu, which chooseOption only
+            # picks to play an action. Treasures are played all at once
+            chosen = self.takeChosen("1")
+            if chosen is not None:
+                return chosen
+            return self.chooseCardFromHand(Action)
+        validChoices = [x for x in self.player.hand if isinstance(x, klass)]
+        if not validChoices:
+            return None
+        return self.pickCard(validChoices, klass)
+
+    def chooseCardsFromHand(self, klass, number, ignore=None):
+        validChoices = [x for x in self.player.hand if isinstance(x, klass) and x is not ignore]
+        return self.pickCards(validChoices, min(number, len(validChoices)))
+
+    def chooseCardFromSupply(self, klass, availableCoins):
+        validChoices = self.game.getAvailableCardOfType(klass, availableCoins)
+        return self.getCardNameByCost(validChoices)
+
+    def chooseCardForBuy(self):
+        chosen = self.takeChosen("3")
+        if chosen is not None:
+            return chosen
+        validChoices = self.game.getAvailableCardsToBuy(self.player.coins)
+        return self.pickBuy(validChoices)
+
+    def getCardInstance(self, validChoices, prompt=None):
+        if not validChoices:
+            return None
+        return self.pickCard(validChoices, Card)
+
+    def getCardNameByCost(self, validChoices):
+        if not validChoices:
+            return None
+        return max(validChoices, key=self.costOf)
+
+    def getYesNoChoice(self, question):
+        return False
+
+    def getChoice(self, prompt, minimum=None, maximum=None):
+        if minimum is None:
+            return "0"
+        return str(minimum)
+
+    def noBuysRemain(self):
+        """The driver ends the turn itself once the buy phase is over"""
+        pass
+
+    def chooseOption(self, options):
+        """Answers the turn menu of the server, for a bot standing in for a
+        player there: an action if it would play one, then all treasures,
+        then a buy if it wants one, then the end of the turn"""
+        player = self.player
+        # the card is kept for the prompt that follows, so the bot neither
+        # changes its mind nor draws from self.random twice
+        self.chosen = None
+        if player.turnphase == "ACTION" and player.actions > 0:
+            card = self.chooseCardFromHand(Action)
+            if card:
+                self.chosen = ("1", card)
+                return "1"
+        if [x for x in player.hand if isinstance(x, Treasure)]:
+            return "2"
+        if player.buys > 0:
+            cardName = self.chooseCardForBuy()
+            if cardName:
+                self.chosen = ("3", cardName)
+                return "3"
+        return "6"
+
+    def takeChosen(self, option):
+        """Returns the answer chooseOption settled on if it picked option,
+        else None"""
+        chosen, self.chosen = self.chosen, None
+        if chosen is not None and chosen[0] == option:
+            return chosen[1]
+        return None
+
+    def costOf(self, cardName):
+        return self.game.cardFactory.getCardInfo(cardName).cost
+
+    def pickCard(self, validChoices, klass):
+        """Pick one card instance. Actions and treasures are picked most
+        expensive first, anything else cheapest first (i.e. the card we
+        would most like to get rid of)"""
+        if klass in (Action, Treasure):
+            return max(validChoices, key=lambda x: x.getCost())
+        return min(validChoices, key=self._junkRank)
+
+    def pickCards(self, validChoices, number):
+        return sorted(validChoices, key=self._junkRank)[:number]
+
+    def pickBuy(self, validChoices):
+        return None
+
+    def _junkRank(self, card):
+        if isinstance(card, Curse):
+            return (0, card.getCost())
+        if isinstance(card, Victory):
+            return (1, card.getCost())
+        return (2, card.getCost())
+
+class BigMoneyBot(BotUserService):
+    """Plays no actions and buys only treasure and victory cards"""
+
+    def chooseCardFromHand(self, klass=Card):
+        if klass is Action:
+            return None
+        return BotUserService.chooseCardFromHand(self, klass)
+
+    def pickBuy(self, validChoices):
+        provinces = self.game.supplyPile["Province"]
+        coins = self.player.coins
+        if coins >= 8:
+            return self._first(validChoices, "Province", "Gold")
+        if coins >= 6:
+            if provinces <= 4:
+                return self._first(validChoices, "Duchy", "Gold")
+            return self._first(validChoices, "Gold")
+        if coins >= 5 and provinces <= 5:
+            return self._first(validChoices, "Duchy", "Silver")
+        if coins >= 3:
+            if provinces <= 2:
+                return self._first(validChoices, "Estate", "Silver")
+            return self._first(validChoices, "Silver")
+        if coins >= 2 and provinces <= 3:
+            return self._first(validChoices, "Estate")
+        return None
+
+    def _first(self, validChoices, *cardNames):
+        for cardName in cardNames:
+            if cardName in validChoices:
+                return cardName
+        return None
+
+class SmithyBot(BigMoneyBot):
+    """Big Money that also buys a Smithy for roughly every 11 cards"""
+
+    def chooseCardFromHand(self, klass=Card):
+        return BotUserService.chooseCardFromHand(self, klass)
+
+    def pickBuy(self, validChoices):
+        coins = self.player.coins
+        if 4 <= coins <= 5 and "Smithy" in validChoices:
+            smithies = len([x for x in self.player.deck if isinstance(x, Smithy)])
+            if smithies < len(self.player.deck) / 11 + 1:
+                return "Smithy"
+        return BigMoneyBot.pickBuy(self, validChoices)
+
+class RandomBot(BotUserService):
+    """Makes a uniformly random legal choice at every prompt"""
+
+    def pickCard(self, validChoices, klass):
+        return self.random.choice(validChoices)
+
+    def pickCards(self, validChoices, number):
+        return self.random.sample(validChoices, number)
+
+    def pickBuy(self, validChoices):
+        if not validChoices or self.random.random() < 0.1:
+            return None
+        return self.random.choice(validChoices)
+
+    def getCardNameByCost(self, validChoices):
+        if not validChoices:
+            return None
+        return self.random.choice(validChoices)
+
+    def getYesNoChoice(self, question):
+        return self.random.random() < 0.5
+
+verifyClass(IUserService, BotUserService)
+
+BOTS = {
+        "bigmoney": BigMoneyBot,
+        "smithy": SmithyBot,
+        "random": RandomBot,
+        }
+
+@maybeInlineCallbacks
+def playTurn(game, player):
+    """Plays one full turn of player: actions, then all treasures, then buys"""
+    service = player.userService
+    while player.turnphase == "ACTION" and player.actions > 0:
+        card = yield service.chooseCardFromHand(Action)
+        if not card:
+            break
+        played = yield player.play(card)
+        if not played:
+            break
+    # so that a copy of the game taken from here on goes on with the buys
+    player.turnphase = "BUY"
+
+    for card in [x for x in player.hand if isinstance(x, Treasure)]:
+        yield player.play(card)
+
+    while player.buys > 0:
+        cardName = yield service.chooseCardForBuy()
+        if not cardName:
+            break
+        yield player.buy(cardName)
+
+    game.endTurn()
+
+@maybeInlineCallbacks
+def runGame(game, maxTurns=MAX_TURNS):
+    """Drives an already set up game until it ends or every player has had
+    maxTurns turns. Fires with the game's winners"""
+    while not game.end() and game.currentPlayer.turn <= maxTurns:
+        yield playTurn(game, game.currentPlayer)
+    defer.returnValue(game.getWinners())
+
+def resultOf(d):
+    """Returns the result of a Deferred which has already fired, or d itself
+    if it is a plain value. Bot games never wait on anything, so their
+    Deferreds fire synchronously"""
+    if not isinstance(d, defer.Deferred):
+        return d
+    results = []
+    d.addBoth(results.append)
+    if not results:
+        raise RuntimeError("game is waiting on an asynchronous prompt")
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+def playGame(bots, cards=None, maxTurns=MAX_TURNS, seed=None, record=False):
+    """Plays a complete game between the given bot classes and returns the
+    finished GameManager. With record set the decisions are logged so the
+    game can be replayed (see replay.py)"""
+    players = [Player("%s%d" % (bot.__name__, i+1)) for i, bot in enumerate(bots)]
+    game = GameManager(players, seed)
+    for bot, player in zip(bots, players):
+        player.userService = bot(game, player)
+    if record:
+        replay.recordGame(game)
+    game.setup(cards)
+    resultOf(runGame(game, maxTurns))
+    return game
+
+def runGames(bots, numGames, cards=None, maxTurns=MAX_TURNS, seed=None):
+    """Plays numGames games and returns a dict of statistics including the
+    number of wins of each seat and the games per second achieved. The game
+    seeds are derived from seed if given"""
+    rng = random.Random(seed)
+    wins = [0] * len(bots)
+    turns = 0
+    start = time.time()
+    for i in xrange(numGames):
+        game = playGame(bots, cards, maxTurns, rng.getrandbits(32))
+        for winner in game.getWinners():
+            wins[game.players.index(winner)] += 1
+        turns += max([x.turn for x in game.players])
+    elapsed = time.time() - start
+    return {
+            "games": numGames,
+            "seconds": elapsed,
+            "gamesPerSecond": numGames / elapsed if elapsed else float("inf"),
+            "msPerGame": elapsed * 1000.0 / numGames if numGames else 0.0,
+            "averageTurns": float(turns) / numGames if numGames else 0.0,
+            "wins": wins,
+            }
+
+def main():
+    parser = OptionParser(usage="%prog [options] BOT BOT [BOT...]")
+    parser.add_option("-n", "--games", type="int", default=1000,
+            help="number of games to play")
+    parser.add_option("-k", "--kingdom",
+            help="comma separated list of kingdom cards (default: random)")
+    parser.add_option("-s", "--seed", type="int", help="random seed")
+    parser.add_option("--debug-score", action="store_true",
+            help="check the incremental scores against a full recount")
+    parser.add_option("--deferred", action="store_true",
+            help="run cards through Deferreds even when the bots answer synchronously")
+    options, args = parser.parse_args()
+    if not args:
+        args = ["bigmoney", "bigmoney"]
+    try:
+        bots = [BOTS[x] for x in args]
+    except KeyError, e:
+        parser.error("unknown bot %s (choose from %s)" % (e, ', '.join(sorted(BOTS))))
+    Player.debugScore = options.debug_score
+    core.synchronous = not options.deferred
+    cards = options.kingdom.split(",") if options.kingdom else None
+
+    stats = runGames(bots, options.games, cards, seed=options.seed)
+    print "%d games in %.2fs: %.1f games/s, %.2f ms/game, %.1f turns/game" % (
+            stats["games"], stats["seconds"], stats["gamesPerSecond"],
+            stats["msPerGame"], stats["averageTurns"])
+    for i, bot in enumerate(args):
+        print "seat %d (%s): %d wins" % (i+1, bot, stats["wins"][i])
+
+if __name__ == '__main__':
+    main()
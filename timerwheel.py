@@ -0,0 +1,97 @@
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+# seconds between the ticks of a wheel, the precision of its timeouts
+DEFAULT_TICK = 0.5
+# slots in a wheel. Timeouts further out than a full turn of the wheel wait
+# for as many rounds
+DEFAULT_SLOTS = 256
+
+class Timeout:
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.wheel._remove(self)
+
+class TimerWheel:
+    """Schedules many timeouts cheaply. A timeout goes in the slot of the
+    tick it falls due in, and a single LoopingCall, running only while there
+    are timeouts, expires one slot per tick, so scheduling and cancelling
+    take constant time and the reactor has one timer instead of one for
+    every timeout. Timeouts fire up to a tick late."""
+
+    def __init__(self, tick=DEFAULT_TICK, slots=DEFAULT_SLOTS, clock=reactor):
+        self.tick = tick
+        self.slots = [set() for i in xrange(slots)]
+        self.clock = clock
+        self.current = 0
+        self.count = 0
+        self.loop = None
+        # when the loop started and the ticks it has made since, which give
+        # the time of the current slot's tick
+        self.started = None
+        self.ticks = 0
+
+    def schedule(self, delay, callback, *args):
+        """Calls callback(*args) after delay seconds, unless the returned
+        Timeout is cancelled first"""
+        if self.loop is None:
+            self.loop = LoopingCall.withCount(self._advance)
+            self.loop.clock = self.clock
+            self.loop.start(self.tick, now=False)
+            self.started = self.clock.seconds()
+            self.ticks = 0
+        # counted from the current slot's tick, part of which may have
+        # passed, to the first tick at or after the deadline
+        elapsed = self.clock.seconds() - (self.started + self.ticks * self.tick)
+        ticks = max(1, int(-(-(elapsed + delay) // self.tick)))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        slot = (self.current + offset + 1) % len(self.slots)
+        timeout = Timeout(self, slot, rounds, callback, args)
+        self.slots[slot].add(timeout)
+        self.count += 1
+        return timeout
+
+    def __len__(self):
+        return self.count
+
+    def _remove(self, timeout):
+        self.slots[timeout.slot].discard(timeout)
+        self.count -= 1
+        if not self.count and self.loop is not None:
+            self.loop.stop()
+            self.loop = None
+
+    def _advance(self, count):
+        # count is more than one if the reactor was too busy for some ticks.
+        # All the timeouts due by now are collected before any is called,
+        # so ones scheduled by the callbacks count from the right slot
+        self.ticks += count
+        due = []
+        for i in xrange(count):
+            self.current = (self.current + 1) % len(self.slots)
+            slot = self.slots[self.current]
+            for timeout in list(slot):
+                if timeout.rounds:
+                    timeout.rounds -= 1
+                else:
+                    slot.discard(timeout)
+                    due.append(timeout)
+        for timeout in due:
+            # an earlier callback may have cancelled it
+            if timeout.active():
+                timeout.called = True
+                self._remove(timeout)
+                timeout.callback(*timeout.args)
@@ -0,0 +1,125 @@
+import sys
+import time
+import random
+import json
+import multiprocessing
+from collections import defaultdict
+from itertools import combinations
+from optparse import OptionParser
+
+import simulation
+
+class GameResult(object):
+    """Compact result of one tournament game. Only plain values are kept so
+    that results are cheap to send back from the worker processes"""
+    __slots__ = ("index", "bots", "seed", "winners", "scores", "turns", "kingdom")
+
+    def __init__(self, index, bots, seed, winners, scores, turns, kingdom):
+        self.index = index
+        self.bots = bots
+        self.seed = seed
+        self.winners = winners
+        self.scores = scores
+        self.turns = turns
+        self.kingdom = kingdom
+
+    def __reduce__(self):
+        return (GameResult, tuple(getattr(self, x) for x in self.__slots__))
+
+    def toDict(self):
+        return dict((x, getattr(self, x)) for x in self.__slots__)
+
+def makeSchedule(botNames, gamesPerTable, tableSize, masterSeed, cards=None):
+    """Returns the list of games to play: every combination of tableSize
+    strategies, with the seating rotated between games. Each game gets its own
+    seed drawn from masterSeed, so the results do not depend on how the games
+    are spread over the workers"""
+    rng = random.Random(masterSeed)
+    tasks = []
+    for table in combinations(botNames, tableSize):
+        for i in xrange(gamesPerTable):
+            shift = i % tableSize
+            seating = table[shift:] + table[:shift]
+            tasks.append((len(tasks), seating, rng.getrandbits(32), cards))
+    return tasks
+
+def playTask(task):
+    index, seating, seed, cards = task
+    game = simulation.playGame([simulation.BOTS[x] for x in seating], cards, seed=seed)
+    winners = [game.players.index(x) for x in game.getWinners()]
+    return GameResult(index, seating, seed, winners,
+            [x.score for x in game.players], [x.turn for x in game.players], game.kingdom)
+
+def runTournament(botNames, gamesPerTable, tableSize=2, masterSeed=0,
+                  processes=None, cards=None, chunksize=16):
+    """Plays the tournament on a pool of processes and returns the results
+    ordered by game index"""
+    tasks = makeSchedule(botNames, gamesPerTable, tableSize, masterSeed, cards)
+    if processes == 1:
+        results = [playTask(x) for x in tasks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = list(pool.imap_unordered(playTask, tasks, chunksize))
+        finally:
+            pool.close()
+            pool.join()
+    results.sort(key=lambda x: x.index)
+    return results
+
+def summarize(results):
+    """Aggregates per strategy statistics. A tied game is shared between its
+    winners"""
+    stats = defaultdict(lambda: {"games": 0, "wins": 0.0, "score": 0, "turns": 0})
+    for result in results:
+        for seat, bot in enumerate(result.bots):
+            entry = stats[bot]
+            entry["games"] += 1
+            entry["score"] += result.scores[seat]
+            entry["turns"] += result.turns[seat]
+            if seat in result.winners:
+                entry["wins"] += 1.0 / len(result.winners)
+    return dict(stats)
+
+def main():
+    parser = OptionParser(usage="%prog [options] BOT BOT [BOT...]")
+    parser.add_option("-n", "--games", type="int", default=100,
+            help="games per table of strategies")
+    parser.add_option("-t", "--table-size", type="int", default=2,
+            help="number of players at each table")
+    parser.add_option("-s", "--seed", type="int", default=0,
+            help="master seed the whole run is derived from")
+    parser.add_option("-j", "--processes", type="int",
+            help="number of worker processes (default: number of cores)")
+    parser.add_option("-k", "--kingdom",
+            help="comma separated list of kingdom cards (default: random)")
+    parser.add_option("-o", "--output",
+            help="write one JSON line per game to this file")
+    options, args = parser.parse_args()
+    if len(args) < options.table_size:
+        parser.error("need at least %d strategies" % options.table_size)
+    for name in args:
+        if name not in simulation.BOTS:
+            parser.error("unknown bot %s (choose from %s)" % (name, ', '.join(sorted(simulation.BOTS))))
+    cards = options.kingdom.split(",") if options.kingdom else None
+
+    start = time.time()
+    results = runTournament(args, options.games, options.table_size,
+            options.seed, options.processes, cards)
+    elapsed = time.time() - start
+
+    if options.output:
+        with open(options.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result.toDict()) + "\n")
+
+    print "%d games in %.2fs: %.1f games/s" % (len(results), elapsed, len(results) / elapsed)
+    stats = summarize(results)
+    for bot in sorted(stats, key=lambda x: -stats[x]["wins"] / stats[x]["games"]):
+        entry = stats[bot]
+        print "%-10s %6d games  %5.1f%% wins  %5.1f avg score  %5.1f avg turns" % (bot,
+                entry["games"], 100.0 * entry["wins"] / entry["games"],
+                float(entry["score"]) / entry["games"], float(entry["turns"]) / entry["games"])
+
+if __name__ == '__main__':
+    main()